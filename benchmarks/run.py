@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""Time the plugins on synthetic ledgers and compare with a JSON baseline.
+
+    python benchmarks/run.py                          # 10^3 .. 10^5 entries
+    python benchmarks/run.py --sizes 1000 1000000     # pick the sizes
+    python benchmarks/run.py --shapes mixed dense     # pick the template shapes
+    python benchmarks/run.py --save                   # record the baseline
+    python benchmarks/run.py --threshold 0.10         # fail on a 10% slowdown
+
+Each plugin runs `--repeat` times on a fresh copy of the ledger and the best
+time is kept. With a baseline file present, the run fails (exit status 1)
+when any time exceeds its baseline by more than `--threshold`. Baselines are
+only comparable on the machine that recorded them.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from beancount.core import data
+from beancount.parser import options
+
+from beancount_muonzoo_plugins import dynamic_forecast, forecast, metadata_spray
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic_ledger  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+CHECKPOINT = os.path.join(tempfile.gettempdir(), "benchmark-dynamic_forecast.ckpt")
+
+
+def run_forecast(entries, options_map, spray):
+    return forecast.forecast_plugin(entries, options_map)
+
+
+def run_dynamic_forecast(entries, options_map, spray):
+    return dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+
+
+def run_dynamic_forecast_resume(entries, options_map, spray):
+    return dynamic_forecast.dynamic_forecast(
+        entries, options_map, repr({"checkpoint": CHECKPOINT})
+    )
+
+
+def prime_dynamic_forecast_resume(entries, spray):
+    """Checkpoint the ledger without its last transaction, so the timed runs resume as after appending it."""
+    if os.path.exists(CHECKPOINT):
+        os.remove(CHECKPOINT)
+    last = max(
+        index
+        for index, entry in enumerate(entries)
+        if isinstance(entry, data.Transaction) and entry.flag != "%"
+    )
+    run_dynamic_forecast_resume(
+        entries[:last] + entries[last + 1 :], options.OPTIONS_DEFAULTS.copy(), spray
+    )
+
+
+def run_metadata_spray(entries, options_map, spray):
+    return metadata_spray.metadata_spray_entries(entries, options_map, spray)
+
+
+PLUGINS = {
+    "forecast_plugin": run_forecast,
+    "dynamic_forecast": run_dynamic_forecast,
+    "dynamic_forecast_resume": run_dynamic_forecast_resume,
+    "metadata_spray_entries": run_metadata_spray,
+}
+
+# Run once per ledger before timing the plugin.
+SETUP = {
+    "dynamic_forecast_resume": prime_dynamic_forecast_resume,
+}
+
+
+# The template mix and recurrence density of the ledgers, as `LedgerSpec` fields.
+SHAPES = {
+    # Half the `%` templates read a balance, each recurring monthly for a year.
+    "mixed": {},
+    # Every `%` template reads a balance, so all of them wait for the merge.
+    "balances": {"balance_share": 1.0},
+    # No `%` template reads a balance, so all of them are evaluated in batches.
+    "events": {"balance_share": 0.0},
+    # Weekly for a year: four times the occurrences per template.
+    "dense": {"frequency": "WEEKLY", "occurrences": 52},
+    # Yearly, with twice the templates.
+    "sparse": {"frequency": "YEARLY", "occurrences": 3, "templates": 2},
+}
+
+
+def spec_for(size: int, shape: str = "mixed") -> synthetic_ledger.LedgerSpec:
+    """Scale the accounts and templates with the number of entries, in the template mix and density of `shape`."""
+    fields = dict(SHAPES[shape])
+    templates = max(5, size // 200) * fields.pop("templates", 1)
+    return synthetic_ledger.LedgerSpec(
+        entries=size,
+        accounts=max(20, size // 500),
+        forecast_templates=templates,
+        dynamic_templates=templates,
+        events=max(12, size // 1000),
+        **fields,
+    )
+
+
+def time_plugin(plugin, entries, spray, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        options_map = options.OPTIONS_DEFAULTS.copy()
+        copy = list(entries)
+        start = time.perf_counter()
+        _, errors = plugin(copy, options_map, spray)
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise RuntimeError(f"plugin reported errors: {errors[:3]}")
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def label(size: int, shape: str) -> str:
+    """The key of the results of `size` entries in `shape`; the default shape is keyed by the size alone."""
+    return str(size) if shape == "mixed" else f"{size}:{shape}"
+
+
+def run(sizes, plugins, repeat: int, shapes=("mixed",)) -> dict:
+    """Return `{plugin: {label(size, shape): seconds}}`."""
+    results = {name: {} for name in plugins}
+    for size in sizes:
+        for shape in shapes:
+            entries, spray = synthetic_ledger.generate(spec_for(size, shape))
+            for name in plugins:
+                if name in SETUP:
+                    SETUP[name](entries, spray)
+                seconds = time_plugin(PLUGINS[name], entries, spray, repeat)
+                results[name][label(size, shape)] = seconds
+                print(
+                    f"{name:<24} {size:>9} entries {shape:<8} {seconds:10.4f}s", flush=True
+                )
+    return results
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """The `(plugin, size, seconds, baseline seconds)` slower than allowed."""
+    slower = []
+    for name, timings in results.items():
+        for size, seconds in timings.items():
+            reference = baseline.get(name, {}).get(size)
+            if reference is not None and seconds > reference * (1 + threshold):
+                slower.append((name, size, seconds, reference))
+    return slower
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--shapes", nargs="+", choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument(
+        "--plugins", nargs="+", choices=sorted(PLUGINS), default=list(PLUGINS)
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed slowdown over the baseline, as a fraction (default: 0.25)",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="write the results as the new baseline"
+    )
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.plugins, args.repeat, args.shapes)
+
+    if args.save:
+        with open(args.baseline, "w") as outfile:
+            json.dump(
+                {"python": platform.python_version(), "results": results},
+                outfile,
+                indent=2,
+                sort_keys=True,
+            )
+            outfile.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --save to record one")
+        return 0
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)["results"]
+    slower = regressions(results, baseline, args.threshold)
+    for name, size, seconds, reference in slower:
+        print(
+            f"REGRESSION {name} at {size} entries: {seconds:.4f}s vs {reference:.4f}s",
+            file=sys.stderr,
+        )
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
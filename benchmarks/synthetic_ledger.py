@@ -0,0 +1,233 @@
+"""Deterministic synthetic ledgers for benchmarking the plugins.
+
+`generate(spec)` builds a sorted list of entries shaped by a `LedgerSpec`:
+account opens, rate events, ordinary transactions, `#` templates for the
+`forecast` plugin and `%` templates for `dynamic_forecast` (a share of them
+reading account balances, the others only events). It also returns a
+`metadata_spray` configuration whose patterns match the generated accounts.
+
+The same spec always yields the same ledger.
+
+"""
+
+import datetime
+import math
+import random
+
+from typing import List, NamedTuple, Tuple
+
+from beancount.core import data
+from beancount.core.amount import Amount
+from beancount.core.number import D
+
+CURRENCY = "USD"
+
+
+class LedgerSpec(NamedTuple):
+    """The shape of a synthetic ledger."""
+
+    entries: int = 1000
+    """ The approximate number of directives, before any plugin runs. """
+
+    accounts: int = 50
+    """ The number of accounts opened. """
+
+    forecast_templates: int = 5
+    """ The number of `#` templates (for the `forecast` plugin). """
+
+    dynamic_templates: int = 5
+    """ The number of `%` templates (for `dynamic_forecast`). """
+
+    balance_share: float = 0.5
+    """ The share of the `%` templates reading an account balance; the others read only events. """
+
+    occurrences: int = 12
+    """ The number of occurrences of each template (`REPEAT n TIMES`). """
+
+    frequency: str = "MONTHLY"
+    """ The recurrence of the templates: DAILY, WEEKLY, MONTHLY or YEARLY. """
+
+    events: int = 24
+    """ The number of `rate` events. """
+
+    sprays: int = 3
+    """ The number of `metadata_spray` sprays. """
+
+    start: datetime.date = datetime.date(2020, 1, 1)
+    """ The date of the first entry. """
+
+    days: int = 3 * 365
+    """ The number of days the transactions are spread over. """
+
+    seed: int = 0
+    """ The seed of the random number generator. """
+
+
+def generate(spec: LedgerSpec) -> Tuple[List[data.Directive], str]:
+    """Return the sorted entries of the ledger described by `spec`, and a spray config."""
+    rng = random.Random(spec.seed)
+    lineno = iter(range(1, 1 << 62))
+    meta = lambda **kwargs: data.new_metadata("<synthetic>", next(lineno), kwargs or None)
+
+    accounts = _account_names(spec.accounts)
+    assets = [name for name in accounts if name.startswith("Assets:")]
+    expenses = [name for name in accounts if name.startswith("Expenses:")]
+    loans = [name for name in accounts if name.startswith("Liabilities:")]
+    fixed = ["Equity:Opening-Balances", "Income:Salary", "Expenses:Interest"]
+
+    entries = [data.Open(meta(), spec.start, name, None, None) for name in fixed + accounts]
+
+    def date():
+        return spec.start + datetime.timedelta(days=rng.randrange(spec.days))
+
+    def units(low, high):
+        return Amount(D(rng.randrange(low * 100, high * 100)) / 100, CURRENCY)
+
+    def posting(account, amount, **kwargs):
+        return data.Posting(account, amount, None, None, None, kwargs or None)
+
+    def transaction(date, flag, narration, postings, **kwargs):
+        return data.Transaction(
+            meta(**kwargs), date, flag, None, narration, frozenset(), frozenset(), postings
+        )
+
+    for index in range(spec.events):
+        rate = "{:.4f}".format(rng.uniform(0.01, 0.10))
+        # The first rate is known from the start, before any template needs it.
+        entries.append(
+            data.Event(meta(), spec.start if index == 0 else date(), "rate", rate)
+        )
+
+    for loan in loans:
+        amount = units(1000, 100000)
+        entries.append(
+            transaction(
+                spec.start,
+                "*",
+                "Loan drawdown",
+                [
+                    posting(loan, -amount),
+                    posting(rng.choice(assets), amount),
+                ],
+            )
+        )
+
+    repeat = f"[{spec.frequency} REPEAT {spec.occurrences} TIMES]"
+    for index in range(spec.forecast_templates):
+        amount = units(10, 500)
+        entries.append(
+            transaction(
+                date(),
+                "#",
+                f"Bill {index} {repeat}",
+                [
+                    posting(rng.choice(expenses), amount),
+                    posting(rng.choice(assets), -amount),
+                ],
+            )
+        )
+
+    zero = Amount(D(0), CURRENCY)
+    for index in range(spec.dynamic_templates):
+        # Spread the templates reading a balance evenly among the others.
+        reads_balance = math.ceil((index + 1) * spec.balance_share) > math.ceil(
+            index * spec.balance_share
+        )
+        if reads_balance and loans:
+            # Reads a balance: serialized with the rest of the ledger.
+            loan = rng.choice(loans)
+            entries.append(
+                transaction(
+                    date(),
+                    "%",
+                    f"Interest {index} {repeat}",
+                    [
+                        posting("Expenses:Interest", zero, expr="-interest"),
+                        posting(loan, zero, expr="interest"),
+                    ],
+                    bal_acc_loan=loan,
+                    event_rate="rate",
+                    expr_interest="R(div(mul(gcu(loan,'USD'),D(rate)),D(12)),2)",
+                )
+            )
+        else:
+            # Reads only events: evaluated in a batch.
+            account = rng.choice(assets)
+            entries.append(
+                transaction(
+                    date(),
+                    "%",
+                    f"Salary {index} {repeat}",
+                    [
+                        posting("Income:Salary", zero, expr="-pay"),
+                        posting(account, zero, expr="pay"),
+                    ],
+                    event_rate="rate",
+                    expr_pay="A(D(rate)*D(50000),'USD')",
+                )
+            )
+
+    while len(entries) < spec.entries:
+        amount = units(1, 200)
+        entries.append(
+            transaction(
+                date(),
+                "*",
+                "Purchase",
+                [
+                    posting(rng.choice(expenses), amount),
+                    posting(rng.choice(assets), -amount),
+                ],
+            )
+        )
+
+    entries.sort(key=data.entry_sortkey)
+    return entries, spray_config(spec)
+
+
+def _account_names(count: int) -> List[str]:
+    """Account names spread across a few banks, expense groups and loans."""
+    names = []
+    for index in range(count):
+        kind = index % 10
+        if kind < 4:
+            names.append(f"Assets:Bank:Bank{index % 7}:Account{index}")
+        elif kind < 9:
+            names.append(f"Expenses:Group{index % 5}:Category{index}")
+        else:
+            names.append(f"Liabilities:Loan:Loan{index}")
+    return names
+
+
+def spray_config(spec: LedgerSpec) -> str:
+    """A `metadata_spray` config for the ledger of `spec`, with `spec.sprays` sprays."""
+    patterns = [
+        (
+            r"Assets:Bank:(?P<bank>[^:]+):(?P<account>[^:]+)",
+            {"portfolio": "cash", "institution": "{bank}"},
+        ),
+        (
+            r"Expenses:(?P<group>[^:]+):(?P<category>[^:]+)",
+            {"budget": "{group}"},
+        ),
+        (
+            r"Liabilities:Loan:(?P<loan>[^:]+)",
+            {"portfolio": "debt"},
+        ),
+    ]
+    sprays = [
+        {
+            "spray_type": "account_open",
+            "replace_type": "overwrite",
+            "pattern": pattern,
+            "metadata_dict": metadata_dict,
+        }
+        for pattern, metadata_dict in (
+            patterns[index % len(patterns)] for index in range(spec.sprays)
+        )
+    ]
+    maps = {
+        "bank": {"primary": ["Bank0"], "secondary": ["Bank[1-3]"], "other": ["Bank.*"]},
+        "group": {"essentials": ["Group0", "Group1"], "discretionary": ["Group.*"]},
+    }
+    return repr({"sprays": sprays, "maps": maps})
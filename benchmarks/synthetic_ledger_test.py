@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from beancount.core import data
+from beancount.parser import options
+
+import run
+import synthetic_ledger
+
+
+class TestSyntheticLedger(unittest.TestCase):
+    def test_deterministic(self):
+        spec = synthetic_ledger.LedgerSpec(entries=300, seed=7)
+        entries, spray = synthetic_ledger.generate(spec)
+        again, again_spray = synthetic_ledger.generate(spec)
+        self.assertEqual(entries, again)
+        self.assertEqual(spray, again_spray)
+        self.assertEqual(300, len(entries))
+        self.assertEqual(entries, sorted(entries, key=data.entry_sortkey))
+        self.assertNotEqual(entries, synthetic_ledger.generate(spec._replace(seed=8))[0])
+
+    def test_plugins_run_cleanly(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cwd = os.getcwd()
+            # Whatever the plugins write (checkpoints, logs, profiles) goes in tmpdir.
+            os.chdir(tmpdir)
+            try:
+                with unittest.mock.patch.object(
+                    run, "CHECKPOINT", os.path.join(tmpdir, "forecast.ckpt")
+                ):
+                    for shape in run.SHAPES:
+                        entries, spray = synthetic_ledger.generate(
+                            run.spec_for(1000, shape)
+                        )
+                        for name, plugin in run.PLUGINS.items():
+                            with self.subTest(shape=shape, plugin=name):
+                                output, errors = plugin(
+                                    list(entries), options.OPTIONS_DEFAULTS.copy(), spray
+                                )
+                                self.assertFalse(errors)
+                                # Every template is replaced by its occurrences, if any.
+                                self.assertGreaterEqual(len(output), len(entries) - 20)
+            finally:
+                os.chdir(cwd)
+
+    def test_shapes(self):
+        def templates(spec):
+            entries, _ = synthetic_ledger.generate(spec)
+            dynamic = [
+                entry
+                for entry in entries
+                if isinstance(entry, data.Transaction) and entry.flag == "%"
+            ]
+            return len(dynamic), sum(1 for entry in dynamic if "bal_acc_loan" in entry.meta)
+
+        self.assertEqual((5, 3), templates(run.spec_for(1000)))
+        self.assertEqual((5, 5), templates(run.spec_for(1000, "balances")))
+        self.assertEqual((5, 0), templates(run.spec_for(1000, "events")))
+        self.assertEqual((10, 5), templates(run.spec_for(1000, "sparse")))
+        self.assertEqual("WEEKLY", run.spec_for(1000, "dense").frequency)
+
+    def test_regressions(self):
+        baseline = {"forecast_plugin": {"1000": 1.0, "10000": 10.0}}
+        results = {"forecast_plugin": {"1000": 1.2, "10000": 13.0, "100000": 50.0}}
+        self.assertEqual(
+            [("forecast_plugin", "10000", 13.0, 10.0)],
+            run.regressions(results, baseline, 0.25),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
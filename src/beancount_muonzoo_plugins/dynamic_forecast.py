@@ -11,36 +11,53 @@ The plugin effectively computes a merge sort of pending recurring transactions a
 
 """
 
-import ast
+import concurrent.futures
+import contextlib
 import datetime
-import re
+import functools
+import heapq
 import inspect
+import itertools
+import os
+import pickle
+import re
+import sys
 
 from pprint import pformat
 
+from beancount_muonzoo_plugins.util import checkpoint, expression, loan
+from beancount_muonzoo_plugins.util.events import EventTimeline
+from beancount_muonzoo_plugins.util.occurrence import Template
 from beancount_muonzoo_plugins.util.parse_config_string import parse as parse_config_string
+from beancount_muonzoo_plugins.util.profiling import NULL_PROFILE, Profile
+from beancount_muonzoo_plugins.util.recurrence import (
+    PERIODS_PER_YEAR,
+    Window,
+    forecast_window,
+    has_recurrence,
+    parse_recurrence,
+)
 
-from collections import namedtuple, deque
-from dateutil import rrule
+from collections import namedtuple
 from dateutil.parser import parse as dateutil_parse
 
-from itertools import pairwise
-
-from typing import NamedTuple, List, Set, Tuple
+from typing import Any, Dict, FrozenSet, NamedTuple, List, Optional, Set, Tuple
 
-from beancount.core import realization
 from beancount.core import getters
-from beancount.core import account, amount
+from beancount.core import account, amount, compare, data
 from beancount.parser.printer import format_entry
 
 from beancount.core.data import (
     Entries,
     Transaction,
     Event,
+    Open,
+    Close,
 )
 
 from beancount.core.amount import Amount
-from beancount.core.number import D
+from beancount.core.inventory import Inventory
+from beancount.core.number import D, Decimal
 
 import logging
 
@@ -51,6 +68,23 @@ __plugins__ = (__plugin_name__,)
 __bal_acc = "bal_acc_"
 __event = "event_"
 __expr = "expr_"
+__until_expr = "until_expr"
+__loan = "loan"
+__loan_principal = "loan_principal"
+__loan_rate = "loan_rate"
+__loan_payment = "loan_payment"
+
+# Bump when the pickled ForecastState changes shape, to invalidate old checkpoint files.
+CHECKPOINT_VERSION = 14
+
+CHECKPOINT_PERIODS = {
+    "MONTHLY": lambda date: (date.year, date.month),
+    "YEARLY": lambda date: date.year,
+}
+
+# Upper bound on the number of distinct (expression, location, layout) triples whose
+# compiled functions are kept between templates.
+EXPR_CACHE_SIZE = 1024
 
 logger = logging.getLogger(__name__)
 logger.propagate = False
@@ -59,13 +93,12 @@ logger.info("TESTING")
 logger.terminator = "\n\n"
 
 LoanModelError = namedtuple("LoanModelError", "source message entry")
+RecurrenceError = namedtuple("RecurrenceError", "source message entry")
 
 pf = lambda obj: pformat(
     obj, width=72, compact=False, indent=2, sort_dicts=False, underscore_numbers=True
 )
 
-# deque[Transactions]
-
 
 class Config(NamedTuple):
     """Capture the config dict passed to the plugin."""
@@ -79,43 +112,477 @@ class Config(NamedTuple):
     debug_sets: Set[str] = set()
     """ A list of comma separated 'flags' that enable specific logging statements. """
 
+    profile: bool = False
+    """ Write per-phase timings and counters to `dynamic_forecast.profile.json`. """
+
+    checkpoint: Optional[str] = None
+    """ A file in which to keep snapshots of the merge state, to resume from on reload. """
+
+    checkpoint_period: str = "MONTHLY"
+    """ Snapshot the state whenever the entry date crosses into a new month (or `YEARLY`). """
+
+    checkpoint_count: int = 3
+    """ The number of snapshots kept, at the last of those boundaries. """
+
+    scenarios: Dict[str, Dict[str, Any]] = {}
+    """ Named sets of event values, each overriding the ledger's events of those types. """
+
+    workers: Optional[int] = None
+    """ The number of processes evaluating scenarios (default: one per CPU). """
+
+    output: str = "list"
+    """ `list` returns a new merged list; `inplace` splices the occurrences into the input list. """
+
+    partition: bool = False
+    """ Merge independent groups of templates on `workers` processes. """
+
+    context_meta: Any = "all"
+    """ The context variables copied to each occurrence's metadata: `all`, `none` or a list of names. """
+
+    context_format: str = "str"
+    """ `str` keeps context values as (interned) strings; `typed` keeps amounts and numbers as they are. """
+
+    horizon: Any = None
+    """ The end of recurrences without REPEAT or UNTIL: a date, or `N DAYS|WEEKS|MONTHS|YEARS` after the last ledger date. """
+
+    cutoff: Optional[int] = None
+    """ Drop the occurrences more than this many days before the last ledger date. """
+
+
+class TrackedBalances(NamedTuple):
+    """The running balances of the accounts referenced by `bal_acc_` metadata."""
+
+    subtree: Dict[str, Inventory]
+    """ The aggregate balance of each `bal_acc_` account, children included. """
+
+    index: Dict[str, Tuple[Inventory, ...]]
+    """ The `subtree` balances each tracked account (a `bal_acc_` account or a child) rolls up into. """
+
+
+class ContextSpec(NamedTuple):
+    """Which context variables an occurrence keeps in its metadata, and in what form."""
 
-def clean_ctx(ctx_dict):
+    names: Optional[FrozenSet[str]] = None
+    """ The variables kept, or None for all of them. """
+
+    typed: bool = False
+    """ Keep typed values (inventories as snapshots) rather than strings. """
+
+    def keeps(self, name):
+        return self.names is None or name in self.names
+
+
+def context_spec(C) -> ContextSpec:
+    """The `ContextSpec` of the `context_meta` and `context_format` options."""
+    names = C.context_meta
+    if names == "all":
+        names = None
+    elif names == "none":
+        names = frozenset()
+    elif isinstance(names, str):
+        names = frozenset(name.strip() for name in names.split(","))
+    else:
+        names = frozenset(names)
+    return ContextSpec(names, C.context_format == "typed")
+
+
+def snapshot(value):
+    """
+    A compact value for metadata that the printer can write out.
+
+    An inventory of one plain position becomes its `Amount`; numbers become
+    `Decimal`s; any other value besides amounts, dates and booleans becomes
+    a string.
+
+    """
+    if isinstance(value, Inventory):
+        if len(value) == 1:
+            position = next(iter(value))
+            if position.cost is None:
+                return position.units
+        # The running balances keep changing: copy them.
+        return Inventory(list(value))
+    if isinstance(value, (bool, Decimal, Amount, datetime.date)) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return D(str(value))
+    return str(value)
+
+
+def clean_ctx(ctx_dict, typed=False):
+    """The context variables `ctx_dict` as metadata values."""
     new_ctx = dict()
     for k, v in ctx_dict.items():
-        # logger.debug(f'{k=} : {type(ctx[k])=}')
         if not (inspect.isfunction(v) or k.startswith("__")):
-            new_ctx[k] = v if isinstance(v, str) else str(v)
+            if typed:
+                new_ctx[k] = snapshot(v)
+            else:
+                # Occurrences often share values; intern them so they share the strings.
+                new_ctx[k] = sys.intern(v if isinstance(v, str) else str(v))
     return new_ctx
 
 
-def ordered_insert(iterable, item, relop):
+class OccurrenceQueue:
+    """
+    A priority queue merging lazy streams of pending dynamic transactions by date.
+
+    Each pushed stream must yield its entries in date order; only the head of
+    each stream is held in the queue, so memory scales with the number of
+    streams rather than the number of occurrences. Occurrences sharing a date
+    are popped from the most-recently-pushed stream first, which is the order
+    the previous linear insertion into a deque produced.
+
+    A stream is only advanced past a popped entry on the next queue operation,
+    so `stop()` can still end it without reading another occurrence.
+
+    Open-ended streams (recurrences without REPEAT or UNTIL) run on past the
+    `horizon`; their heads beyond it are parked rather than queued, so moving
+    the horizon later with `rewindow()` picks them up again.
+
+    - `check_order` : assert that popped dates never decrease (debugging aid).
+
+    """
+
+    def __init__(self, check_order: bool = False, horizon=None):
+        self._heap = []
+        self._parked = []
+        self._seq = 0
+        self._check_order = check_order
+        self._last_date = None
+        self._popped = None
+        self.horizon = horizon
+
+    def __len__(self):
+        self._advance()
+        return len(self._heap)
+
+    def _queue(self, seq, entry, occurrences):
+        item = (entry.date, seq, entry, occurrences)
+        if (
+            self.horizon is not None
+            and entry.date > self.horizon
+            and occurrences.open_ended
+        ):
+            self._parked.append(item)
+        else:
+            heapq.heappush(self._heap, item)
+
+    def _advance(self):
+        if self._popped is not None:
+            seq, occurrences = self._popped
+            self._popped = None
+            entry = next(occurrences, None)
+            if entry is not None:
+                self._queue(seq, entry, occurrences)
+
+    def push(self, occurrences):
+        # The negated sequence number breaks ties so later pushes pop first and
+        # the entries themselves are never compared.
+        self._advance()
+        self._seq += 1
+        entry = next(occurrences, None)
+        if entry is not None:
+            self._queue(-self._seq, entry, occurrences)
+
+    def _requeue(self, restart):
+        """Queue the head `restart(date, entry, occurrences)` returns for each stream instead, dropping those it returns None for."""
+        self._advance()
+        items = self._heap + self._parked
+        self._heap = []
+        self._parked = []
+        for date, seq, entry, occurrences in items:
+            entry = restart(date, entry, occurrences)
+            if entry is not None:
+                self._queue(seq, entry, occurrences)
+
+    def reevaluate(self):
+        """
+        Evaluate the queued head of each stream of evaluated occurrences again.
+
+        Call this when the events those were evaluated against have changed:
+        after overriding them, or resuming from a checkpoint taken before
+        they were edited.
+
+        """
+        self._requeue(
+            lambda date, entry, occurrences: (
+                occurrences.restart(date) if occurrences.evaluated else entry
+            )
+        )
+
+    def rewindow(self, window, restart=False):
+        """
+        Generate the occurrences in `window` instead, restarting every stream from its start if `restart`.
+
+        Only restart streams none of whose occurrences have been popped.
+
+        """
+        self.horizon = window.end
+
+        def rewound(date, entry, occurrences):
+            occurrences.window = window
+            return occurrences.restart(window.start) if restart else entry
+
+        self._requeue(rewound)
+
+    def peek_date(self):
+        self._advance()
+        return self._heap[0][0]
+
+    def pop(self):
+        self._advance()
+        date, seq, entry, occurrences = heapq.heappop(self._heap)
+        self._popped = (seq, occurrences)
+        if self._check_order:
+            assert self._last_date is None or self._last_date <= date, (
+                f"pending queue out of order: {date} after {self._last_date}"
+            )
+            self._last_date = date
+        return entry
+
+    @property
+    def current(self):
+        """The stream of the most recently popped entry, until the next queue operation."""
+        return None if self._popped is None else self._popped[1]
+
+    def stop(self):
+        """Drop the stream of the most recently popped entry."""
+        self._popped = None
+
+
+class Occurrences:
+    """
+    Lazily yield an `Occurrence` of `entry` for each date of the recurrence `rule` in `window`.
+
+    Unlike a generator this can be pickled; it resumes after the last date
+    it yielded.
+
+    """
+
+    # The entries yielded still have to be evaluated.
+    evaluated = False
+
+    def __init__(
+        self, entry, narration, rule, plan=None, *, context=ContextSpec(), window=Window()
+    ):
+        self.template = Template(entry, narration)
+        self.rule = rule
+        self.context = context
+        self.window = window
+        self._last = None
+        self._dates = window.dates(rule)
+        self._plan = plan
+
+    @property
+    def plan(self):
+        """The compiled template, compiled on first use."""
+        if self._plan is None:
+            self._plan = compile_template(self.template.entry, self.context)
+        return self._plan
+
+    @property
+    def open_ended(self):
+        """Whether the recurrence runs on to the horizon, for want of a REPEAT or UNTIL."""
+        return parse_recurrence(self.template.entry.narration).open_ended
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._last = next(self._dates)
+        return self.template.occurrence(self._last)
+
+    def restart(self, date):
+        """Carry on from the occurrence on `date` (or the first after it), returning it (None if there is none)."""
+        self._dates = self.rule.after(date, inc=True)
+        return next(self, None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_dates"]
+        # Compiled functions don't pickle; the plan is compiled again on demand.
+        state["_plan"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dates = (
+            self.window.dates(self.rule)
+            if self._last is None
+            else self.rule.after(self._last)
+        )
+
+
+class EvaluatedOccurrences(Occurrences):
+    """
+    The occurrences of a template that reads no balances, evaluated as a batch.
+
+    Such a template depends only on the event timeline, so its occurrences
+    need not wait for the merge to reach their dates, and runs of them share
+    evaluations. Those up to the end of the window are evaluated in one go
+    before any is pulled (any after it, as they are pulled); they still go
+    through the queue to update the tracked balances in date order.
+
+    """
+
+    evaluated = True
+
+    def __init__(
+        self,
+        entry,
+        narration,
+        rule,
+        timeline,
+        plan=None,
+        *,
+        context=ContextSpec(),
+        window=Window(),
+    ):
+        super().__init__(entry, narration, rule, plan, context=context, window=window)
+        self.timeline = timeline
+        self._evaluated = None
+
+    def evaluate(self, profile=NULL_PROFILE):
+        """Evaluate the remaining occurrences against the timeline, up to the end of the window."""
+        occurrences = ((date, self.template.occurrence(date)) for date in self._dates)
+        evaluated = evaluate_batch(self.plan, occurrences, self.timeline, profile)
+        batch = []
+        for pair in evaluated:
+            batch.append(pair)
+            if pair[0] >= self.window.end:
+                break
+        self._evaluated = itertools.chain(batch, evaluated)
+
+    def __next__(self):
+        if self._evaluated is None:
+            self.evaluate()
+        self._last, occurrence = next(self._evaluated)
+        return occurrence
+
+    def restart(self, date):
+        """Evaluate the occurrences from `date` on again, returning the first (None if there is none)."""
+        self._dates = self.rule.after(date, inc=True)
+        self.evaluate()
+        return next(self, None)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # The occurrences after the last one yielded are evaluated again after
+        # unpickling, against the (possibly overridden) timeline; the one
+        # waiting in the queue is only by `OccurrenceQueue.reevaluate()`.
+        state["_evaluated"] = None
+        return state
+
+
+class LoanOccurrences(EvaluatedOccurrences):
+    """
+    The occurrences of a loan template: its amortization schedule, computed in one go.
+
+    The schedule is computed from the loan's terms and the rates on the
+    occurrence dates, without evaluating any expressions. It always starts
+    from the first date of `rule`; the window only drops installments.
+
+    """
+
+    def __init__(
+        self,
+        entry,
+        narration,
+        rule,
+        timeline,
+        terms,
+        *,
+        context=ContextSpec(),
+        window=Window(),
+    ):
+        super().__init__(entry, narration, rule, timeline, context=context, window=window)
+        self.terms = terms
+
+    def evaluate(self, profile=NULL_PROFILE, start=None):
+        """Compute the schedule, from the first installment after the last one yielded (or from `start`)."""
+        self._evaluated = loan_schedule(
+            self.template,
+            self.rule,
+            self.timeline,
+            self.terms,
+            context=self.context,
+            start=self.window.start if start is None else start,
+            after=None if start is not None else self._last,
+        )
+
+    def restart(self, date):
+        """Compute the schedule from the installment on `date` (or the first after it) on again, returning it."""
+        self.evaluate(start=date)
+        return next(self, None)
+
+
+class ForecastState:
     """
-    For all `x` in `iterable`, traverse and insert `item` at the first location `relop` is false.
+    The running state of the merge of pending occurrences into the entries.
 
-    - `x` : each element from `iterable` in turn.
-    - `iterable` : a mutable iterable in which to insert `item`
-    - `relop` a binary function that compares two elements of type of `item` and `x`.
+    This is everything needed to carry on the merge from `entries[index]`;
+    it pickles, so it can be checkpointed.
 
     """
-    # relop(item, x) changes to false
-    i = 0
-    while i < len(iterable):
-        if not relop(iterable[i], item):
-            break
-        i += 1
-    iterable.insert(i, item)
+
+    def __init__(self, balances, pending, timeline, window=Window()):
+        self.balances = balances
+        self.pending = pending
+        self.timeline = timeline
+        self.window = window
+        self.index = 0
+
+    def override_events(self, overrides):
+        """Use `overrides` for the values of those event types."""
+        self.timeline.overrides = overrides
+        self.pending.reevaluate()
+
+    def catch_up(self, entries, sources):
+        """
+        Carry on over `entries` from `index`, as they may have changed after it since this state was saved.
+
+        The accounts of the entries from there on under the `sources` are
+        tracked too, and their events indexed again.
+
+        """
+        track_accounts(self.balances, sources, getters.get_accounts(entries[self.index :]))
+        self.timeline.index(entries, self.index)
+        self.pending.reevaluate()
+
+    def rewindow(self, window):
+        """
+        Generate occurrences in `window` from here on.
+
+        A later start restarts the pending streams from it, so it only applies
+        while no occurrence before the current start has been merged.
+
+        """
+        restart = window.start != self.window.start
+        self.window = window
+        self.pending.rewindow(window, restart)
 
 
 def location_string(meta):
     return "{f:s}:{l:d}".format(f=meta.get("filename", "<file>"), l=meta.get("lineno"))
 
 
-def compute_amount(expr, context, meta):
-    """Evaluate expr inside context"""
-    tree = ast.parse(expr.strip(), mode="eval")
-    co = compile(tree, location_string(meta), mode="eval")
-    return eval(co, context)
+# The variables every expression sees, ahead of the template's own: the date of
+# the occurrence and `event_at(type, date)`, the value of an event on any date.
+RESERVED_NAMES = ("date", "event_at")
+
+
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def compile_expression(expr, location, names):
+    """
+    Compile `expr` over the context layout `names`, reporting errors against `location`.
+
+    The result is cached by expression text, location and layout; use
+    `compile_expression.cache_info()` to inspect the hit/miss counters.
+
+    """
+    return expression.compile_expression(
+        expr, names, OPERATIONS, location, callables=("event_at",)
+    )
 
 
 def get_currency_units(inventory, currency):
@@ -123,8 +590,29 @@ def get_currency_units(inventory, currency):
     return inventory.get_currency_units(currency)
 
 
+@functools.lru_cache(maxsize=None)
+def quantum(places):
+    return D(10) ** -places
+
+
 def round_to_places(amount, places):
-    return Amount(amount.number.quantize(D(10) ** -places), amount.currency)
+    return Amount(amount.number.quantize(quantum(places)), amount.currency)
+
+
+# The functions expressions may call.
+OPERATIONS = dict(
+    add=amount.add,
+    sub=amount.sub,
+    mul=amount.mul,
+    div=amount.div,
+    gcu=get_currency_units,
+    R=round_to_places,
+    D=D,
+    A=amount.Amount,
+    abs=abs,
+    min=min,
+    max=max,
+)
 
 
 def is_metakey_expr(key):
@@ -136,116 +624,924 @@ def expr_varname(key):
     return key[len(__expr) :] if len(key) > len(__expr) else "expr"
 
 
-def process_computed_entry(real_root, event_map, dynamic_transaction):
-    logger.info(f"{dynamic_transaction.date=} {dynamic_transaction.narration=}")
+class TemplatePlan(NamedTuple):
+    """
+    The compiled form of a dynamic transaction, shared by all its occurrences.
 
-    # build context for evaluation - supply add/sub/mul/div/D/R as functions
+    Every variable has a fixed slot in a context list: the reserved names
+    first, then the `bal_acc_` and `event_` inputs, then the `expr_*` results
+    in metadata order.
 
-    op_ctx = dict(
-        add=amount.add,
-        sub=amount.sub,
-        mul=amount.mul,
-        div=amount.div,
-        gcu=get_currency_units,
-        R=round_to_places,
-        D=D,
-        A=amount.Amount,
-    )
+    """
 
-    calc_ctx = dict()
+    names: Tuple[str, ...]
+    """ The variable name of each slot. """
 
-    ltm = dynamic_transaction.meta
-    # new_meta will get all metadata EXCEPT items that are used to evaluate the value
-    # all bal_acc_ and event_ fields along with expr will be suppressed.
+    balances: Tuple[Tuple[int, str], ...]
+    """ The slot and account of each `bal_acc_` input. """
 
-    new_meta = dict()
+    events: Tuple[Tuple[int, str], ...]
+    """ The slot and event type of each `event_` input. """
 
-    for meta_key in ltm:
-        if meta_key.startswith(__bal_acc):
-            varname = meta_key[len(__bal_acc) :]
-            acct = ltm[meta_key]
-            real_account = realization.get(real_root, acct)
+    exprs: Tuple[Tuple[str, Any], ...]
+    """ The metadata key and compiled function of each `expr_*`, filling the remaining slots. """
+
+    until: Any
+    """ The compiled `until_expr`, or None. """
+
+    postings: Tuple[Any, ...]
+    """ The compiled `expr` of each posting, or None for postings without one. """
 
-            assert real_account is not None, "Missing {}".format(acct)
+    meta: Dict[str, Any]
+    """ The metadata copied to every occurrence. """
+
+    context: Tuple[Tuple[int, str], ...]
+    """ The slot and name of each variable copied to the occurrences' metadata. """
+
+    typed: bool
+    """ Whether those variables are copied as typed values rather than strings. """
+
+    dated: bool
+    """ Whether any expression reads `date` or calls `event_at`, so occurrences differ by date alone. """
+
+
+def compile_template(dynamic_transaction, context=ContextSpec()) -> TemplatePlan:
+    """
+    Compile the expressions of `dynamic_transaction` once, for all its occurrences.
 
-            subtree_balance = realization.compute_balance(real_account, leaf_only=False)
-            logger.debug(f"{subtree_balance=}")
+    `context` selects the variables copied to the occurrences' metadata.
 
-            assert varname not in calc_ctx
-            calc_ctx[varname] = subtree_balance
+    """
+    ltm = dynamic_transaction.meta
+    location = location_string(ltm)
+
+    names = list(RESERVED_NAMES)
+    balances = []
+    events = []
+    # meta will get all metadata EXCEPT items that are used to evaluate the value
+    # all bal_acc_ and event_ fields along with expr and until_expr will be suppressed.
+    meta = dict()
+    for meta_key, value in ltm.items():
+        if meta_key.startswith(__bal_acc):
+            balances.append((len(names), value))
+            names.append(meta_key[len(__bal_acc) :])
         elif meta_key.startswith(__event):
-            varname = meta_key[len(__event) :]
-            event_name = ltm[meta_key]
-            assert event_name in event_map
-            event_value = event_map[event_name]
-            assert varname not in calc_ctx
-            calc_ctx[varname] = event_value
-        elif not is_metakey_expr(meta_key):
+            events.append((len(names), value))
+            names.append(meta_key[len(__event) :])
+        elif not (is_metakey_expr(meta_key) or meta_key == __until_expr):
             # copy all other metadata
-            new_meta[meta_key] = ltm[meta_key]
+            meta[meta_key] = value
+
+    exprs = []
+    for meta_key in [_ for _ in ltm if is_metakey_expr(_)]:
+        # Each expression sees the inputs and the expressions before it.
+        function = compile_expression(ltm[meta_key], location, tuple(names))
+        exprs.append((meta_key, function))
+        names.append(expr_varname(meta_key))
+    names = tuple(names)
+    assert len(set(names)) == len(names), f"{location}: duplicate variable in {names}"
+
+    until_expr = ltm.get(__until_expr, None)
+    until = None
+    if until_expr is not None:
+        until = compile_expression(until_expr, location, names)
+
+    posting_exprs = [
+        None if posting.meta is None else posting.meta.get(__expr[:-1], None)
+        for posting in dynamic_transaction.postings
+    ]
+    postings = tuple(
+        None if expr is None else compile_expression(expr, location, names)
+        for expr in posting_exprs
+    )
+
+    sources = [ltm[key] for key, _ in exprs] + [until_expr] + posting_exprs
+    dated = any(
+        not expression.referenced_names(source).isdisjoint(RESERVED_NAMES)
+        for source in sources
+        if source is not None
+    )
+
+    kept = tuple(
+        (slot, name)
+        for slot, name in enumerate(names)
+        if slot >= len(RESERVED_NAMES) and context.keeps(name)
+    )
+
+    return TemplatePlan(
+        names,
+        tuple(balances),
+        tuple(events),
+        tuple(exprs),
+        until,
+        postings,
+        meta,
+        kept,
+        context.typed,
+        dated,
+    )
+
+
+def process_computed_entry(balances, timeline, occurrence, profile=NULL_PROFILE, plan=None):
+    """
+    Evaluate the expressions of one `Occurrence` of a dynamic transaction.
+
+    Events are looked up in `timeline` on the date of the occurrence. `plan`
+    is the compiled template of the transaction; it is compiled here when
+    not given. Returns the materialized transaction with computed postings,
+    or None when its `until_expr` is true and the recurrence should stop.
 
-    for key in [_ for _ in ltm.keys() if is_metakey_expr(_)]:
-        result = compute_amount(ltm[key], op_ctx | calc_ctx, ltm)
-        varname = expr_varname(key)
-        assert varname not in calc_ctx
-        calc_ctx[varname] = result
-        logger.debug(f"expression: {varname} ({key}) = {result}")
+    """
+    dynamic_transaction = occurrence.template.entry
+    date = occurrence.date
+    logger.info(f"{date=} {occurrence.template.narration=}")
+    if plan is None:
+        plan = compile_template(dynamic_transaction)
+
+    context = [None] * len(plan.names)
+    context[0] = date
+    context[1] = timeline.value_at
+
+    for slot, acct in plan.balances:
+        # The running subtree balance is shared, not a copy: read it only.
+        subtree_balance = balances.subtree.get(acct)
+
+        assert subtree_balance is not None, "Missing {}".format(acct)
+        logger.debug(f"{subtree_balance=}")
+        profile.count("balance_lookups")
+        context[slot] = subtree_balance
+
+    for slot, event_name in plan.events:
+        event_value = timeline.value_at(event_name, date)
+        assert event_value is not None, f"No {event_name} event on or before {date}"
+        context[slot] = event_value
+
+    for slot, (key, function) in enumerate(plan.exprs, len(plan.names) - len(plan.exprs)):
+        with profile.phase("expressions"):
+            result = function(context)
+        profile.count("expressions")
+        context[slot] = result
+        logger.debug(f"expression: {plan.names[slot]} ({key}) = {result}")
+
+    if plan.until is not None:
+        with profile.phase("expressions"):
+            stop = plan.until(context)
+        profile.count("expressions")
+        if stop:
+            logger.info(
+                f"until_expr={dynamic_transaction.meta[__until_expr]!r} is true, stopping recurrence"
+            )
+            return None
 
     # find the posting(s) with 'expr' metadata and compute result
 
     postings = []
-    for posting in dynamic_transaction.postings:
-        expr = posting.meta.get(__expr[:-1], None)
-        if expr is not None:
-            logger.debug(f"{posting.account=} {expr=}")
-            result = compute_amount(expr, op_ctx | calc_ctx, ltm)
+    for posting, function in zip(dynamic_transaction.postings, plan.postings):
+        if function is not None:
+            with profile.phase("expressions"):
+                result = function(context)
+            profile.count("expressions")
             logger.debug(f"{posting.account=} {result=}")
             postings.append(posting._replace(units=result))
         else:
             logger.debug(f"no metadata {posting=}")
             postings.append(posting)
 
-    return dynamic_transaction._replace(
-        meta=new_meta | clean_ctx(calc_ctx), postings=postings
+    return occurrence.materialize(
+        meta=plan.meta
+        | clean_ctx({name: context[slot] for slot, name in plan.context}, plan.typed),
+        postings=postings,
     )
 
 
-def update_balances(real_root, entry):
-    for posting in entry.postings:
-        real_account = realization.get(real_root, posting.account)
+def evaluate_batch(plan, occurrences, timeline, profile=NULL_PROFILE):
+    """
+    Evaluate the `(date, Occurrence)` pairs of a template that reads no balances.
+
+    Each occurrence sees the event values on its date. Unless the template
+    reads the date itself, consecutive occurrences seeing the same values
+    share one evaluation. Lazily yields `(date, Occurrence)` pairs of the
+    evaluated transactions, up to the first whose `until_expr` is true; a
+    run of occurrences sharing an evaluation shares its `Template` too.
+
+    """
+    assert not plan.balances, "batch evaluation of a template reading balances"
+    event_types = [event_type for _, event_type in plan.events]
+    previous_inputs = previous = None
+    for date, occurrence in occurrences:
+        inputs = (
+            occurrence.date
+            if plan.dated
+            else tuple(
+                timeline.value_at(event_type, occurrence.date) for event_type in event_types
+            )
+        )
+        if inputs != previous_inputs or previous is None:
+            txn = process_computed_entry(None, timeline, occurrence, profile, plan=plan)
+            if txn is None:
+                return
+            previous_inputs, previous = inputs, Template(txn, txn.narration)
+        else:
+            profile.count("reused_evaluations")
+        yield date, previous.occurrence(occurrence.date)
+
+
+class LoanTerms(NamedTuple):
+    """The terms of a loan template, read from its `loan_*` metadata."""
+
+    principal: Amount
+    """ The amount owed before the first installment (`loan_principal`). """
+
+    rate: Any
+    """ The event type holding the annual rate, or a constant annual rate as a `Decimal` (`loan_rate`). """
+
+    payment: Optional[Decimal]
+    """ A fixed payment per period (`loan_payment`), or None for the annuity payment. """
+
+    periods_per_year: Decimal
+    """ The number of installments in a year, from the recurrence. """
+
+    roles: Tuple[Optional[Tuple[int, str]], ...]
+    """ The sign and `Installment` field posted by each posting, or None for postings without a `loan` role. """
+
+
+LOAN_ROLES = frozenset(loan.Installment._fields) - {"balance"}
+
+
+def is_loan_template(entry):
+    """True for a dynamic transaction describing a loan with `loan_principal`."""
+    return __loan_principal in entry.meta
+
 
-        # The account will have been created only if we're meant to track it.
-        if real_account is not None:
+def loan_terms(dynamic_transaction, recurrence) -> LoanTerms:
+    """Read the terms of the loan template `dynamic_transaction`, raising ValueError if invalid."""
+    ltm = dynamic_transaction.meta
+    location = location_string(ltm)
+
+    def as_amount(key):
+        value = ltm[key]
+        if isinstance(value, str):
+            value = amount.from_string(value)
+        if not isinstance(value, Amount):
+            raise ValueError(f"{location}: {key} must be an amount, not {value!r}")
+        return value
+
+    if recurrence.count is None and recurrence.until is None:
+        # The term would otherwise depend on the horizon, or on today's date.
+        raise ValueError(
+            f"{location}: a loan needs REPEAT n TIMES or UNTIL to set its term"
+        )
+    principal = as_amount(__loan_principal)
+    rate = ltm.get(__loan_rate)
+    if rate is None:
+        raise ValueError(f"{location}: a loan needs a {__loan_rate}")
+    if isinstance(rate, str):
+        with contextlib.suppress(ValueError):
+            # A quoted constant rate; anything else names the event holding it.
+            rate = D(rate)
+    payment = None
+    if __loan_payment in ltm:
+        payment = as_amount(__loan_payment)
+        if payment.currency != principal.currency:
+            raise ValueError(f"{location}: {__loan_payment} is not in {principal.currency}")
+        payment = payment.number
+
+    roles = []
+    for posting in dynamic_transaction.postings:
+        role = None if posting.meta is None else posting.meta.get(__loan)
+        if role is None:
+            roles.append(None)
+            continue
+        sign, field = (-1, role[1:]) if role.startswith("-") else (1, role)
+        if field not in LOAN_ROLES:
+            raise ValueError(
+                f"{location}: unknown {__loan} role {role!r} (one of {sorted(LOAN_ROLES)}, optionally negated)"
+            )
+        roles.append((sign, field))
+
+    periods_per_year = D(PERIODS_PER_YEAR[recurrence.frequency]) / recurrence.interval
+    return LoanTerms(principal, rate, payment, periods_per_year, tuple(roles))
+
+
+def recurrence_errors(entries) -> List[RecurrenceError]:
+    """Report the templates of `entries` whose recurrence spec is invalid; they generate nothing."""
+    errors = []
+    for entry in entries:
+        if is_template(entry):
+            try:
+                parse_recurrence(entry.narration)
+            except ValueError as exc:
+                errors.append(RecurrenceError(entry.meta, str(exc), entry))
+    return errors
+
+
+def loan_errors(entries) -> List[LoanModelError]:
+    """Report the loan templates of `entries` whose terms are invalid, or whose rate event is missing; they generate nothing."""
+    errors = []
+    templates = []
+    first_events = {}
+    for entry in entries:
+        if isinstance(entry, Event):
+            first_events.setdefault(entry.type, entry.date)
+        elif is_template(entry) and is_loan_template(entry):
+            templates.append(entry)
+    for entry in templates:
+        try:
+            recurrence = parse_recurrence(entry.narration)
+        except ValueError:
+            # Reported by recurrence_errors().
+            continue
+        try:
+            terms = loan_terms(entry, recurrence)
+        except ValueError as exc:
+            errors.append(LoanModelError(entry.meta, str(exc), entry))
+            continue
+        if isinstance(terms.rate, str):
+            first = next(iter(recurrence.dates(entry.date, datetime.date.max)), None)
+            since = first_events.get(terms.rate)
+            if first is not None and (since is None or since > first):
+                errors.append(
+                    LoanModelError(
+                        entry.meta,
+                        f"{location_string(entry.meta)}: no {terms.rate} event on or before {first}",
+                        entry,
+                    )
+                )
+    return errors
+
+
+def loan_schedule(
+    template,
+    rule,
+    timeline,
+    terms,
+    *,
+    context=ContextSpec(),
+    start=None,
+    after=None,
+):
+    """
+    Yield the `(date, Occurrence)` installments of a loan `Template` dated from `start` and after `after`.
+
+    The rate of each installment is the `loan_rate` event's value on its date;
+    the term is the number of dates of the recurrence `rule`. Postings with a
+    `loan` role of `interest`, `principal` or `payment` (or its negation, with
+    a leading `-`) get that amount of the installment; the others are copied.
+    The rates are read up front, but each installment's transaction is only
+    built when it is pulled.
+
+    """
+    dynamic_transaction = template.entry
+    dates = list(rule)
+    if isinstance(terms.rate, str):
+        rates = []
+        for date in dates:
+            value = timeline.value_at(terms.rate, date)
+            if value is None:
+                # Reported by loan_errors(); the loan generates nothing.
+                logger.warning(f"No {terms.rate} event on or before {date}")
+                return
+            rates.append(D(value))
+    else:
+        rates = [D(terms.rate)] * len(dates)
+
+    principal = terms.principal
+    places = max(0, -principal.number.as_tuple().exponent)
+    schedule = loan.amortize(
+        principal.number, rates, terms.periods_per_year, terms.payment, quantum(places)
+    )
+
+    meta = {
+        key: value
+        for key, value in dynamic_transaction.meta.items()
+        if not key.startswith(__loan + "_")
+    }
+    for date, installment in zip(dates, schedule):
+        if (start is not None and date < start) or (after is not None and date <= after):
+            continue
+        postings = [
+            posting
+            if role is None
+            else posting._replace(
+                units=Amount(role[0] * getattr(installment, role[1]), principal.currency)
+            )
+            for posting, role in zip(dynamic_transaction.postings, terms.roles)
+        ]
+        txn = dynamic_transaction._replace(
+            date=date,
+            narration=template.narration,
+            meta=meta
+            | clean_ctx(
+                {
+                    name: value
+                    for name, value in installment._asdict().items()
+                    if context.keeps(name)
+                },
+                context.typed,
+            ),
+            postings=postings,
+        )
+        yield date, Template(txn, txn.narration).occurrence(date)
+
+
+def update_balances(balances, entry):
+    index = balances.index
+    for posting in entry.postings:
+        # The account is indexed only if we're meant to track it.
+        subtree_balances = index.get(posting.account)
+        if subtree_balances is not None:
+            # Roll the posting up into every tracked ancestor's running total.
             # Note: Always allow negative lots for the purpose of balancing.
             # This error should show up somewhere else than here.
-            real_account.balance.add_position(posting)
+            for subtree_balance in subtree_balances:
+                subtree_balance.add_position(posting)
 
 
 def log_entry(prefix: str, entry, level: int = logging.DEBUG):
+    if not logger.isEnabledFor(level):
+        return
     for line in format_entry(entry).split("\n"):
         logger.log(level, "{prefix}: {line}".format(prefix=prefix, line=line))
 
 
-def dynamic_forecast(
-    entries: Entries, unused_options_map, config_string: str, *args
-) -> Tuple[Entries, List[NamedTuple]]:
+def is_template(entry):
+    """True for a dynamic transaction with a recurrence; it is replaced by its occurrences."""
+    return (
+        isinstance(entry, Transaction)
+        and entry.flag == __flag_char
+        and has_recurrence(entry.narration)
+    )
+
+
+def balance_sources(entries) -> Set[str]:
+    """The accounts the dynamic transactions of `entries` read the balance of (`bal_acc_` metadata)."""
+    return {
+        entry.meta.get(metakey)
+        for entry in entries
+        if isinstance(entry, Transaction) and entry.flag == __flag_char
+        for metakey in entry.meta
+        if metakey.startswith(__bal_acc)
+    }
+
+
+class TrackedAccounts(dict):
+    """Whether each account is one of the `sources` (`bal_acc_` accounts) or a child of one, resolved once."""
+
+    def __init__(self, sources):
+        super().__init__()
+        self.sources = sources
+
+    def __missing__(self, account_):
+        tracked = any(parent in self.sources for parent in account.parents(account_))
+        self[account_] = tracked
+        return tracked
+
+
+def track_accounts(balances, sources, accounts):
+    """Track the running balances of those of `accounts` that are `sources` or their children too."""
+    subtree, index = balances
+    for account_ in accounts:
+        if account_ in index:
+            continue
+        parents = [parent for parent in account.parents(account_) if parent in sources]
+        if not parents:
+            continue
+        for parent in parents:
+            subtree.setdefault(parent, Inventory())
+        # Resolve each tracked account once, so postings are looked up with a
+        # single probe and those to untracked accounts are skipped outright.
+        index[account_] = tuple(subtree[parent] for parent in parents)
+
+
+def new_state(entries, C, profile, window=Window(), sources=None) -> ForecastState:
+    """Set up the balance tracking for `entries`, with nothing merged yet, generating occurrences in `window`."""
+    # Figure out the set of accounts for which we need to compute a running
+    # inventory balance.
+    if sources is None:
+        with profile.phase("balance_sources"):
+            sources = balance_sources(entries)
+
+    logger.debug(f"{sources=}")
+
+    with profile.phase("get_accounts"):
+        accounts = getters.get_accounts(entries)
+
+    # Add all children accounts of an asserted account to be calculated as well,
+    # and only those (we're just being tight to make sure).
+    with profile.phase("tracked_accounts"):
+        balances = TrackedBalances({}, {})
+        track_accounts(balances, sources, accounts)
+
+    with profile.phase("events"):
+        timeline = EventTimeline(entries)
+
+    return ForecastState(
+        balances,
+        OccurrenceQueue(check_order="check_order" in C.debug_sets, horizon=window.end),
+        timeline,
+        window,
+    )
+
+
+class MergedOutput:
     """
-    An example dynamic posting computation plugin that allows postings to be
-    computed based on balances at a point in time.
+    The output of the merge, recorded as the occurrences generated and where they go.
 
-    Args:
-      entries: a list of entry instances - as per beancount
-      config_string: a dict as str with the required configuration:
-        debug : bool or comma-separated keys
-        debug_level : logging levels
-        debug_sets : a comma separated list of special debug sections
+    Entries passed through are only counted, so the merge holds on to no more
+    than the generated occurrences; the merged list is built (or spliced into
+    the input list) once the merge is done.
+
+    """
+
+    def __init__(self, length=0, generated=None):
+        self.length = length
+        self.generated = [] if generated is None else generated
+
+    def __len__(self):
+        return self.length
+
+    def pass_through(self, entry):
+        """Note that `entry` of the input comes next in the output."""
+        self.length += 1
+
+    def append(self, txn):
+        """Add the generated `txn` next in the output."""
+        self.generated.append((self.length, txn))
+        self.length += 1
+
+
+def process_pending(state, output, profile, before=None):
+    """Compute and emit the pending occurrences dated before `before` (all if None)."""
+    pending_entries = state.pending
+    while len(pending_entries) > 0 and (
+        before is None or pending_entries.peek_date() < before
+    ):
+        with profile.phase("queue"):
+            occurrence = pending_entries.pop()
+        profile.count("occurrences")
+        occurrences = pending_entries.current
+        if occurrences.evaluated:
+            txn = occurrence.materialize()
+        else:
+            # TODO: add generic exception handlers (from beancount_plugin_utils)
+            # and report LoanModelError(occurrence.template.entry.meta, "Computation Error:", ...)
+            txn = process_computed_entry(
+                state.balances,
+                state.timeline,
+                occurrence,
+                profile,
+                plan=occurrences.plan,
+            )
+        if txn is None:
+            pending_entries.stop()
+            continue
+        with profile.phase("update_balances"):
+            update_balances(state.balances, txn)
+        log_entry("processing queue item", txn)
+        output.append(txn)
+
+
+def merge_entries(entries, state, output, C, profile, *, checkpointer=None, stop=None):
+    """Merge the occurrences of the templates in `entries[state.index:stop]` with them into `output`."""
+
+    # iterate over all the entries, update our balance tracking, etc
+    # our plugin does 3 things:
+    # 1. looks up events (so we can reference them) in the timeline
+    # 2. tracks balances for accounts marked in any of the plugin transactions
+    # 3. computes the legs of the transactions by building a context dict base on the metadata
+    #
+    # - the first expense account type with 0 CUR as amount (CUR is returned from evaluation)
+    #   receives the expr amount, the first OTHER posting with value 0 CUR gets -val as the amount
+    #
+
+    stop = len(entries) if stop is None else stop
+    context = context_spec(C)
+    window = state.window
+    for index in range(state.index, stop):
+        entry = entries[index]
+        state.index = index
+        if checkpointer is not None:
+            checkpointer.visit(state, entries, output)
+
+        # pending entries has a copy of the plugin transaction with the appropriate date
+        # for each repetition wanted, until its `until_expr` (if any) is true.
+        # An occurrence is computed once every entry on or before its date is seen.
+        process_pending(state, output, profile, before=entry.date)
+
+        if isinstance(entry, Event):
+            # Occurrences read events from the timeline, indexed up front.
+            log_entry("EVENT", entry)
+            output.pass_through(entry)
+            continue
+        elif isinstance(entry, Transaction) and entry.flag == __flag_char:
+            # pull up the work from below
+            try:
+                recurrence = parse_recurrence(entry.narration)
+            except ValueError as exc:
+                # Reported by recurrence_errors(); the template generates nothing.
+                logger.warning(f"{exc}")
+                continue
+            if recurrence is None:
+                # no repetition?  just use the transaction and continue
+                output.pass_through(entry)
+                log_entry("no repetition detected -- regularizing", entry)
+                continue
+
+            logger.debug(f"{recurrence=}")
+            profile.count("templates")
+
+            # Push a lazy stream of the occurrences onto a queue that we merge
+            # sort from when the date increases or is seen.
+            with profile.phase("recurrence"):
+                # Open-ended recurrences run on; the queue holds them at the horizon.
+                rule = recurrence.dates(entry.date, datetime.date.max)
+            if is_loan_template(entry):
+                try:
+                    terms = loan_terms(entry, recurrence)
+                except ValueError as exc:
+                    # Reported by loan_errors(); the template generates nothing.
+                    logger.warning(f"{exc}")
+                    continue
+                profile.count("loan_templates")
+                occurrences = LoanOccurrences(
+                    entry,
+                    recurrence.narration,
+                    rule,
+                    state.timeline,
+                    terms,
+                    context=context,
+                    window=window,
+                )
+                occurrences.evaluate(profile)
+                with profile.phase("recurrence"):
+                    state.pending.push(occurrences)
+                continue
+
+            with profile.phase("recurrence"):
+                plan = compile_template(entry, context)
+            if plan.balances:
+                occurrences = Occurrences(
+                    entry, recurrence.narration, rule, plan, context=context, window=window
+                )
+            else:
+                # Nothing to wait for: evaluate the occurrences against the
+                # timeline up front, without the tracked balances.
+                profile.count("batch_templates")
+                occurrences = EvaluatedOccurrences(
+                    entry,
+                    recurrence.narration,
+                    rule,
+                    state.timeline,
+                    plan,
+                    context=context,
+                    window=window,
+                )
+                occurrences.evaluate(profile)
+            with profile.phase("recurrence"):
+                state.pending.push(occurrences)
+
+            logger.info(f"{len(state.pending)=}")
+        else:
+            if isinstance(entry, Transaction):
+                with profile.phase("update_balances"):
+                    update_balances(state.balances, entry)
+            if "passthrough" in C.debug_sets:
+                log_entry("passthrough", entry)
+            output.pass_through(entry)
+        logger.debug(f"{len(state.pending)=}")
+
+    state.index = stop
 
-    Returns:
-      A tuple of entries and errors.
 
+def iter_merged(entries, generated):
     """
+    Yield the merged output without evaluating anything.
 
-    # get config items to add to each loan metadata
+    These are `entries`, less the templates, with each `(position, txn)` of
+    `generated` placed at that position. Nothing but the generator's own
+    state is held, so the result can be streamed.
+
+    """
+    generated = iter(generated)
+    position, txn = next(generated, (None, None))
+    length = 0
+    for entry in itertools.chain(entries, [None]):
+        while position == length:
+            yield txn
+            length += 1
+            position, txn = next(generated, (None, None))
+        if entry is not None and not is_template(entry):
+            yield entry
+            length += 1
+
+
+def splice_generated(entries, generated):
+    """Return a new list of the merged output, as `iter_merged()` yields it."""
+    return list(iter_merged(entries, generated))
+
+
+def splice_in_place(entries, generated):
+    """
+    Turn `entries` itself into the merged output, as `iter_merged()` yields it.
+
+    Templates are compacted out in a forward pass, then the list is extended
+    and a backward pass moves each kept entry to its final position, filling
+    the gaps with the `generated` occurrences. The only extra memory is for
+    the occurrences themselves.
+
+    """
+    kept = 0
+    for entry in entries:
+        if not is_template(entry):
+            entries[kept] = entry
+            kept += 1
+    del entries[kept:]
+
+    entries.extend(itertools.repeat(None, len(generated)))
+    read = kept - 1
+    write = len(entries) - 1
+    for position, txn in reversed(generated):
+        while write > position:
+            entries[write] = entries[read]
+            read -= 1
+            write -= 1
+        entries[write] = txn
+        write -= 1
+    return entries
+
+
+def checkpoint_entry_key(entry, tracked):
+    """
+    What the merge reads of `entry`, to fingerprint the entries before a checkpoint.
+
+    Entries passed through are taken from the current list when the output is
+    built, so besides the dates only the templates, the events and the
+    postings to the `tracked` accounts count, along with the accounts
+    opened, which decide the balances tracked.
+
+    """
+    date = entry.date.toordinal()
+    if isinstance(entry, Transaction):
+        if entry.flag == __flag_char:
+            return date, compare.hash_entry(entry)
+        for posting in entry.postings:
+            if tracked[posting.account]:
+                return date, tuple(
+                    (posting.account, str(posting.units), repr(posting.cost))
+                    for posting in entry.postings
+                    if tracked[posting.account]
+                )
+        return date
+    if isinstance(entry, Event):
+        return date, entry.type, entry.description
+    if isinstance(entry, Open):
+        return date, entry.account
+    return date
+
+
+def window_carries_on(old, new, date):
+    """Whether a state merged up to `date` in the window `old` can carry on in `new` (see `ForecastState.rewindow()`)."""
+    if old == new:
+        return True
+    # The occurrences merged so far must be the same in both.
+    if date > min(old.end, new.end):
+        return False
+    return old.start == new.start or (
+        old.start is not None
+        and new.start is not None
+        and old.start <= new.start
+        and date <= old.start
+    )
+
+
+class Checkpointer:
+    """
+    Snapshot the merge state at the last few period boundaries and resume from the snapshots.
+
+    Each checkpoint carries the occurrences emitted since the previous one, so
+    the output up to it can be rebuilt from the entries without evaluating
+    anything, and the window they were generated in. Only the last `count`
+    boundaries are snapshotted, as edits mostly go at the end of a ledger.
+
+    """
+
+    def __init__(self, filename, key, period, count, tracked):
+        self.filename = filename
+        self.key = key
+        self.period = CHECKPOINT_PERIODS[period]
+        self.count = count
+        self.checkpoints = []
+        self.fingerprint = checkpoint.Fingerprint(
+            functools.partial(checkpoint_entry_key, tracked=tracked)
+        )
+        # The number of occurrences generated up to the last checkpoint.
+        self.emitted = 0
+        # The indexes still to snapshot at, in order.
+        self.planned = []
+        self.taken = False
+
+    def resume(self, entries, window, limit=None):
+        """
+        Return the state and output at the latest valid checkpoint (up to `limit`), or None.
+
+        The snapshots of this run are planned at the last boundaries after it.
+
+        """
+        limit = len(entries) - 1 if limit is None else min(limit, len(entries) - 1)
+        usable = []
+        for cp in sorted(checkpoint.load(self.filename, self.key), key=lambda cp: cp.index):
+            if cp.index > limit or not window_carries_on(
+                cp.payload[2], window, entries[cp.index].date
+            ):
+                break
+            usable.append(cp)
+        self.checkpoints, self.fingerprint = checkpoint.valid_prefix(
+            entries, usable, self.fingerprint
+        )
+        self.plan(entries, self.fingerprint.index, limit)
+        if not self.checkpoints:
+            return None
+        last = self.checkpoints[-1]
+        logger.info(f"resuming from checkpoint at {last.index=}")
+
+        length, _, _ = last.payload
+        output = MergedOutput(
+            length, [item for cp in self.checkpoints for item in cp.payload[1]]
+        )
+        self.emitted = len(output.generated)
+        return pickle.loads(last.state), output
+
+    def plan(self, entries, start, stop):
+        """Plan snapshots at the last `count` period boundaries in `entries[start + 1 : stop + 1]`."""
+        self.planned = []
+        for index in range(stop, start, -1):
+            if len(self.planned) == self.count:
+                break
+            if self.period(entries[index - 1].date) != self.period(entries[index].date):
+                self.planned.insert(0, index)
+
+    def visit(self, state, entries, output):
+        """Note that `entries[state.index]` is next, snapshotting first where planned."""
+        index = state.index
+        if not self.planned or self.planned[0] != index:
+            return
+        self.planned.pop(0)
+        self.fingerprint = self.fingerprint.extended(entries, index)
+        payload = (len(output), output.generated[self.emitted :], state.window)
+        self.checkpoints.append(
+            checkpoint.Checkpoint(
+                index,
+                self.fingerprint.digest(),
+                pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL),
+                payload,
+            )
+        )
+        self.emitted = len(output.generated)
+        self.taken = True
+
+    def save(self):
+        """Store the last `count` checkpoints, the first of them with the occurrences of those dropped."""
+        if not self.taken:
+            # Nothing new to store.
+            return
+        kept = self.checkpoints[-self.count :]
+        dropped = self.checkpoints[: -self.count]
+        if dropped:
+            first = kept[0]
+            length, generated, window = first.payload
+            generated = [item for cp in dropped for item in cp.payload[1]] + generated
+            kept[0] = first._replace(payload=(length, generated, window))
+        checkpoint.save(self.filename, self.key, kept)
+
+
+def checkpoint_key(cdict, sources, window):
+    """The settings a checkpoint is only valid for, besides the entries themselves."""
+    ignored = {
+        "debug",
+        "debug_level",
+        "debug_sets",
+        "profile",
+        "checkpoint",
+        "checkpoint_period",
+        "checkpoint_count",
+        "scenarios",
+        "workers",
+        "output",
+        "partition",
+    }
+    # The window itself moves with the last date of the ledger when the horizon
+    # or cutoff is relative to it; each checkpoint records the one it was taken in.
+    return (
+        CHECKPOINT_VERSION,
+        # without a horizon, bare recurrences run to the end of the current year
+        datetime.date.today().year if window.horizon is None else None,
+        sorted(sources),
+        sorted((k, repr(v)) for k, v in cdict.items() if k not in ignored),
+    )
+
+
+def configure(config_string):
+    """Parse the plugin's `config_string`, returning it as a dict and as a `Config`, and set up logging."""
     cdict = parse_config_string(config_string)
 
     debug_sets = cdict.get("debug_sets", None)
@@ -270,180 +1566,449 @@ def dynamic_forecast(
         fh.setLevel(C.debug_level)
         logger.addHandler(fh)
 
-    logger.info(f"{C=}")
+    return cdict, C
 
-    # Filter out loan entries from the list of valid entries.
-    through_entries = []
-    pending_entries = deque()
-    errors = []
-    logger.debug(f"{len(entries)=}")
-    real_root = realization.RealAccount("")
 
-    # Figure out the set of accounts for which we need to compute a running
-    # inventory balance.
-    balance_sources = {
-        entry.meta.get(metakey)
-        for entry in entries
-        if isinstance(entry, Transaction) and entry.flag == __flag_char
-        for metakey in entry.meta
-        if metakey.startswith(__bal_acc)
+def scenario_divergence(entries, scenarios):
+    """The index of the first event whose value any of the `scenarios` overrides."""
+    overridden = {
+        event_type for overrides in scenarios.values() for event_type in overrides
     }
+    return next(
+        (
+            index
+            for index, entry in enumerate(entries)
+            if isinstance(entry, Event) and entry.type in overridden
+        ),
+        len(entries),
+    )
 
-    logger.debug(f"{balance_sources=}")
-    # Add all children accounts of an asserted account to be calculated as well,
-    # and pre-create these accounts, and only those (we're just being tight to
-    # make sure).
 
-    balance_match_list = [account.parent_matcher(account_) for account_ in balance_sources]
+def merge_scenario(entries, state_bytes, length, overrides, C):
+    """
+    Carry on the pickled merge state through `entries` with `overrides` applied to events.
 
-    for account_ in getters.get_accounts(entries):
-        if account_ in balance_sources or any(
-            match(account_) for match in balance_match_list
-        ):
-            realization.get_or_create(real_root, account_)
+    This runs on a worker process; it returns the `(position, txn)` of each
+    occurrence generated, positioned after the `length` entries output before
+    `entries`.
+
+    """
+    logger.disabled = not C.debug
+    state = pickle.loads(state_bytes)
+    state.index = 0
+    state.override_events(overrides)
+    output = MergedOutput(length)
+    merge_entries(entries, state, output, C, NULL_PROFILE)
+    process_pending(state, output, NULL_PROFILE)
+    return output.generated
+
+
+def submit_scenarios(executor, entries, state, output, *, divergence, C):
+    """Submit the merge of `entries` from `divergence` on, carrying on from `state` and `output`, for each scenario."""
+    state_bytes = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    tail = entries[divergence:]
+    return {
+        name: executor.submit(merge_scenario, tail, state_bytes, len(output), overrides, C)
+        for name, overrides in C.scenarios.items()
+    }
 
-    last_date = None
-    event_map = dict()
 
-    # iterate over all the entries, update our event dict, balance tracking, etc
-    # our plugin does 3 things:
-    # 1. tracks events (so we can reference them)
-    # 2. tracks balances for accounts marked in any of the plugin transactions
-    # 3. computes the legs of the transactions by building a context dict base on the metadata
-    #
-    # - the first expense account type with 0 CUR as amount (CUR is returned from evaluation)
-    #   receives the expr amount, the first OTHER posting with value 0 CUR gets -val as the amount
-    #
+def combine_scenarios(generated, shared, scenarios):
+    """
+    Merge the occurrences of each of `scenarios` into the `(position, txn)` of `generated`.
 
-    for entry in entries:
-        if True:
-            if last_date is None:
-                last_date = entry.date
-
-            # pending entries has a copy of the plugin transaction with the appropriate date
-            # for each repetition wanted.
-            #
-            # TODO: consider refactoring so that it stops automatically when a balance expression
-            # is true...
-            while len(pending_entries) > 0 and pending_entries[0].date <= last_date:
-                dynamic_transaction = pending_entries.popleft()
-                assert dynamic_transaction.date <= last_date
-                try:
-                    txn = process_computed_entry(real_root, event_map, dynamic_transaction)
-                    update_balances(real_root, txn)
-                    through_entries.append(txn)
-                except:  # noqa: E722
-                    raise
-                # TODO: add generic exception handlers (from beancount_plugin_utils)
-                # except:
-                #    errors.append(
-                #        LoanModelError(
-                #            dynamic_transaction.meta, "Computation Error:", dynamic_transaction
-                #        )
-                #    )
-
-            if isinstance(entry, Event):
-                # TODO: track all events running value is sufficient
-                log_entry("EVENT", entry)
-                event_map[entry.type] = entry.description
-                through_entries.append(entry)
-                continue
-            elif isinstance(entry, Transaction) and entry.flag == __flag_char:
-                # pull up the work from below
-                match = re.search(
-                    r"(^.*)\[(MONTHLY|YEARLY|WEEKLY|DAILY)"
-                    r"(\s+SKIP\s+([1-9][0-9]*)\s+TIME.?)"
-                    r"?(\s+REPEAT\s+([1-9][0-9]*)\s+TIME.?)"
-                    r"?(\s+UNTIL\s+([0-9\-]+))?\]",
-                    entry.narration,
-                )
-                if not match:
-                    # no repetition?  just use the transaction and continue
-                    through_entries.append(entry)
-                    log_entry("no repetition detected -- regularizing", entry)
-                    continue
-                dynamic_narration = match.group(1).strip()
-                dynamic_interval = (
-                    rrule.YEARLY
-                    if match.group(2).strip() == "YEARLY"
-                    else (
-                        rrule.WEEKLY
-                        if match.group(2).strip() == "WEEKLY"
-                        else (
-                            rrule.DAILY
-                            if match.group(2).strip() == "DAILY"
-                            else rrule.MONTHLY
-                        )
-                    )
-                )
+    A scenario's occurrences are positioned in its own output, which has the
+    first `shared` occurrences of `generated` in common. Each goes after the
+    same entries of the input in the combined output, after the occurrences
+    of `generated` of the same date.
 
-                dynamic_periodicity = {"dtstart": entry.date}
-
-                if match.group(6):  # e.g., [MONTHLY REPEAT 3 TIMES]:
-                    dynamic_periodicity["count"] = int(match.group(6))
-                elif match.group(8):  # e.g., [MONTHLY UNTIL 2020-01-01]:
-                    dynamic_periodicity["until"] = datetime.datetime.strptime(
-                        match.group(8), "%Y-%m-%d"
-                    ).date()
-                else:
-                    # e.g., [MONTHLY]
-                    dynamic_periodicity["until"] = datetime.date(
-                        datetime.date.today().year, 12, 31
-                    )
+    """
 
-                if match.group(4):
-                    # SKIP
-                    dynamic_periodicity["interval"] = int(match.group(4)) + 1
+    def anchored(occurrences, before):
+        # the entries passed through before each occurrence
+        for count, (position, txn) in enumerate(occurrences, before):
+            yield position - count, txn
 
-                logger.debug(f"{dynamic_periodicity=}")
+    merged = heapq.merge(
+        anchored(generated, 0),
+        *(anchored(occurrences, shared) for occurrences in scenarios),
+        key=lambda item: (item[0], item[1].date),
+    )
+    return [(passed + count, txn) for count, (passed, txn) in enumerate(merged)]
+
+
+def scenario_account(name, account_):
+    """`account_` moved under the scenario `name`: `Assets:Bank` becomes `Assets:Scenario-<name>:Bank`."""
+    root, *rest = account.split(account_)
+    return account.join(root, "Scenario-" + re.sub(r"[^A-Za-z0-9-]", "-", name), *rest)
+
+
+def scenario_occurrences(name, generated):
+    """The `(position, txn)` occurrences `generated` for the scenario `name`, tagged and posting to its own accounts."""
+    tag = f"scenario-{name}"
+    return [
+        (
+            position,
+            txn._replace(
+                tags=(txn.tags or frozenset()) | {tag},
+                postings=[
+                    posting._replace(account=scenario_account(name, posting.account))
+                    for posting in txn.postings
+                ],
+            ),
+        )
+        for position, txn in generated
+    ]
 
-                # Generate a new entry for each loan date.
-                dynamic_dates = [
-                    dt.date() for dt in rrule.rrule(dynamic_interval, **dynamic_periodicity)
-                ]
-                logger.debug(f"{dynamic_dates=}")
-                slen = len(pending_entries)
-                for dynamic_date in dynamic_dates:
-                    # Push these onto a queue that we merge sort from when the date increases or is seen.
-                    # Keep these in  sorted order for certain. (Use some kind of sorted hash_map / ordered list).
-                    dynamic_entry = entry._replace(
-                        date=dynamic_date, narration=dynamic_narration
-                    )
-                    logger.info(f"pushing {dynamic_entry.date} {dynamic_entry.narration}")
-                    # TODO: Append and compute the interest charges instead
-                    # TODO: Event - track the appropriate rate.
 
-                    ordered_insert(
-                        pending_entries, dynamic_entry, lambda a, b: a.date < b.date
-                    )
-                assert len(pending_entries) - slen == len(dynamic_dates)
-                assert all(a.date <= b.date for a, b in pairwise(pending_entries))
+def scenario_opens(date, scenarios):
+    """An `Open` on `date` for each account the `(position, txn)` occurrences of `scenarios` post to."""
+    accounts = {
+        posting.account
+        for occurrences in scenarios
+        for _, txn in occurrences
+        for posting in txn.postings
+    }
+    return [
+        Open(data.new_metadata(f"<{__plugin_name__}>", 0), date, account_, None, None)
+        for account_ in sorted(accounts)
+    ]
 
-                logger.info(f"{len(pending_entries)=}")
-                # Make sure the new entries inserted are sorted.
-            else:
-                if isinstance(entry, Transaction):
-                    update_balances(real_root, entry)
-                if "passthrough" in C.debug_sets:
-                    log_entry("passthrough", entry)
-                through_entries.append(entry)
-            last_date = entry.date
-        logger.debug(f"{len(pending_entries)=}")
-
-    # Drain the swamp
-    while len(pending_entries) > 0:
-        dynamic_transaction = pending_entries.popleft()
-        try:
-            txn = process_computed_entry(real_root, event_map, dynamic_transaction)
-            update_balances(real_root, txn)
-            log_entry("processing remaining queue items", txn, level=logging.DEBUG)
-            through_entries.append(txn)
-        except:
-            raise
-            errors.append(
-                LoanModelError(
-                    dynamic_transaction.meta, "Computation Error: ", dynamic_transaction
+
+def forecast_scenarios(entries, options_map, config_string) -> Dict[str, Entries]:
+    """
+    Compute one merged entry list per configured scenario.
+
+    The shared prefix up to the first overridden event is merged once; each
+    scenario then carries on from it on a process pool.
+
+    """
+    _, C = configure(config_string)
+    state = new_state(
+        entries, C, NULL_PROFILE, forecast_window(entries, is_template, C.horizon, C.cutoff)
+    )
+    divergence = scenario_divergence(entries, C.scenarios)
+    prefix = MergedOutput()
+    merge_entries(entries, state, prefix, C, NULL_PROFILE, stop=divergence)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=C.workers) as executor:
+        futures = submit_scenarios(
+            executor, entries, state, prefix, divergence=divergence, C=C
+        )
+        return {
+            name: splice_generated(entries, prefix.generated + future.result())
+            for name, future in futures.items()
+        }
+
+
+def template_accounts(entry) -> Tuple[Set[str], Set[str]]:
+    """The accounts whose balances the template `entry` reads, and those it posts to."""
+    reads = {value for key, value in entry.meta.items() if key.startswith(__bal_acc)}
+    writes = {posting.account for posting in entry.postings}
+    return reads, writes
+
+
+def partition_templates(entries, groups: int) -> List[Entries]:
+    """
+    Split `entries` into at most `groups` lists of entries that can be merged independently.
+
+    Templates are connected when one posts to an account whose balance another
+    reads (the account or any of its parents). Each connected component keeps
+    its templates together; components are packed into the groups by size.
+    Every group gets the templates of its components, the transactions to the
+    accounts they read, and all the opens, closes and events of `entries`.
+
+    """
+    templates = [index for index, entry in enumerate(entries) if is_template(entry)]
+    accounts = [template_accounts(entries[index]) for index in templates]
+
+    # Union-find over the templates.
+    parent = list(range(len(templates)))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    readers = {}
+    for node, (reads, _) in enumerate(accounts):
+        for read in reads:
+            readers.setdefault(read, []).append(node)
+    for node, (_, writes) in enumerate(accounts):
+        for write in writes:
+            for ancestor in account.parents(write):
+                for reader in readers.get(ancestor, ()):
+                    parent[find(reader)] = find(node)
+
+    components = {}
+    for node in range(len(templates)):
+        components.setdefault(find(node), []).append(node)
+    components = list(components.values())
+
+    # The components reading each account, through any of its ancestors.
+    component_reads = {}
+    for component, nodes in enumerate(components):
+        for node in nodes:
+            for read in accounts[node][0]:
+                component_reads.setdefault(read, set()).add(component)
+    readers_of = functools.lru_cache(maxsize=None)(
+        lambda name: frozenset(
+            component
+            for ancestor in account.parents(name)
+            for component in component_reads.get(ancestor, ())
+        )
+    )
+
+    relevant = [[] for _ in components]
+    shared = []
+    for index, entry in enumerate(entries):
+        if isinstance(entry, (Open, Close, Event)):
+            shared.append(index)
+        elif isinstance(entry, Transaction) and entry.flag != __flag_char:
+            for component in set().union(
+                *(readers_of(posting.account) for posting in entry.postings)
+            ):
+                relevant[component].append(index)
+
+    # Greedily pack the largest components into the least loaded groups.
+    sizes = [len(relevant[c]) + len(components[c]) for c in range(len(components))]
+    loads = [(0, group) for group in range(min(groups, len(components)))]
+    members = [[] for _ in loads]
+    for component in sorted(range(len(components)), key=sizes.__getitem__, reverse=True):
+        load, group = heapq.heappop(loads)
+        members[group].append(component)
+        heapq.heappush(loads, (load + sizes[component], group))
+
+    partitions = []
+    for group in members:
+        indexes = set(shared)
+        for component in group:
+            indexes.update(relevant[component])
+            indexes.update(templates[node] for node in components[component])
+        partitions.append([entries[index] for index in sorted(indexes)])
+    return partitions
+
+
+def merge_partition(entries, C, window):
+    """
+    Merge the templates of `entries`, which no template outside them depends on.
+
+    This runs on a worker process; it returns the generated occurrences in
+    `entry_sortkey` order.
+
+    """
+    logger.disabled = not C.debug
+    state = new_state(entries, C, NULL_PROFILE, window)
+    output = MergedOutput()
+    merge_entries(entries, state, output, C, NULL_PROFILE)
+    process_pending(state, output, NULL_PROFILE)
+    return sorted((txn for _, txn in output.generated), key=data.entry_sortkey)
+
+
+def position_sorted(entries, occurrences):
+    """
+    Return the `(position, txn)` of the sorted `occurrences` merged into `entries`.
+
+    Positions are those of `iter_merged()`: an occurrence goes after the
+    entries, less the templates, that sort before it or equal to it.
+
+    """
+    generated = []
+    entries = (entry for entry in entries if not is_template(entry))
+    entry = next(entries, None)
+    passed = 0
+    for txn in occurrences:
+        key = data.entry_sortkey(txn)
+        while entry is not None and data.entry_sortkey(entry) <= key:
+            passed += 1
+            entry = next(entries, None)
+        generated.append((passed + len(generated), txn))
+    return generated
+
+
+def forecast_partitioned(entries, C, profile, window):
+    """Merge independent groups of templates in parallel, returning the `(position, txn)` of their occurrences."""
+    with profile.phase("partition"):
+        partitions = partition_templates(entries, C.workers or os.cpu_count())
+    profile.count("partitions", len(partitions))
+
+    if len(partitions) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=len(partitions)
+        ) as executor:
+            generated = list(
+                executor.map(
+                    merge_partition,
+                    partitions,
+                    itertools.repeat(C),
+                    itertools.repeat(window),
                 )
             )
+    else:
+        generated = [merge_partition(partition, C, window) for partition in partitions]
+
+    with profile.phase("output"):
+        return position_sorted(entries, heapq.merge(*generated, key=data.entry_sortkey))
+
+
+def build_output(entries, generated, C):
+    """The merged output, as a new list or spliced into `entries` per the `output` option."""
+    if C.output == "inplace":
+        return splice_in_place(entries, generated)
+    return splice_generated(entries, generated)
+
+
+def dynamic_forecast(
+    entries: Entries, unused_options_map, config_string: str, *args
+) -> Tuple[Entries, List[NamedTuple]]:
+    """
+    An example dynamic posting computation plugin that allows postings to be
+    computed based on balances at a point in time.
+
+    Args:
+      entries: a list of entry instances - as per beancount
+      config_string: a dict as str with the required configuration:
+        debug : bool or comma-separated keys
+        debug_level : logging levels
+        debug_sets : a comma separated list of special debug sections
+          (`passthrough` logs passed through entries, `check_order` asserts
+          the pending queue pops in date order)
+        profile : bool, write phase timings and counters as JSON next to the log
+        checkpoint : a file to keep snapshots of the merge state in; a re-run
+          resumes from the latest snapshot whose entry prefix is unchanged
+        checkpoint_period : MONTHLY (default) or YEARLY snapshots
+        checkpoint_count : the number of snapshots kept, at the last period
+          boundaries of the ledger (default 3)
+        scenarios : a dict of scenario name to a dict of event type to value;
+          each scenario is evaluated with those event values on a process pool
+          and its occurrences from the first overridden event on are spliced
+          in among the others, tagged `scenario-<name>` and posting to copies
+          of their accounts under `<Root>:Scenario-<name>` (opened on the first
+          date), so the regular forecast's balances are left as they are
+        workers : the size of that process pool
+        partition : bool, merge independent groups of templates (those not
+          posting to accounts whose balances the others read) on `workers`
+          processes; not combined with `checkpoint` or `scenarios`
+        output : `list` (default) to return a new list, or `inplace` to splice
+          the occurrences into `entries` itself, without copying it
+        horizon : the end of recurrences without REPEAT or UNTIL, a date
+          (yyyy-mm-dd) or `N DAYS|WEEKS|MONTHS|YEARS` after the last date of
+          the ledger (default: the end of the current year)
+        cutoff : drop the occurrences more than this many days before the
+          last date of the ledger
+        context_meta : `all` (default), `none`, or a list of the context
+          variables copied to each occurrence's metadata
+        context_format : `str` (default) for string values, or `typed` for
+          amounts, numbers and balance snapshots
+
+    Returns:
+      A tuple of entries and errors.
+
+    """
+
+    cdict, C = configure(config_string)
+
+    logger.info(f"{C=}")
+
+    profile = Profile() if C.profile else NULL_PROFILE
+
+    # Filter out loan entries from the list of valid entries.
+    output = MergedOutput()
+    errors = recurrence_errors(entries) + loan_errors(entries)
+    logger.debug(f"{len(entries)=}")
+
+    # Resolved against the whole ledger, so partitions and scenarios share it.
+    window = forecast_window(entries, is_template, C.horizon, C.cutoff)
+
+    if C.partition:
+        if C.checkpoint is None and not C.scenarios:
+            generated = forecast_partitioned(entries, C, profile, window)
+            with profile.phase("output"):
+                through_entries = build_output(entries, generated, C)
+            if C.profile:
+                profile.write(f"{__plugin_name__}.profile.json")
+            return (through_entries, errors)
+        logger.warning("partition is ignored together with checkpoint or scenarios")
+
+    with profile.phase("balance_sources"):
+        sources = balance_sources(entries)
+    divergence = scenario_divergence(entries, C.scenarios) if C.scenarios else None
+
+    state = None
+    checkpointer = None
+    if C.checkpoint is not None:
+        checkpointer = Checkpointer(
+            C.checkpoint,
+            checkpoint_key(cdict, sources, window),
+            C.checkpoint_period,
+            C.checkpoint_count,
+            TrackedAccounts(sources),
+        )
+        with profile.phase("checkpoint"):
+            # Scenarios need the state at their divergence, so don't resume past it.
+            resumed = checkpointer.resume(entries, window, limit=divergence)
+        if resumed is not None:
+            state, output = resumed
+            # Only the entries after the checkpoint may have changed since it was taken.
+            state.catch_up(entries, sources)
+            if state.window != window:
+                state.rewindow(window)
+            profile.count("resumed_entries", state.index)
+
+    if state is None:
+        state = new_state(entries, C, profile, window, sources)
+
+    with (
+        concurrent.futures.ProcessPoolExecutor(max_workers=C.workers)
+        if C.scenarios
+        else contextlib.nullcontext()
+    ) as executor:
+        scenario_futures = {}
+        if C.scenarios:
+            merge_entries(
+                entries,
+                state,
+                output,
+                C,
+                profile,
+                checkpointer=checkpointer,
+                stop=divergence,
+            )
+            shared = len(output.generated)
+            scenario_futures = submit_scenarios(
+                executor, entries, state, output, divergence=divergence, C=C
+            )
+
+        merge_entries(entries, state, output, C, profile, checkpointer=checkpointer)
+
+        # Drain the swamp
+        process_pending(state, output, profile)
+
+        generated = output.generated
+        if scenario_futures:
+            with profile.phase("scenarios"):
+                scenarios = [
+                    scenario_occurrences(name, future.result())
+                    for name, future in scenario_futures.items()
+                ]
+                # Opened on the first date, ahead of everything else.
+                opens = scenario_opens(entries[0].date, scenarios)
+                generated = [(position, open_) for position, open_ in enumerate(opens)] + [
+                    (position + len(opens), txn)
+                    for position, txn in combine_scenarios(generated, shared, scenarios)
+                ]
+
+    if checkpointer is not None:
+        with profile.phase("checkpoint"):
+            checkpointer.save()
+
+    with profile.phase("output"):
+        through_entries = build_output(entries, generated, C)
+
+    logger.info(f"{compile_expression.cache_info()=}")
+
+    if C.profile:
+        profile.write(f"{__plugin_name__}.profile.json")
 
     return (through_entries, errors)
@@ -1,11 +1,28 @@
 __copyright__ = "Copyright (C) 2014-2017  Martin Blais"
 __license__ = "GNU GPLv2"
 
+import datetime
+import io
+import json
+import os
+import tempfile
 import textwrap
 import unittest
 
+from dateutil import rrule
+
 from beancount import loader
+from beancount.core import amount
+from beancount.core import data
+from beancount.core.number import D
 from beancount.parser import cmptest
+from beancount.parser import parser
+from beancount.parser import printer
+
+from beancount_muonzoo_plugins import dynamic_forecast
+from beancount_muonzoo_plugins.util import expression, recurrence
+from beancount_muonzoo_plugins.util.events import EventTimeline
+from beancount_muonzoo_plugins.util.profiling import Profile
 
 
 class TestDynamicForecast(cmptest.TestCase):
@@ -175,6 +192,1205 @@ class TestDynamicForecast(cmptest.TestCase):
             entries,
         )
 
+    @loader.load_doc(expect_errors=False)
+    def test_parent_account_balance(self, entries, _, __):
+        """
+        plugin "beancount_muonzoo_plugins.dynamic_forecast" "{}"
+        2011-01-01 open Equity:Opening-Balances
+        2011-01-01 open Expenses:Fees
+        2011-01-01 open Assets:Bank:Checking
+        2011-01-01 open Assets:Bank:Savings
+
+        2011-01-02 * "Opening Position"
+          Equity:Opening-Balances
+          Assets:Bank:Checking               100.00 USD
+          Assets:Bank:Savings                900.00 USD
+
+        2011-02-01 % "Fee [MONTHLY REPEAT 2 TIMES]"
+          bal_acc_bank:  "Assets:Bank"
+          expr_fee:      "R(div(gcu(bank,'USD'),D(100)),2)"
+          Expenses:Fees                      0 USD
+            expr: "fee"
+          Assets:Bank:Checking               0 USD
+            expr: "-fee"
+        """
+        fees = [
+            posting.units
+            for entry in entries
+            if isinstance(entry, data.Transaction) and entry.flag == "%"
+            for posting in entry.postings
+            if posting.account == "Expenses:Fees"
+        ]
+        # The second fee sees the first one deducted from the checking account.
+        self.assertEqual(
+            [amount.Amount(D("10.00"), "USD"), amount.Amount(D("9.90"), "USD")], fees
+        )
+
+    def test_account_index(self):
+        entries, errors, _ = parser.parse_string(
+            textwrap.dedent(
+                """
+                2011-01-01 open Expenses:Fees
+                2011-01-01 open Assets:Bank:Checking
+                2011-01-01 open Assets:Bank:Savings
+
+                2011-02-01 % "Fee [MONTHLY REPEAT 2 TIMES]"
+                  bal_acc_bank:  "Assets:Bank"
+                  bal_acc_chk:   "Assets:Bank:Checking"
+                  Expenses:Fees                   1.00 USD
+                  Assets:Bank:Checking
+                """
+            )
+        )
+        self.assertFalse(errors)
+        balances = dynamic_forecast.new_state(
+            entries, dynamic_forecast.Config(), dynamic_forecast.NULL_PROFILE
+        ).balances
+        self.assertEqual(
+            {"Assets:Bank:Checking", "Assets:Bank:Savings"}, set(balances.index)
+        )
+        self.assertEqual(
+            [
+                id(balances.subtree["Assets:Bank:Checking"]),
+                id(balances.subtree["Assets:Bank"]),
+            ],
+            [id(inventory) for inventory in balances.index["Assets:Bank:Checking"]],
+        )
+
+    @loader.load_doc(expect_errors=False)
+    def test_until_expr_stops_recurrence(self, entries, _, __):
+        """
+        plugin "beancount_muonzoo_plugins.dynamic_forecast" "{}"
+        2011-01-01 open Equity:Opening-Balances
+        2011-01-01 open Liabilities:Loan
+        2011-01-01 open Assets:Bank
+
+        2011-01-02 * "Opening Position"
+          Assets:Bank                        1000.00 USD
+          Liabilities:Loan                  -1000.00 USD
+
+        2011-02-01 % "Repayment [MONTHLY REPEAT 360 TIMES]"
+          bal_acc_loan:  "Liabilities:Loan"
+          until_expr:    "gcu(loan,'USD').number >= 0"
+          Liabilities:Loan                   250.00 USD
+          Assets:Bank
+
+        2041-01-01 balance Liabilities:Loan     0.00 USD
+        """
+        repayments = [
+            entry
+            for entry in entries
+            if isinstance(entry, data.Transaction) and entry.flag == "%"
+        ]
+        self.assertEqual(4, len(repayments))
+        self.assertEqual(datetime.date(2011, 5, 1), repayments[-1].date)
+        self.assertNotIn("until_expr", repayments[-1].meta)
+
+    def test_batch_evaluation(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Equity:Opening-Balances
+            2011-01-01 open Income:Salary
+            2011-01-01 open Expenses:Fees
+            2011-01-01 open Assets:Bank
+
+            2011-01-02 * "Opening Position"
+              Equity:Opening-Balances
+              Assets:Bank                        1000.00 USD
+
+            2011-01-03 event "salary" "1000.00"
+            2011-03-15 event "salary" "1200.00"
+
+            2011-02-01 % "Salary [MONTHLY REPEAT 4 TIMES]"
+              event_salary:  "salary"
+              expr_pay:      "A(D(salary),'USD')"
+              Income:Salary                      0 USD
+                expr: "-pay"
+              Assets:Bank                        0 USD
+                expr: "pay"
+
+            2011-02-15 % "Fee [MONTHLY REPEAT 3 TIMES]"
+              bal_acc_bank:  "Assets:Bank"
+              expr_fee:      "R(div(gcu(bank,'USD'),D(100)),2)"
+              Expenses:Fees                      0 USD
+                expr: "fee"
+              Assets:Bank                        0 USD
+                expr: "-fee"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                entries, errors = dynamic_forecast.dynamic_forecast(
+                    entries, options_map, "{'profile': True}"
+                )
+                with open("dynamic_forecast.profile.json") as infile:
+                    counters = json.load(infile)["counters"]
+            finally:
+                os.chdir(cwd)
+        self.assertFalse(errors)
+
+        def units(account):
+            return [
+                posting.units.number
+                for entry in entries
+                if isinstance(entry, data.Transaction) and entry.flag == "%"
+                for posting in entry.postings
+                if posting.account == account
+            ]
+
+        # The salary follows the event on each date; only its changes are evaluated.
+        self.assertEqual(
+            [D("-1000.00"), D("-1000.00"), D("-1200.00"), D("-1200.00")],
+            units("Income:Salary"),
+        )
+        self.assertEqual(1, counters["batch_templates"])
+        self.assertEqual(2, counters["reused_evaluations"])
+        # Occurrences sharing an evaluation don't share their metadata.
+        salaries = [
+            entry for entry in entries if getattr(entry, "narration", "") == "Salary"
+        ]
+        salaries[0].meta["pay"] = "changed"
+        self.assertEqual("1000.00 USD", salaries[1].meta["pay"])
+        # The fee, evaluated in date order, sees the salary paid before it.
+        self.assertEqual([D("20.00"), D("29.80"), D("41.50")], units("Expenses:Fees"))
+
+    @loader.load_doc(expect_errors=False)
+    def test_event_at(self, entries, _, __):
+        """
+        plugin "beancount_muonzoo_plugins.dynamic_forecast" "{}"
+        2011-01-01 open Equity:Opening-Balances
+        2011-01-01 open Expenses:Fees
+        2011-01-01 open Assets:Bank
+
+        2011-01-02 * "Opening Position"
+          Equity:Opening-Balances
+          Assets:Bank                        1000.00 USD
+
+        2011-01-03 event "fee" "1.00"
+        2011-02-15 event "fee" "2.00"
+        2011-03-01 event "fee" "3.00"
+
+        2011-02-01 % "Flat fee [MONTHLY REPEAT 3 TIMES]"
+          expr_fee:      "A(D(event_at('fee', date)),'USD')"
+          Expenses:Fees                      0 USD
+            expr: "fee"
+          Assets:Bank                        0 USD
+            expr: "-fee"
+
+        2011-02-01 % "Low balance fee [MONTHLY REPEAT 3 TIMES]"
+          bal_acc_bank:  "Assets:Bank"
+          expr_fee:      "A(D(event_at('fee', date)) if gcu(bank,'USD').number < 1000 else D(0),'USD')"
+          Expenses:Fees                      0 USD
+            expr: "fee"
+          Assets:Bank                        0 USD
+            expr: "-fee"
+        """
+        fees = [
+            (entry.date, entry.narration, entry.postings[0].units.number)
+            for entry in entries
+            if isinstance(entry, data.Transaction) and entry.flag == "%"
+        ]
+        # The event on the occurrence date itself counts; the date isn't kept in the metadata.
+        self.assertEqual(
+            [
+                (datetime.date(2011, 2, 1), "Flat fee", D("1.00")),
+                (datetime.date(2011, 2, 1), "Low balance fee", D("0")),
+                (datetime.date(2011, 3, 1), "Flat fee", D("3.00")),
+                (datetime.date(2011, 3, 1), "Low balance fee", D("3.00")),
+                (datetime.date(2011, 4, 1), "Flat fee", D("3.00")),
+                (datetime.date(2011, 4, 1), "Low balance fee", D("3.00")),
+            ],
+            sorted(fees),
+        )
+        self.assertFalse(
+            {"date", "event_at"} & {key for entry in entries for key in entry.meta}
+        )
+
+    def test_output_inplace(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Equity:Opening-Balances
+            2011-01-01 open Expenses:Fees
+            2011-01-01 open Assets:Bank
+
+            2011-01-02 * "Opening Position"
+              Equity:Opening-Balances
+              Assets:Bank                        1000.00 USD
+
+            2011-02-01 % "Fee [MONTHLY REPEAT 3 TIMES]"
+              bal_acc_bank:  "Assets:Bank"
+              expr_fee:      "R(div(gcu(bank,'USD'),D(100)),2)"
+              Expenses:Fees                      0 USD
+                expr: "fee"
+              Assets:Bank                        0 USD
+                expr: "-fee"
+
+            2011-02-15 % "Flat fee [WEEKLY REPEAT 3 TIMES]"
+              Expenses:Fees                   1.00 USD
+              Assets:Bank                    -1.00 USD
+
+            2011-03-15 * "Deposit"
+              Equity:Opening-Balances
+              Assets:Bank                         100.00 USD
+
+            2011-06-01 balance Assets:Bank       1063.38 USD
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        expected, errors = dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+        self.assertFalse(errors)
+        self.assertEqual(12, len(expected))
+
+        merged, errors = dynamic_forecast.dynamic_forecast(
+            entries, options_map, "{'output': 'inplace'}"
+        )
+        self.assertFalse(errors)
+        self.assertIs(entries, merged)
+        self.assertEqual(expected, merged)
+
+    def test_partition(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Equity:Opening-Balances
+            2011-01-01 open Income:Salary
+            2011-01-01 open Expenses:Fees
+            2011-01-01 open Assets:Alice:Bank
+            2011-01-01 open Assets:Bob:Bank
+
+            2011-01-02 * "Opening Position"
+              Equity:Opening-Balances
+              Assets:Alice:Bank                  1000.00 USD
+              Assets:Bob:Bank                    2000.00 USD
+
+            2011-01-03 event "salary" "500.00"
+
+            2011-02-01 % "Alice's salary [MONTHLY REPEAT 4 TIMES]"
+              event_salary:  "salary"
+              expr_pay:      "A(D(salary),'USD')"
+              Income:Salary                      0 USD
+                expr: "-pay"
+              Assets:Alice:Bank                  0 USD
+                expr: "pay"
+
+            2011-02-10 % "Alice's fee [MONTHLY REPEAT 4 TIMES]"
+              bal_acc_bank:  "Assets:Alice"
+              expr_fee:      "R(div(gcu(bank,'USD'),D(100)),2)"
+              Expenses:Fees                      0 USD
+                expr: "fee"
+              Assets:Alice:Bank                  0 USD
+                expr: "-fee"
+
+            2011-02-10 % "Bob's fee [MONTHLY REPEAT 4 TIMES]"
+              bal_acc_bank:  "Assets:Bob:Bank"
+              expr_fee:      "R(div(gcu(bank,'USD'),D(100)),2)"
+              Expenses:Fees                      0 USD
+                expr: "fee"
+              Assets:Bob:Bank                    0 USD
+                expr: "-fee"
+
+            2011-03-15 * "Bob's deposit"
+              Equity:Opening-Balances
+              Assets:Bob:Bank                     100.00 USD
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+
+        partitions = dynamic_forecast.partition_templates(entries, 4)
+        self.assertEqual(
+            [
+                {
+                    "Alice's fee [MONTHLY REPEAT 4 TIMES]",
+                    "Alice's salary [MONTHLY REPEAT 4 TIMES]",
+                },
+                {"Bob's fee [MONTHLY REPEAT 4 TIMES]"},
+            ],
+            sorted(
+                (
+                    {
+                        entry.narration
+                        for entry in partition
+                        if dynamic_forecast.is_template(entry)
+                    }
+                    for partition in partitions
+                ),
+                key=len,
+                reverse=True,
+            ),
+        )
+        # Only Bob's transactions go along with his template.
+        (bob,) = [
+            partition
+            for partition in partitions
+            if not any("Alice" in getattr(entry, "narration", "") for entry in partition)
+        ]
+        self.assertEqual(
+            ["Opening Position", "Bob's deposit"],
+            [
+                entry.narration
+                for entry in bob
+                if isinstance(entry, data.Transaction) and entry.flag != "%"
+            ],
+        )
+
+        expected, errors = dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+        self.assertFalse(errors)
+        merged, errors = dynamic_forecast.dynamic_forecast(
+            entries, options_map, "{'partition': True, 'workers': 2}"
+        )
+        self.assertFalse(errors)
+        self.assertEqual(sorted(expected, key=data.entry_sortkey), merged)
+
+        inplace = list(entries)
+        spliced, errors = dynamic_forecast.dynamic_forecast(
+            inplace, options_map, "{'partition': True, 'workers': 2, 'output': 'inplace'}"
+        )
+        self.assertFalse(errors)
+        self.assertIs(inplace, spliced)
+        self.assertEqual(merged, spliced)
+
+    def test_context_meta(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Interest
+            2011-01-01 open Liabilities:Loan
+            2011-01-01 open Assets:Bank
+
+            2011-01-02 * "Opening Position"
+              Assets:Bank                        1000.00 USD
+              Liabilities:Loan                  -1000.00 USD
+
+            2011-02-01 event "loan_rate" "0.12"
+
+            2011-05-01 % "Interest Charge [MONTHLY REPEAT 2 TIMES]"
+              note:                  "kept"
+              bal_acc_loan:          "Liabilities:Loan"
+              event_int_rate:        "loan_rate"
+              expr_monthly_interest: "R(div(mul(gcu(loan,'USD'),D(int_rate)),D(12)),2)"
+              Expenses:Interest     0 USD
+                expr: "-monthly_interest"
+              Liabilities:Loan      0 USD
+                expr: "monthly_interest"
+        """
+        )
+
+        def metas(config):
+            entries, errors, options_map = parser.parse_string(input_text)
+            self.assertFalse(errors)
+            entries, errors = dynamic_forecast.dynamic_forecast(
+                entries, options_map, config
+            )
+            self.assertFalse(errors)
+            return [
+                {
+                    key: value
+                    for key, value in entry.meta.items()
+                    if key not in ("filename", "lineno")
+                }
+                for entry in entries
+                if isinstance(entry, data.Transaction) and entry.flag == "%"
+            ]
+
+        first, second = metas("{}")
+        self.assertEqual("-10.00 USD", first["monthly_interest"])
+        self.assertEqual("(-1000.00 USD)", first["loan"])
+        self.assertEqual("0.12", second["int_rate"])
+
+        self.assertEqual([{"note": "kept"}] * 2, metas("{'context_meta': 'none'}"))
+
+        first, second = metas(
+            "{'context_meta': ['loan', 'monthly_interest'], 'context_format': 'typed'}"
+        )
+        self.assertEqual({"note", "loan", "monthly_interest"}, set(first))
+        self.assertEqual(amount.Amount(D("-10.00"), "USD"), first["monthly_interest"])
+        # The balance is a snapshot as of the occurrence, not the running balance.
+        self.assertEqual(amount.Amount(D("-1000.00"), "USD"), first["loan"])
+        self.assertEqual(amount.Amount(D("-1010.00"), "USD"), second["loan"])
+
+    def test_typed_context_prints(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Fees
+            2011-01-01 open Assets:Bank
+
+            2011-02-01 % "Fee [MONTHLY REPEAT 1 TIME]"
+              expr_count:  "2"
+              expr_ratio:  "0.5"
+              expr_late:   "2 > 1"
+              expr_fee:    "A(D('1.00'),'USD')"
+              Expenses:Fees      0 USD
+                expr: "fee"
+              Assets:Bank        0 USD
+                expr: "-fee"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        entries, errors = dynamic_forecast.dynamic_forecast(
+            entries, options_map, "{'context_format': 'typed'}"
+        )
+        self.assertFalse(errors)
+        (occurrence,) = [entry for entry in entries if isinstance(entry, data.Transaction)]
+        self.assertEqual(D("2"), occurrence.meta["count"])
+        self.assertEqual(D("0.5"), occurrence.meta["ratio"])
+        self.assertIs(True, occurrence.meta["late"])
+
+        output = io.StringIO()
+        printer.print_entries(entries, file=output)
+        self.assertIn("count: 2\n", output.getvalue())
+        self.assertIn("late: TRUE\n", output.getvalue())
+        self.assertIn("fee: 1.00 USD\n", output.getvalue())
+
+    def test_loan_schedule(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Equity:Opening-Balances
+            2011-01-01 open Expenses:Interest
+            2011-01-01 open Liabilities:Loan
+            2011-01-01 open Assets:Bank
+
+            2011-01-02 * "Opening Position"
+              Assets:Bank                        1000.00 USD
+              Liabilities:Loan                  -1000.00 USD
+
+            2011-01-03 event "loan_rate" "0.12"
+            2011-03-15 event "loan_rate" "0.24"
+
+            2011-02-01 % "Repayment [MONTHLY REPEAT 4 TIMES]"
+              loan_principal:  1000.00 USD
+              loan_rate:       "loan_rate"
+              Expenses:Interest                  0 USD
+                loan: "interest"
+              Liabilities:Loan                   0 USD
+                loan: "principal"
+              Assets:Bank                        0 USD
+                loan: "-payment"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        entries, errors = dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+        self.assertFalse(errors)
+
+        repayments = [
+            entry
+            for entry in entries
+            if isinstance(entry, data.Transaction) and entry.flag == "%"
+        ]
+        self.assertEqual(4, len(repayments))
+        for txn in repayments:
+            self.assertEqual(D(0), sum(posting.units.number for posting in txn.postings))
+            self.assertNotIn("loan_principal", txn.meta)
+        # The payment is recomputed from the rate change on, and clears the loan.
+        payments = [-txn.postings[2].units.number for txn in repayments]
+        self.assertEqual(payments[0], payments[1])
+        self.assertLess(payments[1], payments[2])
+        self.assertEqual(
+            D("1000.00"), sum(txn.postings[1].units.number for txn in repayments)
+        )
+        self.assertEqual("0.00", repayments[-1].meta["balance"])
+
+    def test_loan_matches_expression(self):
+        header = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Interest
+            2011-01-01 open Liabilities:Loan
+            2011-01-01 open Assets:Bank
+
+            2011-01-02 * "Opening Position"
+              Assets:Bank                        1000.00 USD
+              Liabilities:Loan                  -1000.00 USD
+
+            2011-02-01 event "loan_rate" "0.12"
+        """
+        )
+        expression_template = textwrap.dedent(
+            """
+            2011-05-01 % "Interest Charge [MONTHLY REPEAT 12 TIMES]"
+              bal_acc_loan:          "Liabilities:Loan"
+              event_int_rate:        "loan_rate"
+              expr_monthly_interest: "R(div(mul(gcu(loan,'USD'),D(int_rate)),D(12)),2)"
+              Expenses:Interest     0 USD
+                expr: "-monthly_interest"
+              Liabilities:Loan      0 USD
+                expr: "monthly_interest"
+        """
+        )
+        loan_template = textwrap.dedent(
+            """
+            2011-05-01 % "Interest Charge [MONTHLY REPEAT 12 TIMES]"
+              loan_principal:  1000.00 USD
+              loan_rate:       "loan_rate"
+              loan_payment:    0.00 USD
+              Expenses:Interest     0 USD
+                loan: "interest"
+              Liabilities:Loan      0 USD
+                loan: "principal"
+        """
+        )
+
+        def postings(template):
+            entries, errors, options_map = parser.parse_string(header + template)
+            self.assertFalse(errors)
+            entries, errors = dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+            self.assertFalse(errors)
+            return [
+                (entry.date, posting.account, posting.units)
+                for entry in entries
+                if isinstance(entry, data.Transaction) and entry.flag == "%"
+                for posting in entry.postings
+            ]
+
+        self.assertEqual(postings(expression_template), postings(loan_template))
+
+    def test_invalid_loan_is_reported(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Interest
+            2011-01-01 open Liabilities:Loan
+
+            2011-02-01 % "Interest [MONTHLY REPEAT 2 TIMES]"
+              loan_principal:  1000.00 USD
+              Expenses:Interest     0 USD
+                loan: "interest"
+              Liabilities:Loan      0 USD
+                loan: "principal"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        entries, errors = dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], dynamic_forecast.LoanModelError)
+        self.assertIn("loan_rate", errors[0].message)
+        self.assertFalse(
+            [entry for entry in entries if isinstance(entry, data.Transaction)]
+        )
+
+        # Without REPEAT or UNTIL the term would depend on the horizon.
+        entries, errors, options_map = parser.parse_string(
+            input_text.replace(' REPEAT 2 TIMES]"', ']"\n  loan_rate: 0.05')
+        )
+        self.assertFalse(errors)
+        entries, errors = dynamic_forecast.dynamic_forecast(
+            entries, options_map, "{'horizon': '2 YEARS'}"
+        )
+        self.assertEqual(1, len(errors))
+        self.assertIn("REPEAT", errors[0].message)
+        self.assertFalse(
+            [entry for entry in entries if isinstance(entry, data.Transaction)]
+        )
+
+        # A quoted rate is a constant unless it names an event.
+        for rate, events, generated in [
+            ('"0.05"', "", 2),
+            ('"loan_rate"', "", 0),
+            ('"loan_rate"', '2011-03-01 event "loan_rate" "0.05"', 0),
+            ('"loan_rate"', '2011-02-01 event "loan_rate" "0.05"', 2),
+        ]:
+            with self.subTest(rate=rate, events=events):
+                entries, errors, options_map = parser.parse_string(
+                    input_text.replace(' TIMES]"', f' TIMES]"\n  loan_rate: {rate}')
+                    + events
+                )
+                self.assertFalse(errors)
+                entries, errors = dynamic_forecast.dynamic_forecast(
+                    entries, options_map, "{}"
+                )
+                self.assertEqual(
+                    generated,
+                    len(
+                        [entry for entry in entries if isinstance(entry, data.Transaction)]
+                    ),
+                )
+                if not generated:
+                    self.assertEqual(1, len(errors))
+                    self.assertIsInstance(errors[0], dynamic_forecast.LoanModelError)
+                    self.assertIn(
+                        "no loan_rate event on or before 2011-02-01", errors[0].message
+                    )
+                else:
+                    self.assertFalse(errors)
+
+    def test_invalid_recurrence_is_reported(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Restaurant
+            2011-01-01 open Assets:Cash
+
+            2011-01-04 % "Lunch [WEEKLY ON 2ND TUE REPEAT 2 TIMES]"
+              Expenses:Restaurant   12.00 USD
+              Assets:Cash
+
+            2011-02-01 % "Coffee [MONTHLY REPEAT 2 TIMES]"
+              Expenses:Restaurant    4.50 USD
+              Assets:Cash
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        entries, errors = dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+        # Only the bad template is dropped.
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], dynamic_forecast.RecurrenceError)
+        self.assertEqual(
+            "Lunch [WEEKLY ON 2ND TUE REPEAT 2 TIMES]", errors[0].entry.narration
+        )
+        self.assertEqual(
+            [("Coffee", datetime.date(2011, 2, 1)), ("Coffee", datetime.date(2011, 3, 1))],
+            [
+                (entry.narration, entry.date)
+                for entry in entries
+                if isinstance(entry, data.Transaction)
+            ],
+        )
+
+    @loader.load_doc(expect_errors=False)
+    def test_horizon_and_cutoff(self, entries, _, __):
+        """
+        plugin "beancount_muonzoo_plugins.dynamic_forecast" "{'horizon': '2011-07-31', 'cutoff': 45}"
+        2011-01-01 open Expenses:Restaurant
+        2011-01-01 open Assets:Cash
+
+        2011-01-17 % "Dinner [MONTHLY]"
+          Expenses:Restaurant   50.02 USD
+          Assets:Cash
+
+        2011-02-01 % "Coffee [MONTHLY REPEAT 2 TIMES]"
+          Expenses:Restaurant    4.50 USD
+          Assets:Cash
+
+        2011-04-30 * "Lunch"
+          Expenses:Restaurant   12.00 USD
+          Assets:Cash
+        """
+        self.assertEqual(
+            [datetime.date(2011, month, 17) for month in range(3, 8)],
+            [
+                entry.date
+                for entry in entries
+                if getattr(entry, "narration", "") == "Dinner"
+            ],
+        )
+        # The cutoff drops occurrences of bounded recurrences too.
+        self.assertFalse(
+            [entry for entry in entries if getattr(entry, "narration", "") == "Coffee"]
+        )
+
+    def test_same_date_occurrences_keep_queue_order(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Restaurant
+            2011-01-01 open Expenses:Coffee
+            2011-01-01 open Assets:Cash
+
+            2011-05-03 % "Coffee [WEEKLY REPEAT 3 TIMES]"
+              Expenses:Coffee        4.50 USD
+              Assets:Cash
+
+            2011-05-17 % "Dinner [MONTHLY REPEAT 2 TIMES]"
+              Expenses:Restaurant   50.02 USD
+              Assets:Cash
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        entries, errors = dynamic_forecast.dynamic_forecast(
+            entries, options_map, "{ 'debug_sets': 'check_order' }"
+        )
+        self.assertFalse(errors)
+        generated = [
+            (entry.date.isoformat(), entry.narration)
+            for entry in entries
+            if isinstance(entry, data.Transaction)
+        ]
+        # Occurrences on the same date come out most recently queued first.
+        self.assertEqual(
+            [
+                ("2011-05-03", "Coffee"),
+                ("2011-05-10", "Coffee"),
+                ("2011-05-17", "Dinner"),
+                ("2011-05-17", "Coffee"),
+                ("2011-06-17", "Dinner"),
+            ],
+            generated,
+        )
+
+    def test_expression_cache(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Interest
+            2011-01-01 open Liabilities:Loan
+
+            2011-01-02 event "loan_rate" "0.12"
+
+            2011-05-01 % "Interest Charge [MONTHLY REPEAT 3 TIMES]"
+              bal_acc_loan:          "Liabilities:Loan"
+              event_int_rate:        "loan_rate"
+              expr_monthly_interest: "R(div(mul(gcu(loan,'USD'),D(int_rate)),D(12)),2)"
+              Expenses:Interest     0 USD
+                expr: "-monthly_interest"
+              Liabilities:Loan      0 USD
+                expr: "monthly_interest"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        dynamic_forecast.compile_expression.cache_clear()
+        entries, errors = dynamic_forecast.dynamic_forecast(entries, options_map, "{}")
+        self.assertFalse(errors)
+        # Three expressions, compiled once for the template, not per occurrence.
+        info = dynamic_forecast.compile_expression.cache_info()
+        self.assertEqual(3, info.misses)
+        self.assertEqual(0, info.hits)
+
+    def test_unsafe_expression_is_rejected(self):
+        template = data.Transaction(
+            data.new_metadata("<test>", 7, {"expr_x": "D(1).__class__"}),
+            datetime.date(2011, 1, 1),
+            "%",
+            None,
+            "Unsafe [MONTHLY REPEAT 1 TIME]",
+            None,
+            None,
+            [],
+        )
+        with self.assertRaisesRegex(expression.ExpressionError, "<test>:7"):
+            dynamic_forecast.compile_template(template)
+        for expr in ["__import__('os')", "[x for x in y]", "x.number", "D(1)(2)"]:
+            with self.assertRaises(expression.ExpressionError, msg=expr):
+                expression.compile_expression(expr, (), dynamic_forecast.OPERATIONS)
+
+    def test_occurrence_queue_is_lazy(self):
+        start = datetime.date(2011, 1, 1)
+        template = data.Transaction(
+            data.new_metadata("<test>", 0), start, "%", None, "", None, None, []
+        )
+        daily = dynamic_forecast.Occurrences(
+            template, "Daily", recurrence.DateRule(rrule.DAILY, start)
+        )
+        weekly = dynamic_forecast.Occurrences(
+            template, "Weekly", recurrence.DateRule(rrule.WEEKLY, start, count=2)
+        )
+        queue = dynamic_forecast.OccurrenceQueue(check_order=True)
+        queue.push(daily)
+        queue.push(weekly)
+        self.assertEqual(2, len(queue))
+        popped = [queue.pop() for _ in range(9)]
+        self.assertEqual(
+            ["Weekly"] + ["Daily"] * 7 + ["Weekly"],
+            [occurrence.template.narration for occurrence in popped],
+        )
+        # The unbounded daily stream is only read as far as the merge needs.
+        self.assertEqual(1, len(queue))
+        self.assertEqual(datetime.date(2011, 1, 9), next(daily).date)
+
+    def test_batch_evaluation_is_bounded_by_window(self):
+        (template,), errors, _ = parser.parse_string(
+            textwrap.dedent(
+                """
+                2011-01-01 % "Daily [DAILY]"
+                  expr_pay:  "A(D('1.00'),'USD') if date else A(D('0'),'USD')"
+                  Assets:Bank                        0 USD
+                    expr: "pay"
+                """
+            )
+        )
+        self.assertFalse(errors)
+        # An unbounded recurrence of a template reading `date`: every
+        # occurrence is evaluated on its own, up front up to the horizon and
+        # after it only when it is pulled.
+        occurrences = dynamic_forecast.EvaluatedOccurrences(
+            template,
+            "Daily",
+            recurrence.DateRule(rrule.DAILY, template.date),
+            EventTimeline([]),
+            window=recurrence.Window(horizon=datetime.date(2011, 1, 5)),
+        )
+        profile = Profile()
+        occurrences.evaluate(profile)
+        # Two expressions each: `pay` and the posting's.
+        self.assertEqual(10, profile.counters["expressions"])
+        self.assertEqual(
+            [datetime.date(2011, 1, day) for day in range(1, 8)],
+            [next(occurrences).template.entry.date for _ in range(7)],
+        )
+        self.assertEqual(14, profile.counters["expressions"])
+
+    def test_profile_report(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Interest
+            2011-01-01 open Liabilities:Loan
+
+            2011-01-02 event "loan_rate" "0.12"
+
+            2011-05-01 % "Interest Charge [MONTHLY REPEAT 3 TIMES]"
+              bal_acc_loan:          "Liabilities:Loan"
+              event_int_rate:        "loan_rate"
+              expr_monthly_interest: "R(div(mul(gcu(loan,'USD'),D(int_rate)),D(12)),2)"
+              Expenses:Interest     0 USD
+                expr: "-monthly_interest"
+              Liabilities:Loan      0 USD
+                expr: "monthly_interest"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                dynamic_forecast.dynamic_forecast(entries, options_map, "{'profile': True}")
+                with open("dynamic_forecast.profile.json") as infile:
+                    report = json.load(infile)
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(
+            {"templates": 1, "occurrences": 3, "expressions": 9, "balance_lookups": 3},
+            report["counters"],
+        )
+        self.assertLessEqual(
+            {"balance_sources", "get_accounts", "tracked_accounts", "recurrence", "queue"},
+            set(report["phases"]),
+        )
+
+    def test_checkpoint_resume(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Equity:Opening-Balances
+            2011-01-01 open Expenses:Fees
+            2011-01-01 open Assets:Bank
+
+            2011-01-02 * "Opening Position"
+              Equity:Opening-Balances
+              Assets:Bank                        1000.00 USD
+
+            2011-01-03 event "fee_rate" "0.01"
+
+            2011-02-01 % "Fee [MONTHLY REPEAT 6 TIMES]"
+              bal_acc_bank:  "Assets:Bank"
+              event_rate:    "fee_rate"
+              expr_fee:      "R(mul(gcu(bank,'USD'),D(rate)),2)"
+              Expenses:Fees                      0 USD
+                expr: "fee"
+              Assets:Bank                        0 USD
+                expr: "-fee"
+
+            2011-03-15 * "Bonus"
+              Equity:Opening-Balances
+              Assets:Bank                         100.00 USD
+
+            2011-05-15 * "Deposit"
+              Equity:Opening-Balances
+              Assets:Bank                         100.00 USD
+        """
+        )
+        changed_text = input_text.replace("100.00 USD", "200.00 USD", 1)
+
+        def run(text, config):
+            entries, errors, options_map = parser.parse_string(text)
+            self.assertFalse(errors)
+            entries, errors = dynamic_forecast.dynamic_forecast(
+                entries, options_map, config
+            )
+            self.assertFalse(errors)
+            with open("dynamic_forecast.profile.json") as infile:
+                return entries, json.load(infile)["counters"]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                config = "{'profile': True, 'checkpoint': 'forecast.ckpt'}"
+                expected, _ = run(input_text, "{'profile': True}")
+                first, counters = run(input_text, config)
+                self.assertNotIn("resumed_entries", counters)
+                second, counters = run(input_text, config)
+                # Resumed before the May deposit, with the March fee already computed.
+                self.assertEqual(7, counters["resumed_entries"])
+                self.assertEqual(4, counters["occurrences"])
+                self.assertEqual(expected, first)
+                self.assertEqual(expected, second)
+
+                # Changing the March deposit invalidates the checkpoints after it.
+                expected, _ = run(changed_text, "{'profile': True}")
+                changed, counters = run(changed_text, config)
+                self.assertEqual(6, counters["resumed_entries"])
+                self.assertEqual(expected, changed)
+
+                # Accounts and events after the checkpoint are picked up on resume.
+                appended_text = changed_text + textwrap.dedent(
+                    """
+                    2011-05-20 open Assets:Bank:Savings
+
+                    2011-05-20 * "Save"
+                      Equity:Opening-Balances
+                      Assets:Bank:Savings                  500.00 USD
+
+                    2011-05-20 event "fee_rate" "0.02"
+                    """
+                )
+                expected, _ = run(appended_text, "{'profile': True}")
+                appended, counters = run(appended_text, config)
+                self.assertEqual(7, counters["resumed_entries"])
+                self.assertEqual(expected, appended)
+            finally:
+                os.chdir(cwd)
+
+    def test_checkpoint_resume_relative_window(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Income:Job
+            2011-01-01 open Expenses:Fees
+            2011-01-01 open Assets:Bank
+
+            2011-01-01 event "fee_rate" "0.01"
+
+            2011-01-05 % "Fee [MONTHLY]"
+              bal_acc_bank:  "Assets:Bank"
+              event_rate:    "fee_rate"
+              expr_fee:      "R(mul(gcu(bank,'USD'),D(rate)),2)"
+              Expenses:Fees                      0 USD
+                expr: "fee"
+              Assets:Bank                        0 USD
+                expr: "-fee"
+        """
+        )
+        for month in range(1, 8):
+            input_text += textwrap.dedent(
+                f"""
+                2011-{month:02d}-15 * "Pay"
+                  Income:Job                        -100.00 USD
+                  Assets:Bank                        100.00 USD
+                """
+            )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        # Appending the July pay moves the horizon and the cutoff on by a month.
+        appended, entries = entries, entries[:-1]
+
+        def run(entries, config):
+            entries, errors = dynamic_forecast.dynamic_forecast(
+                list(entries), options_map, config
+            )
+            self.assertFalse(errors)
+            with open("dynamic_forecast.profile.json") as infile:
+                return entries, json.load(infile)["counters"]
+
+        def index(date):
+            return next(i for i, entry in enumerate(appended) if entry.date == date)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                for window, resumed in [
+                    ({"horizon": "2 MONTHS"}, datetime.date(2011, 6, 15)),
+                    # Only the checkpoints before the old cutoff carry on.
+                    ({"horizon": "2 MONTHS", "cutoff": 60}, datetime.date(2011, 4, 15)),
+                ]:
+                    with self.subTest(**window):
+                        checkpoint = "-".join(window) + ".ckpt"
+                        config = {"profile": True, "checkpoint": checkpoint, **window}
+                        run(entries, repr(config))
+                        expected, _ = run(appended, repr({"profile": True, **window}))
+                        forecast, counters = run(appended, repr(config))
+                        self.assertEqual(index(resumed), counters["resumed_entries"])
+                        self.assertEqual(expected, forecast)
+            finally:
+                os.chdir(cwd)
+
+    def test_checkpoint_resume_reevaluates_queued_batch(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Equity:Opening-Balances
+            2011-01-01 open Income:Salary
+            2011-01-01 open Assets:Bank
+
+            2011-01-01 event "salary" "1200.00"
+
+            2011-01-10 % "Salary [MONTHLY REPEAT 6 TIMES]"
+              event_salary:  "salary"
+              expr_pay:      "D(salary)"
+              Income:Salary                      0 USD
+                expr: "A(-pay,'USD')"
+              Assets:Bank                        0 USD
+                expr: "A(pay,'USD')"
+
+            2011-03-25 * "Deposit"
+              Equity:Opening-Balances
+              Assets:Bank                         100.00 USD
+
+            2011-04-05 * "Deposit"
+              Equity:Opening-Balances
+              Assets:Bank                         100.00 USD
+
+            2011-04-07 event "salary" "1300.00"
+        """
+        )
+        # The April salary is queued, and evaluated, by the checkpoint on 2011-04-05.
+        changed_text = input_text.replace('"1300.00"', '"1500.00"')
+
+        def salaries(text, config):
+            entries, errors, options_map = parser.parse_string(text)
+            self.assertFalse(errors)
+            entries, errors = dynamic_forecast.dynamic_forecast(
+                entries, options_map, config
+            )
+            self.assertFalse(errors)
+            return [
+                (entry.date, entry.postings[1].units.number)
+                for entry in entries
+                if isinstance(entry, data.Transaction) and entry.narration == "Salary"
+            ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = repr({"checkpoint": os.path.join(tmpdir, "forecast.ckpt")})
+            salaries(input_text, config)
+            resumed = salaries(changed_text, config)
+        self.assertEqual(salaries(changed_text, "{}"), resumed)
+        self.assertEqual((datetime.date(2011, 4, 10), D("1500.00")), resumed[3])
+
+    def test_scenarios_reevaluate_queued_batch(self):
+        input_text = textwrap.dedent(
+            """
+            2010-12-01 open Income:Salary
+            2010-12-01 open Expenses:Interest
+            2010-12-01 open Liabilities:Loan
+            2010-12-01 open Assets:Bank
+
+            2010-12-01 % "Salary [MONTHLY REPEAT 3 TIMES]"
+              event_salary:  "salary"
+              Income:Salary                      0 USD
+                expr: "A(-D(salary),'USD')"
+              Assets:Bank                        0 USD
+                expr: "A(D(salary),'USD')"
+
+            2010-12-01 % "Repayment [MONTHLY REPEAT 3 TIMES]"
+              loan_principal:  1200.00 USD
+              loan_rate:       "loan_rate"
+              Expenses:Interest                  0 USD
+                loan: "interest"
+              Liabilities:Loan                   0 USD
+                loan: "principal"
+              Assets:Bank                        0 USD
+                loan: "-payment"
+
+            2010-12-01 event "salary" "1000.00"
+            2010-12-01 event "loan_rate" "0.12"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        # The templates are queued, with their first occurrences, before the
+        # overridden events.
+        config = """{'scenarios': {'raise': {'salary': '5000.00', 'loan_rate': '0.24'}},
+                     'workers': 1}"""
+        scenarios = dynamic_forecast.forecast_scenarios(entries, options_map, config)
+        self.assertEqual(
+            [D("5000.00")] * 3,
+            [
+                entry.postings[1].units.number
+                for entry in scenarios["raise"]
+                if isinstance(entry, data.Transaction) and entry.narration == "Salary"
+            ],
+        )
+        self.assertEqual(
+            D("24.00"),
+            next(
+                entry.postings[0].units.number
+                for entry in scenarios["raise"]
+                if isinstance(entry, data.Transaction) and entry.narration == "Repayment"
+            ),
+        )
+
+    def test_scenarios(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Equity:Opening-Balances
+            2011-01-01 open Expenses:Interest
+            2011-01-01 open Liabilities:Loan
+
+            2011-01-02 * "Opening Position"
+              Equity:Opening-Balances
+              Liabilities:Loan                  -1000.00 USD
+
+            2011-02-01 event "loan_rate" "0.12"
+
+            2011-05-01 % "Interest Charge [MONTHLY REPEAT 2 TIMES]"
+              bal_acc_loan:          "Liabilities:Loan"
+              event_int_rate:        "loan_rate"
+              expr_monthly_interest: "R(div(mul(gcu(loan,'USD'),D(int_rate)),D(12)),2)"
+              Expenses:Interest     0 USD
+                expr: "-monthly_interest"
+              Liabilities:Loan      0 USD
+                expr: "monthly_interest"
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        config = "{'scenarios': {'high': {'loan_rate': '0.24'}}, 'workers': 1}"
+
+        def interest(entries, tag=None, account="Expenses:Interest"):
+            return [
+                posting.units
+                for entry in entries
+                if isinstance(entry, data.Transaction)
+                and entry.flag == "%"
+                and (tag in entry.tags if tag else not entry.tags)
+                for posting in entry.postings
+                if posting.account == account
+            ]
+
+        USD = lambda number: amount.Amount(D(number), "USD")
+        forecast, errors = dynamic_forecast.dynamic_forecast(entries, options_map, config)
+        self.assertFalse(errors)
+        self.assertEqual([USD("10.00"), USD("10.10")], interest(forecast))
+        # The scenario posts to its own copies of the accounts.
+        self.assertEqual([], interest(forecast, "scenario-high"))
+        self.assertEqual(
+            [USD("20.00"), USD("20.40")],
+            interest(forecast, "scenario-high", "Expenses:Scenario-high:Interest"),
+        )
+        self.assertEqual(
+            ["Expenses:Scenario-high:Interest", "Liabilities:Scenario-high:Loan"],
+            [entry.account for entry in forecast[:2] if isinstance(entry, data.Open)],
+        )
+        # The scenario's occurrences go in at their dates, after the forecast's.
+        self.assertEqual(
+            [
+                (datetime.date(2011, 5, 1), frozenset()),
+                (datetime.date(2011, 5, 1), {"scenario-high"}),
+                (datetime.date(2011, 6, 1), frozenset()),
+                (datetime.date(2011, 6, 1), {"scenario-high"}),
+            ],
+            [(entry.date, entry.tags) for entry in forecast[-4:]],
+        )
+
+        scenarios = dynamic_forecast.forecast_scenarios(entries, options_map, config)
+        self.assertEqual(["high"], list(scenarios))
+        self.assertEqual([USD("20.00"), USD("20.40")], interest(scenarios["high"]))
+        self.assertEqual(len(forecast) - 4, len(scenarios["high"]))
+
+        # The regular forecast's balances are left as they are.
+        _, errors, _ = loader.load_string(
+            f'plugin "beancount_muonzoo_plugins.dynamic_forecast" "{config}"\n'
+            + input_text
+            + textwrap.dedent(
+                """
+                2011-07-01 balance Liabilities:Loan                -1020.10 USD
+                2011-07-01 balance Liabilities:Scenario-high:Loan    -40.40 USD
+                """
+            )
+        )
+        self.assertFalse(errors)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -45,22 +45,42 @@ Other examples:
     2014-03-08 # "Electricity bill [DAILY SKIP 3 TIMES REPEAT 1 TIME]"
       Expenses:Electricity 			50.10 USD
       Assets:Checking			       -50.10 USD
+
+Without a limit transactions are created up to the end of the current year,
+so the output changes with the date it is run on. A configuration fixes the
+horizon instead, as a date or relative to the last date of the ledger (its
+last entry other than a forecast), and can drop the occurrences more than a
+number of days older than that last date:
+
+    plugin "beancount_muonzoo_plugins.forecast" "{'horizon': '18 MONTHS', 'cutoff': 90}"
 """
 
 __copyright__ = "Copyright (C) 2014-2017  Martin Blais"
 __license__ = "GNU GPLv2"
 
-import datetime
-import re
-
-from dateutil import rrule
+import bisect
+import collections
+import heapq
+import operator
 
 from beancount.core import data
 
+from beancount_muonzoo_plugins.util.occurrence import Occurrence, Template
+from beancount_muonzoo_plugins.util.parse_config_string import parse as parse_config_string
+from beancount_muonzoo_plugins.util.recurrence import (
+    forecast_window,
+    has_recurrence,
+    parse_recurrence,
+)
+
 __plugins__ = ("forecast_plugin",)
 
+ForecastError = collections.namedtuple("ForecastError", "source message entry")
+
+_date = operator.attrgetter("date")
 
-def forecast_plugin(entries, options_map):
+
+def forecast_plugin(entries, options_map, config_string=""):
     """An example filter that piggybacks on top of the Beancount input syntax to
     insert forecast entries automatically. This functions accepts the return
     value of beancount.loader.load_file() and must return the same type of output.
@@ -68,73 +88,87 @@ def forecast_plugin(entries, options_map):
     Args:
       entries: a list of entry instances
       options_map: a dict of options parsed from the file
+      config_string: an optional dict as str:
+        horizon : the end of recurrences without REPEAT or UNTIL, a date
+          (yyyy-mm-dd) or `N DAYS|WEEKS|MONTHS|YEARS` after the last date of
+          the ledger (default: the end of the current year)
+        cutoff : drop the occurrences more than this many days before the
+          last date of the ledger
     Returns:
       A tuple of entries and errors.
     """
 
-    # Filter out forecast entries from the list of valid entries.
-    forecast_entries = []
-    filtered_entries = []
-    for entry in entries:
-        outlist = (
-            forecast_entries
-            if (isinstance(entry, data.Transaction) and entry.flag == "#")
-            else filtered_entries
-        )
-        outlist.append(entry)
-
-    # Generate forecast entries up to the end of the current year.
-    new_entries = []
-    for entry in forecast_entries:
-        # Parse the periodicity.
-        match = re.search(
-            r"(^.*)\[(MONTHLY|YEARLY|WEEKLY|DAILY)"
-            r"(\s+SKIP\s+([1-9][0-9]*)\s+TIME.?)"
-            r"?(\s+REPEAT\s+([1-9][0-9]*)\s+TIME.?)"
-            r"?(\s+UNTIL\s+([0-9\-]+))?\]",
-            entry.narration,
-        )
-        if not match:
-            new_entries.append(entry)
+    config = parse_config_string(config_string)
+    window = forecast_window(
+        entries, is_template, config.get("horizon"), config.get("cutoff")
+    )
+
+    # Pick out the forecast templates; everything else passes through.
+    templates = [index for index, entry in enumerate(entries) if is_template(entry)]
+
+    # A template with an invalid spec is reported and generates nothing.
+    streams = []
+    errors = []
+    for index in templates:
+        entry = entries[index]
+        try:
+            recurrence = parse_recurrence(entry.narration)
+        except ValueError as exc:
+            errors.append(ForecastError(entry.meta, str(exc), entry))
             continue
-        forecast_narration = match.group(1).strip()
-        forecast_interval = (
-            rrule.YEARLY
-            if match.group(2).strip() == "YEARLY"
-            else rrule.WEEKLY
-            if match.group(2).strip() == "WEEKLY"
-            else rrule.DAILY
-            if match.group(2).strip() == "DAILY"
-            else rrule.MONTHLY
-        )
-        forecast_periodicity = {"dtstart": entry.date}
-        if match.group(6):  # e.g., [MONTHLY REPEAT 3 TIMES]:
-            forecast_periodicity["count"] = int(match.group(6))
-        elif match.group(8):  # e.g., [MONTHLY UNTIL 2020-01-01]:
-            forecast_periodicity["until"] = datetime.datetime.strptime(
-                match.group(8), "%Y-%m-%d"
-            ).date()
-        else:
-            # e.g., [MONTHLY]
-            forecast_periodicity["until"] = datetime.date(
-                datetime.date.today().year, 12, 31
-            )
+        streams.append(occurrences(entry, recurrence, window))
+
+    # Each template's occurrences are in date order: merge them, then merge
+    # the result into the (sorted) entries rather than sorting everything.
+    forecasts = heapq.merge(*streams, key=Occurrence.sortkey)
+    return (merge_sorted(entries, templates, forecasts), errors)
+
+
+def merge_sorted(entries, skipped, forecasts):
+    """Merge the sorted `Occurrence` forecasts into the sorted `entries`, leaving out the indexes `skipped`.
 
-        if match.group(4):
-            # SKIP
-            forecast_periodicity["interval"] = int(match.group(4)) + 1
-
-        # Generate a new entry for each forecast date.
-        forecast_dates = [
-            dt.date() for dt in rrule.rrule(forecast_interval, **forecast_periodicity)
-        ]
-        for forecast_date in forecast_dates:
-            forecast_entry = entry._replace(
-                date=forecast_date, narration=forecast_narration
+    The runs of entries between forecasts are found by bisection and copied
+    as slices, so the cost is in the number of forecasts, not of entries.
+    """
+    merged = []
+    start = 0
+    skipped = iter(skipped)
+    next_skipped = next(skipped, len(entries))
+
+    def copy_to(stop):
+        nonlocal start, next_skipped
+        while next_skipped < stop:
+            merged.extend(entries[start:next_skipped])
+            start = next_skipped + 1
+            next_skipped = next(skipped, len(entries))
+        merged.extend(entries[start:stop])
+        start = stop
+
+    for forecast in forecasts:
+        # Find the entries on the forecast's date first, comparing dates only.
+        lo = bisect.bisect_left(entries, forecast.date, lo=start, key=_date)
+        hi = bisect.bisect_right(entries, forecast.date, lo=lo, key=_date)
+        copy_to(
+            bisect.bisect_right(
+                entries, forecast.sortkey(), lo=lo, hi=hi, key=data.entry_sortkey
             )
-            new_entries.append(forecast_entry)
+        )
+        merged.append(forecast.materialize())
+    copy_to(len(entries))
+    return merged
+
+
+def is_template(entry):
+    """True for a forecast transaction with a recurrence; it is replaced by its occurrences."""
+    return (
+        isinstance(entry, data.Transaction)
+        and entry.flag == "#"
+        and has_recurrence(entry.narration)
+    )
 
-    # Make sure the new entries inserted are sorted.
-    new_entries.sort(key=data.entry_sortkey)
 
-    return (filtered_entries + new_entries, [])
+def occurrences(entry, recurrence, window):
+    """Yield an `Occurrence` for each date of the `recurrence` of the template `entry` in `window`, in date order."""
+    template = Template(entry, recurrence.narration)
+    for date in window.dates(recurrence.dates(entry.date, window.horizon)):
+        yield template.occurrence(date)
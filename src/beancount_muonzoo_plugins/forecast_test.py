@@ -1,11 +1,16 @@
 __copyright__ = "Copyright (C) 2014-2017  Martin Blais"
 __license__ = "GNU GPLv2"
 
+import datetime
 import textwrap
 import unittest
 
 from beancount import loader
+from beancount.core import data
 from beancount.parser import cmptest
+from beancount.parser import parser
+
+from beancount_muonzoo_plugins import forecast
 
 
 class TestExampleForecast(cmptest.TestCase):
@@ -66,6 +71,129 @@ class TestExampleForecast(cmptest.TestCase):
             entries,
         )
 
+    def test_output_is_merged_in_order(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Restaurant
+            2011-01-01 open Expenses:Coffee
+            2011-01-01 open Assets:Cash
+
+            2011-05-03 # "Coffee [WEEKLY REPEAT 3 TIMES]"
+              Expenses:Coffee        4.50 USD
+              Assets:Cash           -4.50 USD
+
+            2011-05-10 * "Lunch"
+              Expenses:Restaurant   12.00 USD
+              Assets:Cash          -12.00 USD
+
+            2011-05-01 # "Dinner [WEEKLY REPEAT 3 TIMES]"
+              Expenses:Restaurant   50.02 USD
+              Assets:Cash          -50.02 USD
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        entries.sort(key=data.entry_sortkey)
+        # Called directly, without the loader sorting the result again.
+        entries, errors = forecast.forecast_plugin(entries, options_map)
+        self.assertFalse(errors)
+        self.assertEqual(sorted(entries, key=data.entry_sortkey), entries)
+        self.assertEqual(
+            ["Dinner", "Coffee", "Dinner", "Coffee", "Lunch", "Dinner", "Coffee"],
+            [entry.narration for entry in entries if isinstance(entry, data.Transaction)],
+        )
+
+    def test_horizon_and_cutoff(self):
+        input_text = textwrap.dedent(
+            """
+            plugin "beancount_muonzoo_plugins.forecast" "{'horizon': '3 MONTHS', 'cutoff': 45}"
+            2011-01-01 open Expenses:Restaurant
+            2011-01-01 open Assets:Cash
+
+            2011-01-17 # "Dinner [MONTHLY]"
+              Expenses:Restaurant   50.02 USD
+              Assets:Cash
+
+            2011-04-30 * "Lunch"
+              Expenses:Restaurant   12.00 USD
+              Assets:Cash
+        """
+        )
+        entries, errors, __ = loader.load_string(input_text)
+        self.assertFalse(errors)
+        # From 45 days before the last entry to 3 months after it, whatever the date today.
+        self.assertEqual(
+            [
+                datetime.date(2011, 3, 17),
+                datetime.date(2011, 4, 17),
+                datetime.date(2011, 5, 17),
+                datetime.date(2011, 6, 17),
+                datetime.date(2011, 7, 17),
+            ],
+            [
+                entry.date
+                for entry in entries
+                if getattr(entry, "narration", "") == "Dinner"
+            ],
+        )
+
+    def test_on_last_business_day(self):
+        input_text = textwrap.dedent(
+            """
+            plugin "beancount_muonzoo_plugins.forecast"
+            2011-01-01 open Expenses:Rent
+            2011-01-01 open Assets:Cash
+
+            2011-03-01 # "Rent [MONTHLY ON LAST BUSINESS DAY REPEAT 3 TIMES]"
+              Expenses:Rent   900.00 USD
+              Assets:Cash
+        """
+        )
+        entries, errors, __ = loader.load_string(input_text)
+        self.assertFalse(errors)
+        # 2011-04-30 is a Saturday.
+        self.assertEqual(
+            [
+                datetime.date(2011, 3, 31),
+                datetime.date(2011, 4, 29),
+                datetime.date(2011, 5, 31),
+            ],
+            [entry.date for entry in entries if isinstance(entry, data.Transaction)],
+        )
+
+    def test_invalid_recurrence_is_reported(self):
+        input_text = textwrap.dedent(
+            """
+            2011-01-01 open Expenses:Restaurant
+            2011-01-01 open Assets:Cash
+
+            2011-01-04 # "Lunch [DAILY ON LAST FRI REPEAT 2 TIMES]"
+              Expenses:Restaurant   12.00 USD
+              Assets:Cash
+
+            2011-02-01 # "Coffee [MONTHLY REPEAT 2 TIMES]"
+              Expenses:Restaurant    4.50 USD
+              Assets:Cash
+        """
+        )
+        entries, errors, options_map = parser.parse_string(input_text)
+        self.assertFalse(errors)
+        entries, errors = forecast.forecast_plugin(entries, options_map)
+        # Only the bad template is dropped.
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], forecast.ForecastError)
+        self.assertEqual(
+            "Lunch [DAILY ON LAST FRI REPEAT 2 TIMES]", errors[0].entry.narration
+        )
+        self.assertEqual(
+            [("Coffee", datetime.date(2011, 2, 1)), ("Coffee", datetime.date(2011, 3, 1))],
+            [
+                (entry.narration, entry.date)
+                for entry in entries
+                if isinstance(entry, data.Transaction)
+            ],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
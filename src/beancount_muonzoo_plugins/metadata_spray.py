@@ -3,6 +3,8 @@
 import collections
 import re
 
+from typing import Dict, List, NamedTuple, Optional
+
 from beancount.core import data
 from beancount.core import getters
 
@@ -37,6 +39,59 @@ def _invert_dict(d: dict) -> dict:
     return newdict
 
 
+class MapMatcher(NamedTuple):
+    """The keys of one inverted map, compiled once to classify captured group values."""
+
+    literals: Dict[str, str]
+    """ The inverted map itself, for exact lookups of a group value. """
+
+    pattern: Optional[re.Pattern]
+    """ All the keys in one alternation, last key first, or None if they can't be combined. """
+
+    values: List[str]
+    """ The value of each branch of `pattern`, or of each key of `patterns`, last key first. """
+
+    patterns: List[re.Pattern]
+    """ The compiled keys, last key first, when `pattern` is None. """
+
+    def match(self, group_value: str) -> Optional[str]:
+        """The value of `group_value`'s key: an exact match, or else the last key matching it as a regex."""
+        value = self.literals.get(group_value)
+        if value is not None:
+            return value
+        if self.pattern is not None:
+            rem = self.pattern.match(group_value)
+            return None if rem is None else self.values[rem.lastindex - 1]
+        for index, pat in enumerate(self.patterns):
+            if pat.match(group_value):
+                return self.values[index]
+        return None
+
+
+def compile_map(inverted: dict) -> MapMatcher:
+    """Compile the keys of an inverted map into a `MapMatcher`."""
+    keys, patterns = [], []
+    for key in reversed(inverted):
+        try:
+            patterns.append(re.compile(key))
+        except re.error:
+            # Not a regex, e.g. `C++`: only ever matched exactly.
+            continue
+        keys.append(key)
+    values = [inverted[key] for key in keys]
+    # One alternation tries the keys in order and stops at the first that
+    # matches, the last one in the map. Keys with groups of their own would
+    # shift the branch numbers, so those maps keep a list of patterns.
+    if keys and not any(pat.groups for pat in patterns):
+        try:
+            pattern = re.compile("|".join(f"({key})" for key in keys))
+        except re.error:
+            pattern = None
+        else:
+            return MapMatcher(inverted, pattern, values, [])
+    return MapMatcher(inverted, None, values, patterns)
+
+
 def metadata_spray(entry, replace_type, metadata_dict):
     errors = []
     entry_meta = entry[0].meta
@@ -63,110 +118,159 @@ def metadata_spray(entry, replace_type, metadata_dict):
     return entry_meta, errors
 
 
-def metadata_spray_account_open(
-    entries, replace_type, pattern, metadata_dict, maps=None, debug=False
-):
-    errors = []
-    account_entries = getters.get_account_open_close(entries)
-    regexer = re.compile(pattern)
+class Spray(NamedTuple):
+    """An `account_open` spray of the configuration, with its pattern compiled."""
 
-    inverted_map = {k: _invert_dict(v) for k, v in maps.items()}
-    if debug:
-        print(f";; {maps=}\n;;\n;; {inverted_map=}")
-    if debug:
-        print(f";; {metadata_dict=}")
+    replace_type: str
+    """ One of `MetadataSprayReplaceType`. """
+
+    regexer: re.Pattern
+    """ The account pattern; its named groups fill in `metadata_dict` and select map values. """
+
+    metadata_dict: dict
+    """ The metadata to spray, as `str.format` templates of the pattern's groups. """
+
+
+def _map_groups(groups, matchers, account_, debug=False):
+    map_dict = dict()
+    for group_name, group_value in groups.items():
+        if debug:
+            print(f";; {group_name=} {group_value=} {account_=}")
+        if group_name in matchers and group_value is not None:
+            map_value = matchers[group_name].match(group_value)
+            if map_value is not None:
+                map_dict[_metaid(group_name)] = map_value
+    return map_dict
+
+
+def spray_account_opens(entries, sprays, matchers, debug=False):
+    """
+    Apply all `sprays` to the Open entries of `entries` in one pass.
+
+    Each account's Open gets the sprays matching it in order, each with its
+    own `replace_type`, and is then rebuilt once. Returns the entries and a
+    list of the errors of each spray.
+    """
+    errors = [[] for _ in sprays]
+    account_entries = getters.get_account_open_close(entries)
+    # Position of each entry by identity, so replacing an Open doesn't scan the ledger.
+    positions = None
 
-    for account_ in account_entries:
+    for account_, entry in account_entries.items():
         # Only operate on account Open entries
-        entry = account_entries[account_]
-        if getattr(entry[0].__class__, "__name__") != "Open":
+        if not isinstance(entry[0], data.Open):
             continue
-        rem = regexer.match(account_)
-        if rem:
+        sprayed = False
+        for spray, spray_errors in zip(sprays, errors):
+            rem = spray.regexer.match(account_)
+            if not rem:
+                continue
             g = rem.groupdict()
-            map_dict = dict()
-            for group_name, group_value in g.items():
-                if debug:
-                    print(f";; {group_name=} {group_value=} {account_=}")
-                if group_name in inverted_map:
-                    if group_value in inverted_map[group_name]:
-                        map_dict[_metaid(group_name)] = inverted_map[group_name].get(
-                            group_value
-                        )
-                    else:
-                        for pat in inverted_map[group_name]:
-                            if debug:
-                                print(f";; {group_value=} {pat=}")
-                            if re.match(pat, group_value):
-                                map_dict[_metaid(group_name)] = inverted_map[
-                                    group_name
-                                ].get(pat)
-
-            spray_meta, spray_errors = metadata_spray(
+            _, new_errors = metadata_spray(
                 entry,
-                replace_type,
-                {k: v.format(**g) for k, v in metadata_dict.items()} | map_dict,
+                spray.replace_type,
+                {k: v.format(**g) for k, v in spray.metadata_dict.items()}
+                | _map_groups(g, matchers, account_, debug),
             )
-            spray_entry = data.Open(spray_meta, entry[0].date, entry[0].account, None, None)
+            spray_errors += new_errors
+            sprayed = True
+
+        if sprayed:
+            if positions is None:
+                positions = {id(entry): index for index, entry in enumerate(entries)}
+            # The sprays updated the metadata of the Open in place.
+            spray_entry = data.Open(entry[0].meta, entry[0].date, account_, None, None)
+            entries[positions[id(entry[0])]] = spray_entry
+
+    return entries, errors
 
-            # Modify entries and update errors
-            entry_index = entries.index(entry[0])
-            entries[entry_index] = spray_entry
-            errors += spray_errors
 
+def compile_maps(maps) -> dict:
+    """A `MapMatcher` for each group name of `maps`."""
+    return {k: compile_map(_invert_dict(v)) for k, v in (maps or {}).items()}
+
+
+def metadata_spray_account_open(
+    entries, replace_type, pattern, metadata_dict, maps=None, debug=False
+):
+    if debug:
+        print(f";; {maps=}\n;;\n;; {metadata_dict=}")
+    entries, (errors,) = spray_account_opens(
+        entries,
+        [Spray(replace_type, re.compile(pattern), metadata_dict)],
+        compile_maps(maps),
+        debug,
+    )
     return entries, errors
 
 
 def metadata_spray_entries(entries, options_map, config_str):
     """
-    Insert metadata on
-    """
-    errors = []
+    Insert metadata on the Open entries of accounts matching the configured sprays.
 
+    All the sprays are applied in a single pass over the accounts, in the
+    order they are configured.
+    """
     config_obj = eval(config_str, {}, {})
     sprays = config_obj["sprays"]
     maps = config_obj["maps"]
 
+    # The errors of each configured spray, in order: its own if it is invalid,
+    # else those of spraying it.
+    errors = []
+    plan = []
     for spray in sprays:
         if ("spray_type" not in spray) or ("replace_type" not in spray):
             errors.append(
-                MetadataSprayError(
-                    metadata_spray_error_meta,
-                    "Missing spray or replace type, \
+                [
+                    MetadataSprayError(
+                        metadata_spray_error_meta,
+                        "Missing spray or replace type, \
                     skipping this spray operation",
-                    None,
-                )
+                        None,
+                    )
+                ]
             )
             continue
 
         spray_type = spray["spray_type"]
         if spray_type not in MetadataSprayTypes:
             errors.append(
-                MetadataSprayError(
-                    metadata_spray_error_meta,
-                    "Invalid spray type: {} \
+                [
+                    MetadataSprayError(
+                        metadata_spray_error_meta,
+                        "Invalid spray type: {} \
                                 skipping this spray operation".format(spray_type),
-                    None,
-                )
+                        None,
+                    )
+                ]
             )
             continue
 
         replace_type = spray["replace_type"]
         if replace_type not in MetadataSprayReplaceType:
             errors.append(
-                MetadataSprayError(
-                    metadata_spray_error_meta,
-                    "Invalid spray type: {} \
+                [
+                    MetadataSprayError(
+                        metadata_spray_error_meta,
+                        "Invalid spray type: {} \
                                 skipping this spray operation".format(spray_type),
-                    None,
-                )
+                        None,
+                    )
+                ]
             )
             continue
 
         if spray_type == "account_open":
-            entries, new_errors = metadata_spray_account_open(
-                entries, replace_type, spray["pattern"], spray["metadata_dict"], maps
+            plan.append(
+                Spray(replace_type, re.compile(spray["pattern"]), spray["metadata_dict"])
             )
-            errors += new_errors
+            errors.append(None)
 
-    return entries, errors
+    entries, spray_errors = spray_account_opens(entries, plan, compile_maps(maps))
+    spray_errors = iter(spray_errors)
+    return entries, [
+        error
+        for own_errors in errors
+        for error in (next(spray_errors) if own_errors is None else own_errors)
+    ]
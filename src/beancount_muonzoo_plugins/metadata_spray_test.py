@@ -1,11 +1,16 @@
 # metadata_sprayer_test
 
+import datetime
+
 from beancount import loader
+from beancount.core import data
 from beancount.core import getters
 
 import unittest
 import pytest
 
+from beancount_muonzoo_plugins import metadata_spray
+
 
 class TestMetadataSpray(unittest.TestCase):
     @pytest.mark.skip(reason="Unimplemented old test")
@@ -165,3 +170,162 @@ class TestMetadataSpray(unittest.TestCase):
         self.assertEqual(
             account_entries["Assets:OtherBrokerage:HOOLI"][0].meta["portfolio"], "tech"
         )
+
+    @loader.load_doc(expect_errors=False)
+    def test_metadata_spray_replaces_open_in_place(self, entries, errors, options_map):
+        """
+        plugin "beancount_muonzoo_plugins.metadata_spray" "{
+            'sprays': [{ 'spray_type': 'account_open',
+                         'replace_type': 'return_error',
+                         'pattern': 'Assets:(?P<broker>[A-Za-z]+):.*',
+                         'metadata_dict': {'portfolio': '{broker}'}
+                         }],
+            'maps': {}
+            }"
+
+        2018-10-20 open Assets:Cash
+        2018-10-20 open Equity:Opening
+
+        2018-10-21 * "Deposit"
+          Assets:Cash        100 USD
+          Equity:Opening
+
+        2018-10-22 open Assets:MyBrokerage:HOOLI
+        2018-10-23 open Assets:OtherBrokerage:HOOLI
+
+        """
+        opens = [entry for entry in entries if isinstance(entry, data.Open)]
+        self.assertEqual(4, len(opens))
+        self.assertEqual(
+            ["MyBrokerage", "OtherBrokerage"],
+            [entry.meta["portfolio"] for entry in opens if "portfolio" in entry.meta],
+        )
+        self.assertEqual(
+            datetime.date(2018, 10, 22),
+            getters.get_account_open_close(entries)["Assets:MyBrokerage:HOOLI"][0].date,
+        )
+
+    @loader.load_doc(expect_errors=False)
+    def test_metadata_spray_maps(self, entries, errors, options_map):
+        """
+        plugin "beancount_muonzoo_plugins.metadata_spray" "{
+            'sprays': [{ 'spray_type': 'account_open',
+                         'replace_type': 'return_error',
+                         'pattern': 'Assets:Brokerage:(?P<asset_class>[A-Za-z0-9]+)',
+                         'metadata_dict': {}
+                         }],
+            'maps': {'asset_class': {'equity': ['HOOLI', '[A-Z]+'],
+                                     'bond': ['T[A-Z]+', 'TBILL'],
+                                     'cash': ['Cash']}}
+            }"
+
+        2018-10-20 open Assets:Brokerage:HOOLI
+        2018-10-20 open Assets:Brokerage:TNOTE
+        2018-10-20 open Assets:Brokerage:Cash
+        2018-10-20 open Assets:Brokerage:2030
+
+        """
+        account_entries = getters.get_account_open_close(entries)
+        self.assertEqual(
+            {
+                "Assets:Brokerage:HOOLI": "equity",
+                "Assets:Brokerage:TNOTE": "bond",
+                "Assets:Brokerage:Cash": "cash",
+                "Assets:Brokerage:2030": None,
+            },
+            {
+                account: opens[0].meta.get("asset-class")
+                for account, opens in account_entries.items()
+            },
+        )
+
+    def test_compile_map(self):
+        # An exact key wins, then the last key matching as a regex.
+        inverted = {"HOOLI": "equity", "[A-Z]+": "equity", "T[A-Z]+": "bond", "C++": "code"}
+        matcher = metadata_spray.compile_map(inverted)
+        self.assertIsNotNone(matcher.pattern)
+        self.assertEqual(
+            ["equity", "equity", "bond", "code", None],
+            [matcher.match(value) for value in ("HOOLI", "GOOG", "TNOTE", "C++", "c")],
+        )
+        # Keys with groups of their own are tried one at a time.
+        matcher = metadata_spray.compile_map({"(A)+": "a", "(B)+": "b", "AB": "ab"})
+        self.assertIsNone(matcher.pattern)
+        self.assertEqual(
+            ["a", "ab", "b", None],
+            [matcher.match(value) for value in ("AA", "AB", "BA", "C")],
+        )
+
+    @loader.load_doc(expect_errors=True)
+    def test_metadata_spray_sprays_in_order(self, entries, errors, options_map):
+        """
+        plugin "beancount_muonzoo_plugins.metadata_spray" "{
+            'sprays': [{ 'spray_type': 'account_open',
+                         'replace_type': 'return_error',
+                         'pattern': 'Assets:.*',
+                         'metadata_dict': {'portfolio': 'core'}
+                         },
+                       { 'spray_type': 'account_fund' },
+                       { 'spray_type': 'account_open',
+                         'replace_type': 'dont_overwrite',
+                         'pattern': 'Assets:(?P<broker>[A-Za-z]+):.*',
+                         'metadata_dict': {'portfolio': 'tech', 'broker': '{broker}'}
+                         },
+                       { 'spray_type': 'account_open',
+                         'replace_type': 'return_error',
+                         'pattern': 'Assets:MyBrokerage:.*',
+                         'metadata_dict': {'portfolio': 'alt'}
+                         }],
+            'maps': {}
+            }"
+
+        2018-10-20 open Assets:MyBrokerage:HOOLI
+        2018-10-20 open Assets:OtherBrokerage:HOOLI
+        2018-10-20 open Equity:Opening
+
+        """
+        # Errors come in the order of the sprays: the invalid one, then the
+        # last spray finding the portfolio set by the first.
+        self.assertEqual(
+            ["Missing spray or replace type", "Existing metadata 'portfolio'"],
+            [error.message[:29] for error in errors],
+        )
+        account_entries = getters.get_account_open_close(entries)
+        self.assertEqual(
+            [
+                {"portfolio": "core", "broker": "MyBrokerage"},
+                {"portfolio": "core", "broker": "OtherBrokerage"},
+                {},
+            ],
+            [
+                {
+                    key: opens[0].meta[key]
+                    for key in ("portfolio", "broker")
+                    if key in opens[0].meta
+                }
+                for opens in account_entries.values()
+            ],
+        )
+        # Each Open was rebuilt once and is still in the entries.
+        self.assertEqual(3, sum(isinstance(entry, data.Open) for entry in entries))
+
+    def test_metadata_spray_account_open(self):
+        entries, errors, _ = loader.load_string(
+            """
+            2018-10-20 open Assets:MyBrokerage:HOOLI
+            2018-10-20 open Assets:Cash
+            """,
+            dedent=True,
+        )
+        self.assertFalse(errors)
+        # The arguments, debug included, can all be passed by position.
+        entries, errors = metadata_spray.metadata_spray_account_open(
+            entries,
+            "return_error",
+            "Assets:MyBrokerage:.*",
+            {"portfolio": "tech"},
+            {},
+            False,
+        )
+        self.assertFalse(errors)
+        self.assertEqual(["tech", None], [entry.meta.get("portfolio") for entry in entries])
@@ -0,0 +1,116 @@
+"""Checkpoint files for plugins that fold state over a sorted list of entries.
+
+A checkpoint pairs a snapshot of plugin state with a fingerprint of the entry
+prefix that produced it. The fingerprint is a running hash over a key of each
+entry: by default its stable hash, or just the parts of it the plugin reads.
+A checkpoint is only reused when the keys of every entry before it are
+unchanged.
+
+"""
+
+import hashlib
+import marshal
+import os
+import pickle
+
+from typing import Any, Callable, List, NamedTuple, Tuple
+
+from beancount.core import compare
+
+
+class Checkpoint(NamedTuple):
+    """A snapshot of plugin state taken before processing `entries[index]`."""
+
+    index: int
+    """ The number of entries folded into the state. """
+
+    fingerprint: bytes
+    """ The `Fingerprint` digest of `entries[:index]`. """
+
+    state: bytes
+    """ The pickled plugin state. """
+
+    payload: Any = None
+    """ Whatever else the plugin needs to rebuild its output up to `index`. """
+
+
+class Fingerprint:
+    """
+    A running hash of the `key`s of a prefix of the entries.
+
+    Keys are built of numbers, strings, bytes, None and tuples, which hash
+    the same in every process. They are hashed in chunks of `CHUNK` entries,
+    so the digest doesn't depend on how the prefix was taken in.
+
+    """
+
+    CHUNK = 4096
+
+    def __init__(self, key: Callable[[Any], Any] = compare.hash_entry):
+        self.key = key
+        # The number of entries taken in.
+        self.index = 0
+        self._hash = hashlib.blake2b(digest_size=16)
+        # The keys after the last complete chunk.
+        self._keys = []
+
+    def extended(self, entries, stop: int) -> "Fingerprint":
+        """A copy taking in `entries[self.index:stop]` as well."""
+        extended = Fingerprint(self.key)
+        extended._hash = self._hash.copy()
+        keys = list(self._keys)
+        index = self.index
+        while index < stop:
+            end = min(stop, index + self.CHUNK - len(keys))
+            keys.extend(map(self.key, entries[index:end]))
+            index = end
+            if len(keys) == self.CHUNK:
+                # Version 2 writes equal keys alike, however their values are shared.
+                extended._hash.update(marshal.dumps(keys, 2))
+                keys = []
+        extended._keys = keys
+        extended.index = stop
+        return extended
+
+    def digest(self) -> bytes:
+        digest = self._hash.copy()
+        digest.update(marshal.dumps(self._keys, 2))
+        return digest.digest()
+
+
+def load(filename: str, key) -> List[Checkpoint]:
+    """Read the checkpoints stored in `filename`, or none if they were written for another `key`."""
+    try:
+        with open(filename, "rb") as infile:
+            stored_key, checkpoints = pickle.load(infile)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return []
+    return checkpoints if stored_key == key else []
+
+
+def save(filename: str, key, checkpoints: List[Checkpoint]):
+    """Atomically replace `filename` with `checkpoints` written for `key`."""
+    tmpname = f"{filename}.tmp"
+    with open(tmpname, "wb") as outfile:
+        pickle.dump((key, checkpoints), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpname, filename)
+
+
+def valid_prefix(
+    entries, checkpoints: List[Checkpoint], fingerprint: Fingerprint
+) -> Tuple[List[Checkpoint], Fingerprint]:
+    """Return the leading checkpoints whose fingerprints match `entries`, and the fingerprint at the last of them.
+
+    `fingerprint` is that of none of the entries yet; the entries after the
+    last matching checkpoint are not looked at.
+    """
+    valid = []
+    for checkpoint in sorted(checkpoints, key=lambda checkpoint: checkpoint.index):
+        if checkpoint.index > len(entries):
+            break
+        extended = fingerprint.extended(entries, checkpoint.index)
+        if extended.digest() != checkpoint.fingerprint:
+            break
+        valid.append(checkpoint)
+        fingerprint = extended
+    return valid, fingerprint
@@ -0,0 +1,65 @@
+import datetime
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from beancount.core import data
+
+from beancount_muonzoo_plugins.util import checkpoint
+
+
+def entries(count):
+    date = datetime.date(2020, 1, 1)
+    return [
+        data.Event({}, date + datetime.timedelta(days=day), "day", str(day))
+        for day in range(count)
+    ]
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_fingerprint_chunks(self):
+        events = entries(10)
+        whole = checkpoint.Fingerprint().extended(events, 10)
+        with unittest.mock.patch.object(checkpoint.Fingerprint, "CHUNK", 3):
+            chunked = checkpoint.Fingerprint().extended(events, 10)
+            stepped = checkpoint.Fingerprint()
+            for stop in (2, 3, 7, 10):
+                stepped = stepped.extended(events, stop)
+            self.assertEqual(chunked.digest(), stepped.digest())
+            self.assertEqual(10, stepped.index)
+        # Taking in the same entries in other runs gives the same digest.
+        self.assertEqual(
+            whole.digest(),
+            checkpoint.Fingerprint().extended(events, 4).extended(events, 10).digest(),
+        )
+        self.assertNotEqual(
+            whole.digest(), checkpoint.Fingerprint().extended(events, 9).digest()
+        )
+
+    def test_valid_prefix(self):
+        events = entries(10)
+        fingerprint = checkpoint.Fingerprint(key=lambda entry: entry.description)
+        checkpoints = [
+            checkpoint.Checkpoint(stop, fingerprint.extended(events, stop).digest(), b"")
+            for stop in (8, 3, 5)
+        ]
+        events[6] = events[6]._replace(description="changed")
+        valid, at = checkpoint.valid_prefix(events, checkpoints, fingerprint)
+        self.assertEqual([3, 5], [cp.index for cp in valid])
+        self.assertEqual(5, at.index)
+        valid, at = checkpoint.valid_prefix(events[:4], checkpoints, fingerprint)
+        self.assertEqual([3], [cp.index for cp in valid])
+
+    def test_save_load(self):
+        checkpoints = [checkpoint.Checkpoint(1, b"fingerprint", b"state", "payload")]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "checkpoints")
+            self.assertEqual([], checkpoint.load(filename, "key"))
+            checkpoint.save(filename, "key", checkpoints)
+            self.assertEqual(checkpoints, checkpoint.load(filename, "key"))
+            self.assertEqual([], checkpoint.load(filename, "other key"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""The values of beancount `event` directives over time.
+
+An `EventTimeline` indexes the events of a sorted entry list by type, so the
+value of an event type on any date is a bisection away, independent of how far
+a plugin has got through the entries.
+
+"""
+
+import bisect
+import datetime
+import itertools
+
+from collections import defaultdict
+from typing import Dict, Optional
+
+from beancount.core.data import Event
+
+
+class EventTimeline:
+    """The description of each event type by date, with optional per-type overrides."""
+
+    def __init__(self, entries=()):
+        self.overrides: Dict[str, str] = {}
+        self.index(entries)
+
+    def index(self, entries, start=0):
+        """
+        (Re)build the timeline from the events of the sorted `entries`.
+
+        From a `start` past zero, only the events from the date of
+        `entries[start]` on are indexed again; those before it are kept.
+
+        """
+        if start == 0:
+            self._dates = {}
+            self._values = {}
+        else:
+            date = entries[start].date
+            while start > 0 and entries[start - 1].date == date:
+                start -= 1
+            for event_type, dates in self._dates.items():
+                kept = bisect.bisect_left(dates, date)
+                del dates[kept:]
+                del self._values[event_type][kept:]
+        dates = defaultdict(list, self._dates)
+        values = defaultdict(list, self._values)
+        for entry in itertools.islice(entries, start, None):
+            if isinstance(entry, Event):
+                dates[entry.type].append(entry.date)
+                values[entry.type].append(entry.description)
+        self._dates = {
+            event_type: dates[event_type] for event_type in dates if dates[event_type]
+        }
+        self._values = {event_type: values[event_type] for event_type in self._dates}
+
+    def value_at(self, event_type: str, date: datetime.date) -> Optional[str]:
+        """The value of the latest `event_type` event on or before `date`, or None."""
+        dates = self._dates.get(event_type)
+        if dates is None:
+            return None
+        position = bisect.bisect_right(dates, date)
+        if position == 0:
+            return None
+        return self.overrides.get(event_type, self._values[event_type][position - 1])
@@ -0,0 +1,30 @@
+import datetime
+import unittest
+
+from beancount.core import data
+
+from beancount_muonzoo_plugins.util.events import EventTimeline
+
+
+def event(day, event_type, description):
+    return data.Event({}, datetime.date(2020, 1, day), event_type, description)
+
+
+class TestEventTimeline(unittest.TestCase):
+    def test_value_at(self):
+        timeline = EventTimeline([event(2, "rate", "1"), event(5, "rate", "2")])
+        self.assertIsNone(timeline.value_at("rate", datetime.date(2020, 1, 1)))
+        self.assertEqual("1", timeline.value_at("rate", datetime.date(2020, 1, 4)))
+        self.assertEqual("2", timeline.value_at("rate", datetime.date(2020, 1, 5)))
+        self.assertIsNone(timeline.value_at("fx", datetime.date(2020, 1, 5)))
+
+    def test_index_from(self):
+        old = [event(2, "rate", "1"), event(5, "rate", "2"), event(5, "fx", "3")]
+        new = [event(2, "rate", "1"), event(5, "rate", "4"), event(5, "tax", "5")]
+        timeline = EventTimeline(old)
+        # Events on the date of the start are indexed again, even before it.
+        timeline.index(new, 2)
+        self.assertEqual(EventTimeline(new)._dates, timeline._dates)
+        self.assertEqual(EventTimeline(new)._values, timeline._values)
+        self.assertEqual("4", timeline.value_at("rate", datetime.date(2020, 1, 9)))
+        self.assertIsNone(timeline.value_at("fx", datetime.date(2020, 1, 9)))
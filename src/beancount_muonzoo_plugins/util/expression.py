@@ -0,0 +1,194 @@
+"""A small, restricted expression language compiled to Python closures.
+
+Expressions use Python syntax but only a safe subset of it: constants, names,
+arithmetic, comparisons, boolean logic, conditional expressions, calls to a
+fixed set of functions and a fixed set of attributes. Anything else is
+rejected when the expression is compiled.
+
+Names are resolved at compile time to slots of a context list, so evaluating
+an expression is a call of the compiled closure on that list; no dict is
+built or looked up.
+
+"""
+
+import ast
+import operator
+
+from typing import Any, Callable, Collection, Dict, FrozenSet, Sequence
+
+ALLOWED_ATTRIBUTES = frozenset({"number", "currency"})
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+UNARY_OPERATORS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: operator.not_,
+}
+
+COMPARISON_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+CONSTANT_TYPES = (bool, int, float, str)
+
+
+class ExpressionError(ValueError):
+    """An expression that does not parse or uses a construct outside the language."""
+
+
+def compile_expression(
+    expr: str,
+    names: Sequence[str],
+    functions: Dict[str, Callable],
+    location: str = "<expr>",
+    callables: Collection[str] = (),
+) -> Callable[[Sequence[Any]], Any]:
+    """Compile `expr` to a closure evaluating it over a context list.
+
+    Args:
+      expr: The expression source.
+      names: The variable names; `names[i]` is read from `context[i]`.
+      functions: The functions expressions may call, by name.
+      location: Where the expression came from, for error messages.
+      callables: The variables holding functions supplied with the context,
+        which expressions may call too.
+    Returns:
+      A function of the context list returning the value of the expression.
+    Raises:
+      ExpressionError: If the expression is invalid.
+    """
+    try:
+        tree = ast.parse(expr.strip(), filename=location, mode="eval")
+    except SyntaxError as exc:
+        raise ExpressionError(
+            f"{location}: invalid expression {expr!r}: {exc.msg}"
+        ) from exc
+    slots = {name: index for index, name in enumerate(names)}
+    return _Compiler(slots, functions, callables, location, expr).compile(tree.body)
+
+
+def referenced_names(expr: str) -> FrozenSet[str]:
+    """The variable and function names `expr` refers to."""
+    tree = ast.parse(expr.strip(), mode="eval")
+    return frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+
+class _Compiler:
+    def __init__(self, slots, functions, callables, location, expr):
+        self.slots = slots
+        self.functions = functions
+        self.callables = callables
+        self.location = location
+        self.expr = expr
+
+    def error(self, message):
+        return ExpressionError(f"{self.location}: {message} in {self.expr!r}")
+
+    def compile(self, node):
+        method = getattr(self, f"compile_{type(node).__name__}", None)
+        if method is None:
+            raise self.error(f"unsupported construct {type(node).__name__}")
+        return method(node)
+
+    def compile_Constant(self, node):
+        value = node.value
+        if not isinstance(value, CONSTANT_TYPES):
+            raise self.error(f"unsupported constant {value!r}")
+        return lambda context: value
+
+    def compile_Name(self, node):
+        if node.id not in self.slots:
+            raise self.error(f"unknown name {node.id!r}")
+        return operator.itemgetter(self.slots[node.id])
+
+    def compile_Attribute(self, node):
+        if node.attr not in ALLOWED_ATTRIBUTES:
+            raise self.error(f"unsupported attribute {node.attr!r}")
+        value = self.compile(node.value)
+        getter = operator.attrgetter(node.attr)
+        return lambda context: getter(value(context))
+
+    def compile_UnaryOp(self, node):
+        op = self.operator(UNARY_OPERATORS, node.op)
+        operand = self.compile(node.operand)
+        return lambda context: op(operand(context))
+
+    def compile_BinOp(self, node):
+        op = self.operator(BINARY_OPERATORS, node.op)
+        left = self.compile(node.left)
+        right = self.compile(node.right)
+        return lambda context: op(left(context), right(context))
+
+    def compile_BoolOp(self, node):
+        values = [self.compile(value) for value in node.values]
+        # Like Python, return the deciding operand rather than a bool.
+        stop_on = not isinstance(node.op, ast.And)
+
+        def boolop(context):
+            for value in values:
+                result = value(context)
+                if bool(result) is stop_on:
+                    return result
+            return result
+
+        return boolop
+
+    def compile_Compare(self, node):
+        ops = [self.operator(COMPARISON_OPERATORS, op) for op in node.ops]
+        operands = [self.compile(operand) for operand in [node.left, *node.comparators]]
+        if len(ops) == 1:
+            (op,), (left, right) = ops, operands
+            return lambda context: op(left(context), right(context))
+
+        def compare(context):
+            left = operands[0](context)
+            for op, operand in zip(ops, operands[1:]):
+                right = operand(context)
+                if not op(left, right):
+                    return False
+                left = right
+            return True
+
+        return compare
+
+    def compile_IfExp(self, node):
+        test = self.compile(node.test)
+        body = self.compile(node.body)
+        orelse = self.compile(node.orelse)
+        return lambda context: body(context) if test(context) else orelse(context)
+
+    def compile_Call(self, node):
+        if not isinstance(node.func, ast.Name) or not (
+            node.func.id in self.functions or node.func.id in self.callables
+        ):
+            raise self.error(f"unsupported call of {ast.unparse(node.func)!r}")
+        if node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args):
+            raise self.error("only positional arguments are supported")
+        args = [self.compile(arg) for arg in node.args]
+        if node.func.id not in self.functions:
+            function = self.compile(node.func)
+            return lambda context: function(context)(*[arg(context) for arg in args])
+        function = self.functions[node.func.id]
+        if len(args) == 1:
+            (arg,) = args
+            return lambda context: function(arg(context))
+        if len(args) == 2:
+            first, second = args
+            return lambda context: function(first(context), second(context))
+        return lambda context: function(*[arg(context) for arg in args])
+
+    def operator(self, table, op):
+        if type(op) not in table:
+            raise self.error(f"unsupported operator {type(op).__name__}")
+        return table[type(op)]
@@ -0,0 +1,82 @@
+"""Amortization schedules computed directly in `Decimal`.
+
+`amortize()` walks a loan's balance period by period. Each period charges
+interest at that period's rate and applies the payment, interest first. The
+payment is either fixed or the annuity payment that clears the balance over
+the remaining term; the annuity is recomputed whenever the rate changes.
+
+"""
+
+from decimal import Decimal
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+
+class Installment(NamedTuple):
+    """One period of an amortization schedule."""
+
+    interest: Decimal
+    """ The interest charged for the period. """
+
+    principal: Decimal
+    """ The part of the payment that reduces the balance (negative if interest is capitalized). """
+
+    payment: Decimal
+    """ The amount paid, `interest + principal`. """
+
+    balance: Decimal
+    """ The balance outstanding after the period. """
+
+
+def annuity_payment(balance: Decimal, rate: Decimal, periods: int) -> Decimal:
+    """The level payment clearing `balance` in `periods` periods at `rate` per period."""
+    if rate == 0:
+        return balance / periods
+    return balance * rate / (1 - (1 + rate) ** -periods)
+
+
+def amortize(
+    balance: Decimal,
+    rates: Iterable[Decimal],
+    periods_per_year: Decimal,
+    payment: Optional[Decimal] = None,
+    quantum: Decimal = Decimal("0.01"),
+) -> Iterator[Installment]:
+    """Yield the installments repaying `balance`, one per annual rate of `rates`.
+
+    Args:
+      balance: The amount owed before the first period.
+      rates: The annual interest rate in force in each period; there is one
+        period per rate, so this also sets the term.
+      periods_per_year: The number of periods in a year, to turn annual rates
+        into periodic ones.
+      payment: A fixed payment per period, or None for the annuity payment.
+        A zero payment capitalizes the interest and never repays the loan;
+        any other fixed payment is topped up (or cut down) in the last period
+        to clear the balance.
+      quantum: The precision amounts are rounded to.
+    Yields:
+      One `Installment` per period, stopping early once the balance is repaid.
+    """
+    rates = list(rates)
+    term = len(rates)
+    fixed = payment is not None
+    interest_only = fixed and payment == 0
+    previous_rate = None
+    for period, annual_rate in enumerate(rates):
+        rate = annual_rate / periods_per_year
+        remaining = term - period
+        interest = (balance * rate).quantize(quantum)
+        if not fixed and annual_rate != previous_rate:
+            payment = annuity_payment(balance, rate, remaining).quantize(quantum)
+        previous_rate = annual_rate
+
+        if interest_only:
+            principal = -interest
+        elif remaining == 1:
+            principal = balance
+        else:
+            principal = min(payment - interest, balance)
+        balance -= principal
+        yield Installment(interest, principal, interest + principal, balance)
+        if balance == 0 and not interest_only:
+            return
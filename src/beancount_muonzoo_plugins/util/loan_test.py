@@ -0,0 +1,45 @@
+import unittest
+
+from beancount.core.number import D
+
+from beancount_muonzoo_plugins.util import loan
+
+
+class TestAmortize(unittest.TestCase):
+    def test_annuity(self):
+        schedule = list(loan.amortize(D("100000.00"), [D("0.06")] * 360, D(12)))
+        self.assertEqual(360, len(schedule))
+        self.assertEqual(D("599.55"), schedule[0].payment)
+        self.assertEqual(D("500.00"), schedule[0].interest)
+        self.assertEqual(D("99.55"), schedule[0].principal)
+        self.assertEqual(D("100000.00"), sum(row.principal for row in schedule))
+        self.assertEqual(D("0.00"), schedule[-1].balance)
+
+    def test_rate_change_recomputes_payment(self):
+        rates = [D("0.12")] * 2 + [D("0.24")] * 2
+        schedule = list(loan.amortize(D("1000.00"), rates, D(12)))
+        payments = [row.payment for row in schedule]
+        self.assertEqual(payments[0], payments[1])
+        self.assertLess(payments[1], payments[2])
+        self.assertEqual(D("1000.00"), sum(row.principal for row in schedule))
+        # The new payment clears what is left over the remaining two periods.
+        remaining = schedule[1].balance
+        self.assertEqual(
+            loan.annuity_payment(remaining, D("0.02"), 2).quantize(D("0.01")), payments[2]
+        )
+
+    def test_fixed_payment_stops_at_payoff(self):
+        schedule = list(loan.amortize(D("250.00"), [D(0)] * 12, D(12), payment=D("100.00")))
+        self.assertEqual(
+            [D("100.00"), D("100.00"), D("50.00")], [row.payment for row in schedule]
+        )
+
+    def test_zero_payment_capitalizes_interest(self):
+        schedule = list(loan.amortize(D("1000.00"), [D("0.12")] * 2, D(12), payment=D(0)))
+        self.assertEqual([D("10.00"), D("10.10")], [row.interest for row in schedule])
+        self.assertEqual([D("-10.00"), D("-10.10")], [row.principal for row in schedule])
+        self.assertEqual(D("1020.10"), schedule[-1].balance)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Compact occurrences of recurring template transactions.
+
+An `Occurrence` holds only its date and a reference to a `Template`, shared
+by all the occurrences of one template transaction. The `Transaction` of an
+occurrence is only built by `materialize()`, with metadata dicts (its own
+and its postings') and a postings list of its own, so changing one
+materialized occurrence never changes another (or the template).
+
+"""
+
+import datetime
+
+from typing import NamedTuple
+
+from beancount.core import data
+
+
+class Template(NamedTuple):
+    """A template transaction, shared by all its occurrences and never handed out itself."""
+
+    entry: data.Transaction
+    """ The template transaction. """
+
+    narration: str
+    """ The narration of its occurrences (without the recurrence spec). """
+
+    def occurrence(self, date: datetime.date) -> "Occurrence":
+        return Occurrence(date, self)
+
+
+class Occurrence(NamedTuple):
+    """One occurrence of a `Template`: a date, until it is materialized."""
+
+    date: datetime.date
+    """ The date of the occurrence. """
+
+    template: Template
+    """ The template it is an occurrence of. """
+
+    def sortkey(self):
+        """The `data.entry_sortkey` of the materialized transaction, without materializing it."""
+        return (
+            self.date,
+            data.SORT_ORDER.get(data.Transaction, 0),
+            self.template.entry.meta["lineno"],
+        )
+
+    def materialize(self, meta=None, postings=None) -> data.Transaction:
+        """Build the transaction of this occurrence, with copies of the template's `meta` and `postings` unless given."""
+        entry = self.template.entry
+        if postings is None:
+            postings = [
+                posting
+                if posting.meta is None
+                else posting._replace(meta=dict(posting.meta))
+                for posting in entry.postings
+            ]
+        return data.Transaction(
+            dict(entry.meta) if meta is None else meta,
+            self.date,
+            entry.flag,
+            entry.payee,
+            self.template.narration,
+            entry.tags,
+            entry.links,
+            postings,
+        )
@@ -0,0 +1,51 @@
+import datetime
+import unittest
+
+from beancount.core import data
+
+from beancount_muonzoo_plugins.util import occurrence
+
+
+class TestOccurrence(unittest.TestCase):
+    def setUp(self):
+        self.entry = data.Transaction(
+            data.new_metadata("<test>", 7, {"note": "template"}),
+            datetime.date(2020, 1, 1),
+            "#",
+            None,
+            "Rent [MONTHLY]",
+            frozenset(),
+            frozenset(),
+            [
+                data.Posting("Expenses:Rent", None, None, None, None, {"note": "posting"}),
+                data.Posting("Assets:Cash", None, None, None, None, None),
+            ],
+        )
+        self.template = occurrence.Template(self.entry, "Rent")
+
+    def test_materialize(self):
+        first = self.template.occurrence(datetime.date(2020, 1, 1))
+        txn = first.materialize()
+        self.assertEqual(
+            self.entry._replace(narration="Rent", meta=dict(self.entry.meta)), txn
+        )
+        self.assertEqual(data.entry_sortkey(txn), first.sortkey())
+
+    def test_materialized_occurrences_are_independent(self):
+        first, second = (
+            self.template.occurrence(datetime.date(2020, month, 1)).materialize()
+            for month in (1, 2)
+        )
+        first.meta["note"] = "changed"
+        first.postings[0].meta["note"] = "changed"
+        first.postings.append(None)
+        self.assertEqual("template", second.meta["note"])
+        self.assertEqual(self.entry.postings, second.postings)
+        self.assertEqual("posting", second.postings[0].meta["note"])
+        self.assertEqual("template", self.entry.meta["note"])
+        self.assertEqual("posting", self.entry.postings[0].meta["note"])
+        self.assertEqual(2, len(self.entry.postings))
+
+
+if __name__ == "__main__":
+    unittest.main()
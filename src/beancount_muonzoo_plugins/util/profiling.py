@@ -0,0 +1,51 @@
+"""Lightweight wall-time and counter profiling for plugins."""
+
+import contextlib
+import json
+import time
+
+from collections import Counter, defaultdict
+
+
+class Profile:
+    """Accumulate wall time per named phase along with named counters."""
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.counters = Counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Add the wall time spent inside the `with` block to phase `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def report(self) -> dict:
+        return {"phases": dict(self.phases), "counters": dict(self.counters)}
+
+    def write(self, filename: str):
+        """Write the report to `filename` as JSON."""
+        with open(filename, "w") as outfile:
+            json.dump(self.report(), outfile, indent=2, sort_keys=True)
+            outfile.write("\n")
+
+
+class NullProfile:
+    """A stand-in for `Profile` that records nothing, for when profiling is off."""
+
+    _null_phase = contextlib.nullcontext()
+
+    def phase(self, name: str):
+        return self._null_phase
+
+    def count(self, name: str, n: int = 1):
+        pass
+
+
+NULL_PROFILE = NullProfile()
@@ -0,0 +1,366 @@
+"""Recurrence specifications embedded in a transaction narration.
+
+Both the `forecast` and `dynamic_forecast` plugins recognise a trailing
+bracketed spec in the narration of their template transactions, e.g.:
+
+    2014-03-08 # "Electricity bill [MONTHLY]"
+    2014-03-08 # "Electricity bill [MONTHLY UNTIL 2019-12-31]"
+    2014-03-08 # "Electricity bill [WEEKLY SKIP 1 TIME REPEAT 10 TIMES]"
+
+An `ON` clause after the frequency picks days within each period (week,
+month or year) by weekday:
+
+    2014-03-08 # "Gym [WEEKLY ON MON,WED,FRI]"
+    2014-03-08 # "Rent [MONTHLY ON LAST BUSINESS DAY]"
+    2014-03-08 # "Book club [MONTHLY ON 2ND TUE REPEAT 10 TIMES]"
+
+A position (`2ND TUE`, `LAST BUSINESS DAY`) is only allowed on MONTHLY and
+YEARLY recurrences.
+
+The dates are generated by `DateRule`, which follows `dateutil.rrule` but
+works on date ordinals and yields `datetime.date`s.
+
+"""
+
+import calendar
+import datetime
+import functools
+import re
+
+from typing import Any, Callable, FrozenSet, Iterable, Iterator, NamedTuple, Optional
+
+from dateutil import relativedelta, rrule
+
+_DAY = r"(?:MON?|TUE?|WED?|THU?|FRI?|SAT?|SUN?)"
+
+RECURRENCE_RE = re.compile(
+    r"(?P<narration>^.*)\[(?P<frequency>MONTHLY|YEARLY|WEEKLY|DAILY)"
+    rf"(?:\s+ON\s+(?P<on>LAST\s+BUSINESS\s+DAY|(?:1ST|2ND|3RD|4TH|5TH|LAST)\s+{_DAY}"
+    rf"|{_DAY}(?:\s*,\s*{_DAY})*))?"
+    r"(?:\s+SKIP\s+(?P<skip>[1-9][0-9]*)\s+TIME.?)?"
+    r"(?:\s+REPEAT\s+(?P<count>[1-9][0-9]*)\s+TIME.?)?"
+    r"(?:\s+UNTIL\s+(?P<until>[0-9\-]+))?\]"
+)
+
+# Weekdays by their first two letters, numbered as `date.weekday()`.
+WEEKDAYS = {name[:2].upper(): number for number, name in enumerate(calendar.day_abbr)}
+
+# The position of an `ON <position> <weekday>` day within its period.
+SET_POSITIONS = {"1ST": 1, "2ND": 2, "3RD": 3, "4TH": 4, "5TH": 5, "LAST": -1}
+
+BUSINESS_DAYS = frozenset(range(5))
+
+FREQUENCIES = {
+    "YEARLY": rrule.YEARLY,
+    "MONTHLY": rrule.MONTHLY,
+    "WEEKLY": rrule.WEEKLY,
+    "DAILY": rrule.DAILY,
+}
+
+# A horizon relative to the last date of the ledger, e.g. `18 MONTHS`.
+HORIZON_RE = re.compile(r"^\s*\+?([0-9]+)\s+(DAY|WEEK|MONTH|YEAR)S?\s*$", re.IGNORECASE)
+
+# The (nominal) number of periods of each frequency in a year.
+PERIODS_PER_YEAR = {
+    rrule.YEARLY: 1,
+    rrule.MONTHLY: 12,
+    rrule.WEEKLY: 52,
+    rrule.DAILY: 365,
+}
+
+
+class Recurrence(NamedTuple):
+    """A parsed recurrence spec."""
+
+    narration: str
+    """ The narration with the bracketed spec removed. """
+
+    frequency: int
+    """ The `dateutil.rrule` frequency constant. """
+
+    interval: int = 1
+    """ One more than the number of periods skipped between occurrences. """
+
+    count: Optional[int] = None
+    """ The number of occurrences, for `REPEAT n TIMES`. """
+
+    until: Optional[datetime.date] = None
+    """ The last possible date, for `UNTIL yyyy-mm-dd`. """
+
+    weekdays: Optional[FrozenSet[int]] = None
+    """ The weekdays picked within each period by an `ON` clause (Monday is 0). """
+
+    setpos: Optional[int] = None
+    """ The position of the day picked among those weekdays (negative from the end), or None for all. """
+
+    @property
+    def open_ended(self) -> bool:
+        """Whether the recurrence runs to the horizon, for want of a `REPEAT` or `UNTIL`."""
+        return self.count is None and self.until is None
+
+    def _until(self, horizon):
+        if self.count is not None:
+            return None
+        if self.until is not None:
+            return self.until
+        if horizon is not None:
+            return horizon
+        return datetime.date(datetime.date.today().year, 12, 31)
+
+    def dates(
+        self, dtstart: datetime.date, horizon: Optional[datetime.date] = None
+    ) -> "DateRule":
+        """Return the rule generating the dates of the occurrences starting on `dtstart`.
+
+        Without a `count` or `until` the rule runs to `horizon`, by default the
+        end of the current year.
+        """
+        return DateRule(
+            self.frequency,
+            dtstart,
+            interval=self.interval,
+            count=self.count,
+            until=self._until(horizon),
+            weekdays=self.weekdays,
+            setpos=self.setpos,
+        )
+
+    def rrule(
+        self, dtstart: datetime.date, horizon: Optional[datetime.date] = None
+    ) -> rrule.rrule:
+        """Return the `dateutil.rrule` equivalent of `dates()`, yielding datetimes."""
+        periodicity = {"dtstart": dtstart, "interval": self.interval}
+        if self.count is not None:
+            periodicity["count"] = self.count
+        else:
+            periodicity["until"] = self._until(horizon)
+        if self.weekdays is not None:
+            periodicity["byweekday"] = sorted(self.weekdays)
+            if self.setpos is not None:
+                periodicity["bysetpos"] = self.setpos
+        return rrule.rrule(self.frequency, **periodicity)
+
+
+class DateRule:
+    """
+    A recurrence of dates, generated lazily from date ordinals.
+
+    The dates are those of the equivalent `dateutil.rrule`. Every `interval`
+    periods (days, weeks, months or years) from `dtstart`'s, a period yields
+    the day on `dtstart`'s weekday, day of the month or date in the year; a
+    period without that day (the 31st, 29 February) yields nothing. With
+    `weekdays`, a period yields its days on those weekdays instead, or just
+    the `setpos`-th of them. Dates before `dtstart` or after `until` are
+    left out, and at most `count` dates are yielded.
+
+    """
+
+    def __init__(
+        self,
+        frequency: int,
+        dtstart: datetime.date,
+        *,
+        interval: int = 1,
+        count: Optional[int] = None,
+        until: Optional[datetime.date] = None,
+        weekdays: Optional[FrozenSet[int]] = None,
+        setpos: Optional[int] = None,
+    ):
+        self.frequency = frequency
+        self.dtstart = dtstart
+        self.interval = interval
+        self.count = count
+        self.until = until
+        self.weekdays = weekdays
+        self.setpos = setpos
+
+    def __iter__(self) -> Iterator[datetime.date]:
+        return self._dates(0)
+
+    def after(self, date: datetime.date, inc: bool = False) -> Iterator[datetime.date]:
+        """The dates after `date` (or on it, with `inc`)."""
+        # Without a count the periods before `date` needn't be generated at all.
+        first = 0 if self.count is not None else max(0, self._period_of(date))
+        return (day for day in self._dates(first) if day > date or (inc and day == date))
+
+    def _period_of(self, date):
+        start = self.dtstart
+        if self.frequency == rrule.DAILY:
+            periods = date.toordinal() - start.toordinal()
+        elif self.frequency == rrule.WEEKLY:
+            periods = (date.toordinal() - date.weekday()) - (
+                start.toordinal() - start.weekday()
+            )
+            periods //= 7
+        elif self.frequency == rrule.MONTHLY:
+            periods = (date.year - start.year) * 12 + date.month - start.month
+        else:
+            periods = date.year - start.year
+        return periods // self.interval
+
+    def _period(self, period):
+        """The first ordinal of `period` and the ordinals it yields, before `dtstart` and `until`."""
+        start = self.dtstart
+        step = period * self.interval
+        if self.frequency == rrule.DAILY:
+            first = start.toordinal() + step
+            days = [first]
+        elif self.frequency == rrule.WEEKLY:
+            first = start.toordinal() - start.weekday() + 7 * step
+            days = range(first, first + 7) if self.weekdays else [first + start.weekday()]
+        elif self.frequency == rrule.MONTHLY:
+            year, month = divmod(start.year * 12 + start.month - 1 + step, 12)
+            month += 1
+            first = datetime.date(year, month, 1).toordinal()
+            length = calendar.monthrange(year, month)[1]
+            if self.weekdays:
+                days = range(first, first + length)
+            else:
+                days = [first + start.day - 1] if start.day <= length else []
+        else:
+            year = start.year + step
+            first = datetime.date(year, 1, 1).toordinal()
+            if self.weekdays:
+                days = range(first, datetime.date(year, 12, 31).toordinal() + 1)
+            elif start.month == 2 and start.day == 29 and not calendar.isleap(year):
+                days = []
+            else:
+                days = [datetime.date(year, start.month, start.day).toordinal()]
+
+        if self.weekdays:
+            # Ordinal 1 (0001-01-01) is a Monday.
+            days = [day for day in days if (day - 1) % 7 in self.weekdays]
+            if self.setpos is not None:
+                index = self.setpos - 1 if self.setpos > 0 else self.setpos
+                days = [days[index]] if -len(days) <= index < len(days) else []
+        return first, days
+
+    def _dates(self, period):
+        start = self.dtstart.toordinal()
+        until = None if self.until is None else self.until.toordinal()
+        remaining = self.count
+        while True:
+            first, days = self._period(period)
+            if until is not None and first > until:
+                return
+            for day in days:
+                if day < start:
+                    continue
+                if until is not None and day > until:
+                    return
+                yield datetime.date.fromordinal(day)
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+            period += 1
+
+
+class Window(NamedTuple):
+    """The dates occurrences are generated in, set by the plugins' `horizon` and `cutoff`."""
+
+    start: Optional[datetime.date] = None
+    """ Occurrences before this date are dropped. """
+
+    horizon: Optional[datetime.date] = None
+    """ The end of recurrences without `REPEAT` or `UNTIL` (default: the end of the current year). """
+
+    @property
+    def end(self) -> datetime.date:
+        """The horizon, or the end of the current year without one."""
+        if self.horizon is not None:
+            return self.horizon
+        return datetime.date(datetime.date.today().year, 12, 31)
+
+    def dates(self, rule: DateRule) -> Iterable[datetime.date]:
+        """The dates of `rule` from `start` on."""
+        if self.start is None:
+            return iter(rule)
+        return rule.after(self.start, inc=True)
+
+
+def parse_horizon(horizon: Any, last_date: datetime.date) -> datetime.date:
+    """The date of `horizon`: a date, `yyyy-mm-dd`, or `N DAYS|WEEKS|MONTHS|YEARS` after `last_date`."""
+    if isinstance(horizon, datetime.date):
+        return horizon
+    match = HORIZON_RE.match(horizon)
+    if match is None:
+        return datetime.datetime.strptime(horizon.strip(), "%Y-%m-%d").date()
+    count, unit = int(match.group(1)), match.group(2).lower()
+    return last_date + relativedelta.relativedelta(**{unit + "s": count})
+
+
+def forecast_window(
+    entries,
+    is_template: Callable[[Any], bool],
+    horizon: Any = None,
+    cutoff: Optional[int] = None,
+) -> Window:
+    """The `Window` of the `horizon` and of a `cutoff` in days, both relative to the last date of `entries`.
+
+    The last date is that of the last of the sorted `entries` that isn't a
+    template, so the window only changes with the ledger itself.
+    """
+    if horizon is None and cutoff is None:
+        return Window()
+    last_date = next(
+        (entry.date for entry in reversed(entries) if not is_template(entry)),
+        datetime.date.today(),
+    )
+    return Window(
+        None if cutoff is None else last_date - datetime.timedelta(days=cutoff),
+        None if horizon is None else parse_horizon(horizon, last_date),
+    )
+
+
+@functools.cache
+def has_recurrence(narration: str) -> bool:
+    """Whether `narration` ends in a recurrence spec, valid or not (see `parse_recurrence()`)."""
+    return RECURRENCE_RE.search(narration) is not None
+
+
+@functools.cache
+def parse_recurrence(narration: str) -> Optional[Recurrence]:
+    """Parse the recurrence spec out of `narration`, or None if it has none.
+
+    Results are memoized by narration text, so a template repeated across
+    files is only parsed once per process. Raises ValueError for a spec that
+    can't generate any dates.
+    """
+    match = RECURRENCE_RE.search(narration)
+    if not match:
+        return None
+
+    recurrence = Recurrence(
+        match.group("narration").strip(), FREQUENCIES[match.group("frequency")]
+    )
+    if match.group("count"):  # e.g., [MONTHLY REPEAT 3 TIMES]:
+        recurrence = recurrence._replace(count=int(match.group("count")))
+    elif match.group("until"):  # e.g., [MONTHLY UNTIL 2020-01-01]:
+        recurrence = recurrence._replace(
+            until=datetime.datetime.strptime(match.group("until"), "%Y-%m-%d").date()
+        )
+
+    if match.group("skip"):
+        recurrence = recurrence._replace(interval=int(match.group("skip")) + 1)
+
+    if match.group("on"):
+        weekdays, setpos = parse_on(match.group("on"))
+        if setpos is not None and recurrence.frequency in (rrule.DAILY, rrule.WEEKLY):
+            # A day or a week holds at most one of each weekday.
+            raise ValueError(
+                f"ON {match.group('on')} needs a MONTHLY or YEARLY recurrence: {narration!r}"
+            )
+        recurrence = recurrence._replace(weekdays=weekdays, setpos=setpos)
+
+    return recurrence
+
+
+def parse_on(on: str):
+    """The weekdays and set position of an `ON` clause, e.g. `2ND TUE` is `({1}, 2)`."""
+    words = on.split()
+    if words == ["LAST", "BUSINESS", "DAY"]:
+        return BUSINESS_DAYS, -1
+    if words[0] in SET_POSITIONS:
+        return frozenset({WEEKDAYS[words[1][:2]]}), SET_POSITIONS[words[0]]
+    return frozenset(WEEKDAYS[day.strip()[:2]] for day in on.split(",")), None
@@ -0,0 +1,170 @@
+import datetime
+import unittest
+
+from typing import NamedTuple
+
+from dateutil import rrule
+
+from beancount_muonzoo_plugins.util import recurrence
+
+
+class TestRecurrence(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            recurrence.Recurrence("Electricity bill", rrule.WEEKLY, interval=2, count=10),
+            recurrence.parse_recurrence(
+                "Electricity bill [WEEKLY SKIP 1 TIME REPEAT 10 TIMES]"
+            ),
+        )
+        self.assertEqual(
+            recurrence.Recurrence("Rent", rrule.MONTHLY, until=datetime.date(2019, 12, 31)),
+            recurrence.parse_recurrence("Rent [MONTHLY UNTIL 2019-12-31]"),
+        )
+        self.assertIsNone(recurrence.parse_recurrence("Rent"))
+
+    def test_parse_is_memoized(self):
+        narration = "Memoized [DAILY SKIP 3 TIMES REPEAT 1 TIME]"
+        self.assertIs(
+            recurrence.parse_recurrence(narration),
+            recurrence.parse_recurrence(narration),
+        )
+
+    def test_rrule(self):
+        spec = recurrence.parse_recurrence("Rent [MONTHLY REPEAT 3 TIMES]")
+        self.assertEqual(
+            [
+                datetime.date(2020, 1, 31),
+                datetime.date(2020, 3, 31),
+                datetime.date(2020, 5, 31),
+            ],
+            [dt.date() for dt in spec.rrule(datetime.date(2020, 1, 31))],
+        )
+
+    def test_parse_on(self):
+        self.assertEqual(
+            recurrence.Recurrence(
+                "Gym", rrule.WEEKLY, weekdays=frozenset({0, 2, 4}), count=6
+            ),
+            recurrence.parse_recurrence("Gym [WEEKLY ON MON, WE,FRI REPEAT 6 TIMES]"),
+        )
+        self.assertEqual(
+            recurrence.Recurrence(
+                "Rent", rrule.MONTHLY, weekdays=recurrence.BUSINESS_DAYS, setpos=-1
+            ),
+            recurrence.parse_recurrence("Rent [MONTHLY ON LAST BUSINESS DAY]"),
+        )
+        self.assertEqual(
+            recurrence.Recurrence(
+                "Club", rrule.MONTHLY, weekdays=frozenset({1}), setpos=2, interval=2
+            ),
+            recurrence.parse_recurrence("Club [MONTHLY ON 2ND TUE SKIP 1 TIME]"),
+        )
+        # A week has a single Tuesday, so these could never generate a date.
+        for narration in (
+            "Gym [WEEKLY ON 2ND TUE REPEAT 3 TIMES]",
+            "Gym [DAILY ON LAST FRI REPEAT 2 TIMES]",
+            "Rent [WEEKLY ON LAST BUSINESS DAY]",
+        ):
+            with self.assertRaises(ValueError):
+                recurrence.parse_recurrence(narration)
+
+    def test_dates_match_rrule(self):
+        narrations = [
+            "[DAILY REPEAT 40 TIMES]",
+            "[DAILY SKIP 2 TIMES UNTIL 2021-03-01]",
+            "[WEEKLY SKIP 1 TIME REPEAT 30 TIMES]",
+            "[WEEKLY ON MON,WED,FRI UNTIL 2020-06-30]",
+            "[WEEKLY ON SU SKIP 2 TIMES REPEAT 12 TIMES]",
+            "[MONTHLY REPEAT 30 TIMES]",
+            "[MONTHLY SKIP 1 TIME UNTIL 2024-12-31]",
+            "[MONTHLY ON LAST BUSINESS DAY REPEAT 30 TIMES]",
+            "[MONTHLY ON 2ND TUE UNTIL 2022-12-31]",
+            "[MONTHLY ON 5TH FRI REPEAT 10 TIMES]",
+            "[MONTHLY ON LAST SAT SKIP 2 TIMES REPEAT 10 TIMES]",
+            "[YEARLY REPEAT 12 TIMES]",
+            "[YEARLY ON 1ST MON UNTIL 2030-12-31]",
+            "[YEARLY ON LAST BUSINESS DAY REPEAT 5 TIMES]",
+        ]
+        starts = [
+            datetime.date(2020, 1, 31),
+            datetime.date(2020, 2, 29),
+            datetime.date(2020, 3, 4),
+            datetime.date(2021, 12, 31),
+        ]
+        for narration in narrations:
+            spec = recurrence.parse_recurrence(narration)
+            for start in starts:
+                with self.subTest(narration=narration, start=start):
+                    expected = [dt.date() for dt in spec.rrule(start)]
+                    self.assertEqual(expected, list(spec.dates(start)))
+                    after = start + datetime.timedelta(days=45)
+                    self.assertEqual(
+                        [date for date in expected if date >= after],
+                        list(spec.dates(start).after(after, inc=True)),
+                    )
+
+    def test_horizon(self):
+        spec = recurrence.parse_recurrence("Rent [MONTHLY]")
+        self.assertEqual(
+            [datetime.date(2020, 1, 15), datetime.date(2020, 2, 15)],
+            [
+                dt.date()
+                for dt in spec.rrule(datetime.date(2020, 1, 15), datetime.date(2020, 3, 1))
+            ],
+        )
+        last = datetime.date(2020, 1, 31)
+        self.assertEqual(
+            datetime.date(2020, 3, 1), recurrence.parse_horizon("2020-03-01", last)
+        )
+        self.assertEqual(
+            datetime.date(2021, 7, 31), recurrence.parse_horizon("18 MONTHS", last)
+        )
+        self.assertEqual(
+            datetime.date(2020, 2, 14), recurrence.parse_horizon("+2 weeks", last)
+        )
+        with self.assertRaises(ValueError):
+            recurrence.parse_horizon("soon", last)
+
+    def test_forecast_window(self):
+        entries = [
+            Entry(datetime.date(2020, 1, 1), False),
+            Entry(datetime.date(2020, 3, 31), False),
+            Entry(datetime.date(2020, 4, 30), True),
+        ]
+        window = recurrence.forecast_window(
+            entries, lambda entry: entry.template, "1 YEAR", 31
+        )
+        # The template doesn't count towards the last date of the ledger.
+        self.assertEqual(
+            recurrence.Window(datetime.date(2020, 2, 29), datetime.date(2021, 3, 31)),
+            window,
+        )
+        rule = recurrence.parse_recurrence("Rent [MONTHLY REPEAT 4 TIMES]").dates(
+            datetime.date(2020, 1, 29)
+        )
+        self.assertEqual(
+            [
+                datetime.date(2020, 2, 29),
+                datetime.date(2020, 3, 29),
+                datetime.date(2020, 4, 29),
+            ],
+            list(window.dates(rule)),
+        )
+        self.assertEqual(recurrence.Window(), recurrence.forecast_window(entries, bool))
+        self.assertEqual(datetime.date(2021, 3, 31), window.end)
+        self.assertEqual(
+            datetime.date(datetime.date.today().year, 12, 31), recurrence.Window().end
+        )
+        self.assertFalse(
+            recurrence.parse_recurrence("Rent [MONTHLY REPEAT 4 TIMES]").open_ended
+        )
+        self.assertTrue(recurrence.parse_recurrence("Rent [MONTHLY]").open_ended)
+
+
+class Entry(NamedTuple):
+    date: datetime.date
+    template: bool
+
+
+if __name__ == "__main__":
+    unittest.main()